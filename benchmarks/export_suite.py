@@ -0,0 +1,213 @@
+"""Benchmark whole exports against a local synthetic GitBook.
+
+Usage: python benchmarks/export_suite.py [--pages 50] [--links-per-page 10]
+           [--images-per-page 2] [--image-kb 32] [--css-kb 200]
+           [--concurrency 4] [--output FILE]
+
+A generated book (see ``mock_gitbook.py``) is served on 127.0.0.1 and the
+stages of both conversion methods are measured:
+
+* html: crawl throughput, image pipeline, CSS, assembly peak memory and
+  the full ``generate_pdf`` render (needs wkhtmltopdf)
+* print: link discovery and the full ``generate_pdf`` print (needs Chrome)
+* merge: ``merge_pdfs`` over one synthetic PDF per page
+
+Stages whose tools are missing are reported as skipped. The results are
+written as JSON together with the parameters and the git revision, so runs
+of different versions can be compared.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urljoin
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from PyPDF2 import PdfWriter  # noqa: E402
+
+import gitbook_to_pdf  # noqa: E402
+from mock_gitbook import build_site, serve  # noqa: E402
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_html(base_url, site, args, directory):
+    results = {}
+    image_urls = [urljoin(base_url, path) for path in site if path.endswith(".png")]
+    image_bytes = sum(
+        len(body) for path, (_, body) in site.items() if path.endswith(".png")
+    )
+
+    with gitbook_to_pdf.GitbookToPDF(
+        base_url, concurrency=args.concurrency
+    ) as converter:
+        _, seconds = timed(converter.get_page_content, base_url)
+        pages = len(converter.page_fragments)
+        results["crawl"] = {
+            "pages": pages,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(pages / seconds, 1),
+        }
+
+        css, seconds = timed(converter.download_css)
+        results["css"] = {
+            "seconds": round(seconds, 3),
+            "input_kb": args.css_kb,
+            "output_kb": round(len(css) / 1024, 1),
+        }
+
+        document = Path(directory) / "book.html"
+        tracemalloc.start()
+        _, seconds = timed(
+            converter._write_document,
+            document, f"<html><head><style>{css}</style></head><body>",
+            converter.page_fragments,
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["assembly"] = {
+            "seconds": round(seconds, 3),
+            "document_mb": round(document.stat().st_size / 2**20, 2),
+            "peak_mb": round(peak / 2**20, 2),
+        }
+
+        try:
+            gitbook_to_pdf.resolve_wkhtmltopdf()
+        except FileNotFoundError as error:
+            results["render"] = {"skipped": str(error)}
+        else:
+            output = Path(directory) / "html.pdf"
+            _, seconds = timed(converter.generate_pdf, str(output))
+            results["render"] = {
+                "seconds": round(seconds, 3),
+                "pdf_mb": round(output.stat().st_size / 2**20, 2),
+            }
+
+    with gitbook_to_pdf.GitbookToPDF(
+        base_url, concurrency=args.concurrency
+    ) as converter:
+        def download_all():
+            futures = [converter.fetch_image(url) for url in image_urls]
+            return [future.result() for future in futures]
+
+        _, seconds = timed(download_all)
+        results["images"] = {
+            "images": len(image_urls),
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(image_bytes / 2**20 / seconds, 1),
+        }
+    return results
+
+
+def bench_print(base_url, args, directory):
+    try:
+        converter = gitbook_to_pdf.GitbookToPDF(
+            base_url, method="print", print_workers=args.print_workers
+        )
+    except Exception as error:
+        return {"skipped": f"Chrome is not available: {error}"}
+
+    results = {}
+    with converter:
+        links, seconds = timed(converter.get_all_links, base_url)
+        results["links"] = {"links": len(links), "seconds": round(seconds, 3)}
+
+        output = Path(directory) / "print.pdf"
+        _, seconds = timed(converter.generate_pdf, str(output))
+        results["print"] = {
+            "seconds": round(seconds, 3),
+            "pdf_mb": round(output.stat().st_size / 2**20, 2),
+        }
+    return results
+
+
+def bench_merge(pages, directory):
+    files = []
+    for index in range(pages):
+        path = Path(directory) / f"merge_{index:05d}.pdf"
+        writer = PdfWriter()
+        writer.add_blank_page(width=595, height=842)
+        with open(path, "wb") as f:
+            writer.write(f)
+        files.append(str(path))
+
+    with gitbook_to_pdf.GitbookToPDF("http://127.0.0.1/") as converter:
+        _, seconds = timed(
+            converter.merge_pdfs, files, str(Path(directory) / "merged.pdf"),
+            [f"Page {index}" for index in range(pages)],
+        )
+    return {"pages": pages, "seconds": round(seconds, 3)}
+
+
+def run(args):
+    parameters = {
+        "pages": args.pages,
+        "links_per_page": args.links_per_page,
+        "images_per_page": args.images_per_page,
+        "image_kb": args.image_kb,
+        "css_kb": args.css_kb,
+        "concurrency": args.concurrency,
+    }
+    site = build_site(
+        pages=args.pages,
+        links_per_page=args.links_per_page,
+        images_per_page=args.images_per_page,
+        image_kb=args.image_kb,
+        css_kb=args.css_kb,
+    )
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": parameters,
+    }
+    with tempfile.TemporaryDirectory() as directory, serve(site) as base_url:
+        results["html"] = bench_html(base_url, site, args, directory)
+        results["print"] = bench_print(base_url, args, directory)
+        results["merge"] = bench_merge(args.pages, directory)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--links-per-page", type=int, default=10)
+    parser.add_argument("--images-per-page", type=int, default=2)
+    parser.add_argument("--image-kb", type=int, default=32)
+    parser.add_argument("--css-kb", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--print-workers", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(results + "\n", encoding="utf-8")
+    print(results)
+
+
+if __name__ == "__main__":
+    main()
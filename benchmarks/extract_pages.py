@@ -0,0 +1,152 @@
+"""Measure HTML extraction time per page over a corpus of GitBook pages.
+
+Usage: python benchmarks/extract_pages.py [--corpus DIR] [--pages 200]
+                                          [--repeat 3] [--output FILE]
+
+The corpus is every ``*.html`` file under DIR, e.g. pages saved from a real
+book with ``curl``. Without ``--corpus`` synthetic pages shaped like a
+GitBook page (sidebar navigation, stylesheets, an article with images) are
+used. The previous multi-pass extraction on ``html.parser`` is compared
+with ``PageExtractor`` on every installed parser backend.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urljoin
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from gitbook_to_pdf import PageExtractor  # noqa: E402
+
+BASE_URL = "https://example.com/book/"
+
+
+def synthetic_page(index, sidebar_links=150, paragraphs=60):
+    navigation = "".join(
+        f'<li class="chapter"><a href="chapter-{n}.html">Chapter {n}</a></li>'
+        for n in range(sidebar_links)
+    )
+    body = "".join(
+        f"<p>Paragraph {n} of page {index} with <code>code</code> and a "
+        f'<a href="chapter-{n}.html#s{n}">reference</a>.</p>'
+        + (f'<img src="assets/figure-{index}-{n}.png">' if n % 10 == 0 else "")
+        for n in range(paragraphs)
+    )
+    return (
+        f"<html><head><title>Page {index}</title>"
+        '<link rel="stylesheet" href="gitbook/style.css">'
+        '<link rel="stylesheet" href="gitbook/website.css"></head>'
+        f'<body><div class="book"><div class="book-summary"><ul class="summary">'
+        f"{navigation}</ul></div>"
+        f'<div class="page-inner"><section class="markdown-section">'
+        f"<h1>Page {index}</h1>{body}</section></div></div></body></html>"
+    )
+
+
+def load_corpus(directory, pages):
+    if directory:
+        return [
+            path.read_text(encoding="utf-8", errors="replace")
+            for path in sorted(Path(directory).rglob("*.html"))
+        ]
+    return [synthetic_page(index) for index in range(pages)]
+
+
+def multi_pass(html, url):
+    """The extraction used before PageExtractor, for comparison."""
+    soup = BeautifulSoup(html, "html.parser")
+    stylesheets = [
+        urljoin(url, link.get("href"))
+        for link in soup.find_all("link", rel="stylesheet")
+        if link.get("href")
+    ]
+    images = [
+        urljoin(url, img.get("src"))
+        for img in soup.find_all("img")
+        if img.get("src")
+    ]
+    content = (
+        soup.find("article") or soup.find("main") or
+        soup.find("div", class_="page-inner")
+    )
+    links = [urljoin(url, link["href"]) for link in soup.find_all("a", href=True)]
+    return stylesheets, images, str(content) if content else None, links
+
+
+def single_pass(parser):
+    extractor = PageExtractor(parser=parser)
+
+    def extract(html, url):
+        page = extractor.extract(html, url)
+        content = page["content"]
+        return page, str(content) if content is not None else None
+
+    return extract
+
+
+def available_parsers():
+    parsers = ["html.parser"]
+    try:
+        import lxml  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        parsers.append("lxml")
+    return parsers
+
+
+def measure(extract, corpus, repeat):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for html in corpus:
+            extract(html, BASE_URL)
+        runs.append(time.perf_counter() - started)
+    best = min(runs)
+    return {
+        "seconds": round(best, 3),
+        "median_seconds": round(statistics.median(runs), 3),
+        "ms_per_page": round(best * 1000 / len(corpus), 2),
+    }
+
+
+def run(corpus, repeat):
+    results = {
+        "pages": len(corpus),
+        "corpus_mb": round(sum(len(html) for html in corpus) / 2**20, 2),
+        "multi_pass/html.parser": measure(multi_pass, corpus, repeat),
+    }
+    for parser in available_parsers():
+        results[f"single_pass/{parser}"] = measure(
+            single_pass(parser), corpus, repeat
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="Directory of saved .html pages")
+    parser.add_argument(
+        "--pages", type=int, default=200,
+        help="Number of synthetic pages when no corpus is given",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus, args.pages)
+    if not corpus:
+        parser.error(f"no .html files found in {args.corpus}")
+    results = json.dumps(run(corpus, args.repeat), indent=2)
+    if args.output:
+        Path(args.output).write_text(results + "\n", encoding="utf-8")
+    print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Measure peak memory of merging per-page PDFs as the page count grows.
+
+Usage: python benchmarks/merge_memory.py [--pages 100 400 1600] [--output FILE]
+
+Each input is a one-page PDF with a ~64 KB content stream, similar to a
+page printed by Chrome. The streaming merger used by ``merge_pdfs`` is
+compared with PyPDF2's ``PdfMerger``, which keeps every page in memory.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from PyPDF2 import PdfMerger, PdfWriter  # noqa: E402
+from PyPDF2.generic import DecodedStreamObject, NameObject  # noqa: E402
+
+from gitbook_to_pdf import StreamingPdfMerger  # noqa: E402
+
+
+def write_page(path, index, stream_bytes=64 * 1024):
+    writer = PdfWriter()
+    page = writer.add_blank_page(width=595, height=842)
+    content = DecodedStreamObject()
+    line = f"BT /F1 12 Tf 72 720 Td (page {index}) Tj ET\n".encode("ascii")
+    content.set_data(line * (stream_bytes // len(line)))
+    page[NameObject("/Contents")] = writer._add_object(content)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def measure(merge, files, output):
+    tracemalloc.start()
+    started = time.perf_counter()
+    merge(files, output)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(elapsed, 3), "peak_mb": round(peak / 2**20, 2)}
+
+
+def streaming_merge(files, output):
+    with StreamingPdfMerger(output) as merger:
+        for index, pdf in enumerate(files):
+            merger.append(pdf, f"Page {index}")
+
+
+def pypdf2_merge(files, output):
+    merger = PdfMerger()
+    for pdf in files:
+        merger.append(pdf)
+    merger.write(output)
+    merger.close()
+
+
+def run(page_counts):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        files = []
+        for pages in page_counts:
+            while len(files) < pages:
+                path = directory / f"page_{len(files):05d}.pdf"
+                write_page(path, len(files))
+                files.append(str(path))
+            results.append({
+                "pages": pages,
+                "streaming": measure(
+                    streaming_merge, files[:pages], directory / "streaming.pdf"
+                ),
+                "pypdf2": measure(
+                    pypdf2_merge, files[:pages], directory / "pypdf2.pdf"
+                ),
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 400, 1600])
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = json.dumps(run(args.pages), indent=2)
+    if args.output:
+        Path(args.output).write_text(results + "\n", encoding="utf-8")
+    print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""A synthetic GitBook served from memory by a local HTTP server.
+
+Used by the benchmark suite so that exports can be measured without the
+network. ``build_site`` generates the pages, images and stylesheet and
+``serve`` runs them on ``127.0.0.1`` for the duration of a ``with`` block::
+
+    with serve(build_site(pages=50)) as base_url:
+        ...
+"""
+import random
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def png_image(size_kb, seed):
+    """Return a valid RGB PNG of roughly `size_kb` kilobytes.
+
+    The pixels are noise so that compression does not shrink the file.
+    """
+    side = max(1, int((size_kb * 1024 / 3) ** 0.5))
+    rows = random.Random(seed)
+    raw = b"".join(
+        b"\x00" + rows.getrandbits(side * 24).to_bytes(side * 3, "little")
+        for _ in range(side)
+    )
+
+    def chunk(kind, data):
+        body = kind + data
+        return (
+            struct.pack(">I", len(data)) + body +
+            struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n" +
+        chunk(b"IHDR", struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)) +
+        chunk(b"IDAT", zlib.compress(raw, 1)) +
+        chunk(b"IEND", b"")
+    )
+
+
+def stylesheet(size_kb):
+    """Return a GitBook-like theme of about `size_kb` kilobytes.
+
+    Half of the rules style the page content and half the site chrome
+    (sidebar, header, dark mode) that the converter strips away.
+    """
+    rules = []
+    size = 0
+    index = 0
+    while size < size_kb * 1024:
+        if index % 2:
+            rule = (
+                f".book-summary .chapter-{index} a:hover, "
+                f"html.dark .header-{index} {{ color: #{index % 4096:03x}; "
+                f"padding: {index % 7}px {index % 11}px; }}\n"
+            )
+        else:
+            rule = (
+                f".markdown-section p, .markdown-section code.lang-{index} "
+                f"{{ margin: {index % 5}px 0; line-height: 1.{index % 9}; }}\n"
+            )
+        rules.append(rule)
+        size += len(rule)
+        index += 1
+    return "".join(rules)
+
+
+def build_site(pages=50, links_per_page=10, images_per_page=2, image_kb=32,
+               css_kb=200, paragraphs=20, seed=0):
+    """Return a ``{path: (content_type, body)}`` map for a synthetic book.
+
+    Every page carries the full sidebar navigation, `links_per_page` links
+    to other pages inside its content and `images_per_page` distinct
+    images. All pages share one stylesheet of `css_kb` kilobytes.
+    """
+    choose = random.Random(seed)
+    paths = ["/"] + [f"/chapter-{number}.html" for number in range(1, pages)]
+    summary = "".join(
+        f'<li class="chapter"><a href="{path}">Chapter {number}</a></li>'
+        for number, path in enumerate(paths)
+    )
+    site = {
+        "/gitbook/style.css": ("text/css", stylesheet(css_kb).encode()),
+    }
+    for number, path in enumerate(paths):
+        body = []
+        for paragraph in range(paragraphs):
+            target = choose.choice(paths)
+            body.append(
+                f"<p>Paragraph {paragraph} of chapter {number} with "
+                f"<code>inline code</code> and "
+                + (
+                    f'<a href="{target}">a cross reference</a>.</p>'
+                    if paragraph < links_per_page else "plain text.</p>"
+                )
+            )
+        for _ in range(paragraphs, links_per_page):
+            body.append(f'<p><a href="{choose.choice(paths)}">See also</a></p>')
+        for image in range(images_per_page):
+            image_path = f"/assets/figure-{number}-{image}.png"
+            site[image_path] = (
+                "image/png", png_image(image_kb, seed=number * 1000 + image)
+            )
+            body.insert(
+                (image + 1) * len(body) // (images_per_page + 1),
+                f'<p><img src="{image_path}" alt="Figure {image}"></p>',
+            )
+        html = (
+            f"<!DOCTYPE html><html><head><title>Chapter {number}</title>"
+            '<link rel="stylesheet" href="/gitbook/style.css"></head>'
+            '<body><div class="book"><div class="book-summary">'
+            f'<ul class="summary">{summary}</ul></div>'
+            '<div class="body-inner"><div class="page-wrapper">'
+            '<div class="page-inner"><section class="markdown-section">'
+            f"<h1>Chapter {number}</h1>{''.join(body)}"
+            "</section></div></div></div></div></body></html>"
+        )
+        site[path] = ("text/html; charset=utf-8", html.encode())
+    return site
+
+
+@contextmanager
+def serve(site):
+    """Serve `site` on an ephemeral local port and yield its base URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            entry = site.get(self.path.split("?", 1)[0].split("#", 1)[0])
+            if entry is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content_type, body = entry
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -1,6 +1,7 @@
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+import html
+from bs4 import BeautifulSoup, Tag
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
 import os
 import pdfkit
 import logging
@@ -16,14 +17,61 @@ import tempfile
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
-from PyPDF2 import PdfMerger
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    TextStringObject,
+)
 from selenium.common.exceptions import WebDriverException
 import time
 import argparse
+import asyncio
+import threading
+import queue
+import io
+import array
+import multiprocessing
+import random
+from email.utils import parsedate_to_datetime
+import xml.etree.ElementTree as ElementTree
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 是可选依赖，仅用于图片优化
+    Image = ImageOps = None
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp 是可选依赖，仅用于 AsyncGitbookToPDF
+    aiohttp = None
+
+try:
+    import psutil
+except ImportError:  # psutil 是可选依赖，用于统计浏览器进程内存
+    psutil = None
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，改用 msvcrt 加锁
+    fcntl = None
+    import msvcrt
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:  # lxml 是可选依赖，缺失时使用内置解析器
+    HTML_PARSER = 'html.parser'
 
 
 def resolve_wkhtmltopdf(explicit_path=None):
@@ -47,445 +95,4951 @@ def resolve_wkhtmltopdf(explicit_path=None):
     )
 
 
-def setup_chrome_driver():
-    """设置 Chrome 驱动"""
+def wkhtmltopdf_options(current_date):
+    """Return the wkhtmltopdf options of the HTML method."""
+    return {
+        'encoding': 'UTF-8',
+        'page-size': 'A4',
+        'margin-top': '2cm',
+        'margin-right': '2.5cm',
+        'margin-bottom': '2cm',
+        'margin-left': '2.5cm',
+        'header-right': '[title]',
+        'header-font-size': '9',
+        'header-spacing': '10',
+        'footer-center': '[page]',
+        'footer-font-size': '10',
+        'footer-right': current_date,
+        'footer-spacing': '10',
+        'zoom': '1.2',
+        'enable-local-file-access': None,
+        'quiet': ''
+    }
+
+
+def wkhtmltopdf_number_options(options):
+    """Return `options` for transparent pages carrying only the page number."""
+    number_options = {
+        name: value for name, value in options.items()
+        if not name.startswith(('header-', 'footer-')) or
+        name in ('footer-center', 'footer-font-size', 'footer-spacing')
+    }
+    number_options['no-background'] = None
+    return number_options
+
+
+async def run_wkhtmltopdf(html_path, pdf_path, options, pdfkit_config):
+    """Render `html_path` to `pdf_path` in an asyncio subprocess.
+
+    Runs the command `pdfkit.from_file` would run and fails the same way.
+    The process is killed when the awaiting task is cancelled.
+    """
+    kit = pdfkit.PDFKit(
+        str(html_path), 'file', options=options, configuration=pdfkit_config
+    )
+    command = kit.command(str(pdf_path))
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=kit.environ,
+    )
     try:
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--window-size=1920,1080')
-        
-        # 添加 PDF 打印首选项
-        chrome_options.add_experimental_option('prefs', {
-            'printing.print_preview_sticky_settings.appState': json.dumps({
-                'recentDestinations': [{
-                    'id': 'Save as PDF',
-                    'origin': 'local',
-                    'account': ''
-                }],
-                'selectedDestinationId': 'Save as PDF',
-                'version': 2,
-                'isHeaderFooterEnabled': False,
-                'isLandscapeEnabled': False,
-            })
-        })
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    stderr = (stderr or stdout or b"").decode('utf-8', errors='replace')
+    kit.handle_error(process.returncode, stderr)
+    if not os.path.exists(pdf_path) or not os.path.getsize(pdf_path):
+        raise IOError(f"Command failed: {' '.join(command)}")
 
+
+DEFAULT_CACHE_SIZE_MB = 1024
+
+
+def write_atomic(path, data):
+    """Write bytes to `path` so readers never observe a partial file."""
+    path = Path(path)
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}."
+    )
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
         try:
-            driver = webdriver.Chrome(options=chrome_options)
-        except WebDriverException:
-            print("正在安装 ChromeDriver...")
-            service = Service(ChromeDriverManager().install())
-            driver = webdriver.Chrome(service=service, options=chrome_options)
-        
-        return driver
-    except Exception as error:
-        raise RuntimeError(
-            "Could not start Chrome. Ensure Google Chrome is installed."
-        ) from error
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
 
-class GitbookToPDF:
-    def __init__(self, base_url, method='html', wkhtmltopdf_path=None):
-        self.base_url = base_url
-        self.visited_urls = set()
-        self.all_content = []
-        self.session = requests.Session()
-        self.css_files = set()
-        self.title = ""
-        self.images = {}
-        self.method = method
-        self.wkhtmltopdf_path = wkhtmltopdf_path
-        self.driver = None
-        self._temporary_directory = tempfile.TemporaryDirectory(
-            prefix="gitbook-to-pdf-"
+
+DEFAULT_TIMEOUT = (10, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_RETRY_DELAY = 60
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value, now=None):
+    """Return the delay in seconds requested by a Retry-After header.
+
+    Accepts both forms of the header (delta seconds and an HTTP date) and
+    returns None when it is missing or malformed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, when.timestamp() - now)
+
+
+def retry_delay(attempt, backoff=DEFAULT_BACKOFF, retry_after=None,
+                max_delay=MAX_RETRY_DELAY):
+    """Return how long to wait before retry number `attempt` (from 0).
+
+    A server supplied Retry-After wins; otherwise the delay grows
+    exponentially from `backoff` with full jitter so that parallel workers
+    do not retry in lockstep.
+    """
+    if retry_after is not None:
+        return min(retry_after, max_delay)
+    return random.uniform(0, min(max_delay, backoff * 2 ** attempt))
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token; return 0, or the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate,
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait on the event loop until a token is available and take it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class HostRateLimiter:
+    """One token bucket per host; a `rate` of None disables limiting."""
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url):
+        host = canonical_netloc(urlparse(url))
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[host] = bucket
+        return bucket
+
+    def acquire(self, url):
+        if self.rate:
+            self._bucket(url).acquire()
+
+    async def acquire_async(self, url):
+        if self.rate:
+            await self._bucket(url).acquire_async()
+
+
+class Metrics:
+    """Counters and per-stage timers collected during an export.
+
+    Timers keep every sample, so the report can give per-page latencies and
+    percentiles. Hooks registered with `add_hook` are called as
+    ``hook(kind, name, value, labels)`` for every timer sample (``kind`` is
+    ``'timer'``, `value` the duration in seconds) and counter increment
+    (``'counter'``), which is enough to feed an external tracing or metrics
+    system.
+    """
+
+    PREFIX = 'gitbook_to_pdf'
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.samples = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _emit(self, kind, name, value, labels):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception as e:
+                logging.error(f"Metrics hook failed: {str(e)}")
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self._emit('counter', name, value, labels)
+
+    def set(self, name, value):
+        """Record a total that is counted elsewhere, e.g. cache hits."""
+        with self._lock:
+            self.counters[name] = value
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            self.samples.setdefault(name, []).append((seconds, labels))
+        self._emit('timer', name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the enclosed block as one sample of stage `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def report(self):
+        """Return the collected metrics as a JSON-serializable dict."""
+        with self._lock:
+            counters = dict(self.counters)
+            samples = {name: list(values) for name, values in self.samples.items()}
+        timers = {}
+        pages = []
+        for name, values in samples.items():
+            durations = sorted(seconds for seconds, _ in values)
+            timers[name] = {
+                'count': len(durations),
+                'total_seconds': round(sum(durations), 6),
+                'mean_seconds': round(sum(durations) / len(durations), 6),
+                'p50_seconds': round(durations[(len(durations) - 1) // 2], 6),
+                'p95_seconds': round(
+                    durations[int(0.95 * (len(durations) - 1))], 6
+                ),
+                'max_seconds': round(durations[-1], 6),
+            }
+            pages.extend(
+                {'stage': name, 'url': labels['url'], 'seconds': round(seconds, 6)}
+                for seconds, labels in values
+                if 'url' in labels
+            )
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'duration_seconds': round(time.time() - self.started, 3),
+            'counters': counters,
+            'timers': timers,
+            'pages': pages,
+        }
+
+    def prometheus(self):
+        """Return the report in the Prometheus text exposition format."""
+        report = self.report()
+        lines = []
+        for name, value in sorted(report['counters'].items()):
+            metric = f"{self.PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        metric = f"{self.PREFIX}_stage_seconds"
+        if report['timers']:
+            lines.append(f"# TYPE {metric} summary")
+        for name, timer in sorted(report['timers'].items()):
+            for quantile in ('0.5', '0.95'):
+                key = 'p50_seconds' if quantile == '0.5' else 'p95_seconds'
+                lines.append(
+                    f'{metric}{{stage="{name}",quantile="{quantile}"}} '
+                    f"{timer[key]}"
+                )
+            lines.append(f'{metric}_sum{{stage="{name}"}} {timer["total_seconds"]}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {timer["count"]}')
+        metric = f"{self.PREFIX}_duration_seconds"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {report['duration_seconds']}")
+        return '\n'.join(lines) + '\n'
+
+
+class ExportCancelled(Exception):
+    """Raised inside an export after `GitbookToPDF.cancel` was called."""
+
+
+class CachedResponse:
+    """The parts of `requests.Response` used by the converter, from cache."""
+
+    status_code = 200
+
+    def __init__(self, url, content, headers):
+        self.url = url
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers)
+
+    @property
+    def text(self):
+        encoding = requests.utils.get_encoding_from_headers(self.headers)
+        if 'charset' not in self.headers.get('content-type', ''):
+            encoding = 'utf-8'
+        return self.content.decode(encoding or 'utf-8', errors='replace')
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=8192):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class BufferedResponse(CachedResponse):
+    """A response read in full by `AsyncGitbookToPDF`'s HTTP client."""
+
+    def __init__(self, url, status_code, content, headers):
+        super().__init__(url, content, headers)
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+
+    def close(self):
+        pass
+
+
+class HTTPCache:
+    """Persistent response cache revalidated with conditional GETs.
+
+    Bodies are stored once per SHA-256 content hash under ``objects/`` and
+    ``index.json`` maps each URL to its body hash, ETag/Last-Modified
+    validators and last use. Least recently used URLs are evicted once the
+    stored bodies exceed `max_bytes`.
+
+    The index is saved every `SAVE_INTERVAL` seconds while bodies are
+    stored, not only on `save`. Bodies the index does not reference, left
+    by a crash or by another process whose index was overwritten, are
+    deleted on load once they are older than `ORPHAN_AGE` seconds.
+    """
+
+    INDEX_NAME = 'index.json'
+    STORED_HEADERS = ('content-type', 'etag', 'last-modified')
+    SAVE_INTERVAL = 30
+    ORPHAN_AGE = 3600
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE_MB * 2**20):
+        self.directory = Path(directory).expanduser()
+        self.objects_dir = self.directory / 'objects'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = self._load_index()
+        self._saved = time.monotonic()
+        self._remove_orphans()
+
+    def _remove_orphans(self):
+        referenced = {entry['hash'] for entry in self._entries.values()}
+        # 较新的对象可能属于仍在运行、尚未保存索引的其他进程
+        cutoff = time.time() - self.ORPHAN_AGE
+        for path in self.objects_dir.glob('*/*'):
+            try:
+                if (path.name not in referenced and
+                        path.stat().st_mtime < cutoff):
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _load_index(self):
+        try:
+            with open(self.directory / self.INDEX_NAME, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable HTTP cache index: {str(e)}")
+            return {}
+
+    def save(self):
+        """Persist the URL index."""
+        with self._lock:
+            data = json.dumps(self._entries, sort_keys=True).encode('utf-8')
+            self._saved = time.monotonic()
+        write_atomic(self.directory / self.INDEX_NAME, data)
+
+    def object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+
+    def fetch(self, get, url, **kwargs):
+        """GET `url` with `get`, revalidating any cached copy.
+
+        Returns a `CachedResponse` for cached or cacheable bodies and the
+        original response for anything that cannot be cached.
+        """
+        kwargs.pop('stream', None)
+        entry, headers = self._conditional_headers(
+            url, kwargs.pop('headers', None)
         )
-        self.workspace_dir = Path(self._temporary_directory.name)
-        self.image_dir = self.workspace_dir / "images"
-        self.temp_dir = self.workspace_dir / "pages"
-        self.image_dir.mkdir()
-        self.temp_dir.mkdir()
+        response = self._complete(
+            url, entry, get(url, headers=headers, **kwargs)
+        )
+        if response is None:
+            return self.fetch(get, url, **kwargs)
+        return response
+
+    async def fetch_async(self, get, url, **kwargs):
+        """Like `fetch`, for a coroutine function `get`."""
+        kwargs.pop('stream', None)
+        entry, headers = self._conditional_headers(
+            url, kwargs.pop('headers', None)
+        )
+        response = self._complete(
+            url, entry, await get(url, headers=headers, **kwargs)
+        )
+        if response is None:
+            return await self.fetch_async(get, url, **kwargs)
+        return response
+
+    def _conditional_headers(self, url, headers):
+        """Return the cache entry of `url` and the headers to revalidate it."""
+        headers = dict(headers or {})
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry and not self.object_path(entry['hash']).exists():
+                entry = None
+        if entry:
+            if entry['headers'].get('etag'):
+                headers['If-None-Match'] = entry['headers']['etag']
+            if entry['headers'].get('last-modified'):
+                headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return entry, headers
+
+    def _complete(self, url, entry, response):
+        """Serve or store the body of `response`.
+
+        Returns None when the server confirmed a cached body that has been
+        evicted since, so the request has to be sent again.
+        """
+        if entry and response.status_code == 304:
+            try:
+                content = self.object_path(entry['hash']).read_bytes()
+            except FileNotFoundError:
+                return None
+            with self._lock:
+                entry['used'] = time.time()
+                self.hits += 1
+            return CachedResponse(url, content, entry['headers'])
+
+        response.raise_for_status()
+        with self._lock:
+            self.misses += 1
+        if response.status_code != 200:
+            return response
+        content = response.content
+        stored_headers = {
+            name: response.headers[name]
+            for name in self.STORED_HEADERS
+            if response.headers.get(name)
+        }
+        self.store(url, content, stored_headers)
+        return CachedResponse(url, content, stored_headers)
+
+    def store(self, url, content, headers):
+        """Record `content` as the current body of `url`."""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            write_atomic(path, content)
+        with self._lock:
+            self._entries[url] = {
+                'hash': digest,
+                'size': len(content),
+                'headers': headers,
+                'used': time.time(),
+            }
+            self._evict()
+            due = time.monotonic() - self._saved >= self.SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def _evict(self):
+        sizes = {}
+        references = {}
+        for entry in self._entries.values():
+            sizes[entry['hash']] = entry['size']
+            references[entry['hash']] = references.get(entry['hash'], 0) + 1
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        for url, entry in sorted(
+            self._entries.items(), key=lambda item: item[1]['used']
+        ):
+            if total <= self.max_bytes:
+                break
+            del self._entries[url]
+            references[entry['hash']] -= 1
+            if not references[entry['hash']]:
+                total -= entry['size']
+                try:
+                    os.remove(self.object_path(entry['hash']))
+                except OSError:
+                    pass
+
+
+class BuildManifest:
+    """Map page URLs to their content hash and last rendered artifact.
 
+    Artifacts are kept under ``artifacts/<name>/`` next to ``<name>.json``.
+    A page whose content hash is unchanged since the last export reuses its
+    artifact instead of being rendered again. Records for pages that were
+    not seen during a completed export are dropped when the manifest is
+    saved; an interrupted export keeps them for the next run.
+    """
+
+    def __init__(self, directory, name):
+        directory = Path(directory).expanduser()
+        self.path = directory / f'{name}.json'
+        self.artifacts_dir = directory / 'artifacts' / name
+        self.artifacts_dir.mkdir(parents=True, exist_ok=True)
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._seen = set()
         try:
-            if self.method == 'print':
-                self.driver = setup_chrome_driver()
-        except Exception:
-            self._temporary_directory.cleanup()
-            self._temporary_directory = None
+            with open(self.path, encoding='utf-8') as f:
+                self._records = json.load(f)
+        except FileNotFoundError:
+            self._records = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable build manifest: {str(e)}")
+            self._records = {}
+
+    def artifact(self, url, content_hash):
+        """Return the stored artifact of an unchanged page, or None."""
+        with self._lock:
+            self._seen.add(url)
+            record = self._records.get(url)
+        if not record or record['hash'] != content_hash:
+            return None
+        path = self.artifacts_dir / record['artifact']
+        if not path.is_file():
+            return None
+        with self._lock:
+            self.reused += 1
+        return path
+
+    def store_bytes(self, url, content_hash, data, suffix):
+        """Record `data` as the artifact rendered from `content_hash`."""
+        path = self._artifact_path(url, suffix)
+        write_atomic(path, data)
+        self._record(url, content_hash, path)
+        return path
+
+    def store_file(self, url, content_hash, source, **details):
+        """Record a copy of the file at `source` as the page artifact."""
+        path = self._artifact_path(url, Path(source).suffix)
+        shutil.copyfile(source, path)
+        self._record(url, content_hash, path, details)
+        return path
+
+    def details(self, url):
+        """Return the extra details stored with the artifact of `url`."""
+        with self._lock:
+            return dict(self._records.get(url, {}).get('details', {}))
+
+    def _artifact_path(self, url, suffix):
+        return self.artifacts_dir / (
+            hashlib.sha256(url.encode()).hexdigest() + suffix
+        )
+
+    def _record(self, url, content_hash, path, details=None):
+        record = {'hash': content_hash, 'artifact': path.name}
+        if details:
+            record['details'] = details
+        with self._lock:
+            self._seen.add(url)
+            self._records[url] = record
+
+    def save(self, prune=True):
+        """Persist the records; with `prune`, drop pages not seen this run."""
+        with self._lock:
+            stale = set(self._records) - self._seen if prune else ()
+            for url in stale:
+                record = self._records.pop(url)
+                try:
+                    os.remove(self.artifacts_dir / record['artifact'])
+                except OSError:
+                    pass
+            data = json.dumps(self._records, sort_keys=True).encode('utf-8')
+        write_atomic(self.path, data)
+
+
+class FileLock:
+    """Exclusive lock on a file, held across threads and processes.
+
+    Every `acquire` opens the lock file anew, so threads of one process
+    exclude each other just like separate processes do.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; return False if `blocking` is false and it is held."""
+        f = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(
+                    f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+                )
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(
+                            f.fileno(),
+                            msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK,
+                            1,
+                        )
+                        break
+                    except OSError:
+                        # LK_LOCK 只重试 10 秒，阻塞模式下继续等待
+                        if not blocking:
+                            raise
+        except OSError:
+            f.close()
+            if not blocking:
+                return False
             raise
+        self._file = f
+        return True
+
+    def release(self):
+        f = self._file
+        self._file = None
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            f.close()
 
     def __enter__(self):
+        self.acquire()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
+        self.release()
         return False
 
-    def close(self):
-        """Release browser and temporary workspace resources."""
+
+DEFAULT_STORE_GRACE_PERIOD = 24 * 3600
+DEFAULT_STORE_GC_INTERVAL = 3600
+STORE_LOCK_STRIPES = 256
+STORE_LOCK_POLL_INTERVAL = 0.05
+
+
+class ContentStore:
+    """Content-addressed blob store shared by exports and processes.
+
+    Blobs are stored once under ``objects/`` as their SHA-256 hash plus a
+    file suffix. ``keys/<namespace>/`` maps names such as image URLs to a
+    blob and the blobs it depends on, and every export records the blobs it
+    used in ``refs/<ref>.json``. `collect_garbage` deletes blobs that no ref
+    manifest references; blobs used within `grace_period` seconds are kept
+    so that exports still running in other processes do not lose them.
+    Collection walks the whole store, so it runs at most once per
+    `gc_interval` seconds across all processes. All files are replaced
+    atomically, so readers need no locks.
+    """
+
+    GC_STAMP = 'gc.stamp'
+
+    def __init__(self, directory, grace_period=DEFAULT_STORE_GRACE_PERIOD,
+                 gc_interval=DEFAULT_STORE_GC_INTERVAL):
+        self.directory = Path(directory).expanduser()
+        self.objects_dir = self.directory / 'objects'
+        self.keys_dir = self.directory / 'keys'
+        self.refs_dir = self.directory / 'refs'
+        self.locks_dir = self.directory / 'locks'
+        self.tmp_dir = self.directory / 'tmp'
+        for directory in (
+            self.objects_dir, self.keys_dir, self.refs_dir,
+            self.locks_dir, self.tmp_dir,
+        ):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.grace_period = grace_period
+        self.gc_interval = gc_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._used = set()
+
+    def path(self, blob):
+        return self.objects_dir / blob[:2] / blob
+
+    def _use(self, *blobs):
+        with self._lock:
+            self._used.update(blobs)
+
+    def add_stream(self, chunks, suffix=''):
+        """Store the bytes of `chunks`; return the blob name."""
+        digest = hashlib.sha256()
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.tmp_dir)
         try:
-            if self.driver is not None:
-                driver = self.driver
-                self.driver = None
-                driver.quit()
-        finally:
-            if self._temporary_directory is not None:
-                temporary_directory = self._temporary_directory
-                self._temporary_directory = None
-                temporary_directory.cleanup()
-    
-    def print_to_pdf(self, url, index):
-        """使用 Chrome 打印方式生成 PDF"""
+            with os.fdopen(descriptor, 'wb') as f:
+                for chunk in chunks:
+                    if chunk:
+                        digest.update(chunk)
+                        f.write(chunk)
+            blob = digest.hexdigest() + suffix
+            path = self.path(blob)
+            path.parent.mkdir(exist_ok=True)
+            if path.exists():
+                os.remove(temporary_path)
+                os.utime(path)
+            else:
+                os.replace(temporary_path, path)
+        except BaseException:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise
+        self._use(blob)
+        return blob
+
+    def add(self, data, suffix=''):
+        return self.add_stream([data], suffix)
+
+    def add_file(self, source, suffix=None):
+        """Store a copy of the file at `source`; return the blob name."""
+        if suffix is None:
+            suffix = Path(source).suffix
+        with open(source, 'rb') as f:
+            return self.add_stream(iter(lambda: f.read(1024 * 1024), b''), suffix)
+
+    def _key_path(self, namespace, key):
+        return (
+            self.keys_dir / namespace /
+            (hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+        )
+
+    def get(self, namespace, key):
+        """Return the record stored for `key`, or None.
+
+        The record is only returned while its blob and dependencies exist;
+        they are marked as used by this export.
+        """
         try:
-            self.driver.get(url)
-            time.sleep(2)
-            
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
-            
-            pdf_data = self.driver.execute_cdp_cmd("Page.printToPDF", {
-                "printBackground": True,
-                "paperWidth": 8.27,
-                "paperHeight": 11.69,
-                "marginTop": 0.4,
-                "marginBottom": 0.4,
-                "marginLeft": 0.4,
-                "marginRight": 0.4,
-                "scale": 1,
-            })
-            
-            filename = f"page_{index:03d}.pdf"
-            filepath = os.path.join(self.temp_dir, filename)
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(pdf_data['data']))
-            
-            print(f"已保存 {filename}")
-            return filepath
-        except Exception as e:
-            print(f"处理 {url} 时出错: {str(e)}")
+            with open(self._key_path(namespace, key), encoding='utf-8') as f:
+                record = json.load(f)
+            blobs = [record['blob'], *record['deps']]
+            for blob in blobs:
+                os.utime(self.path(blob))
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
             return None
+        self._use(*blobs)
+        with self._lock:
+            self.hits += 1
+        return record
 
-    def merge_pdfs(self, pdf_files, output_file):
-        """合并多个 PDF 文件"""
-        merger = PdfMerger()
-        
-        for pdf in pdf_files:
-            if pdf and os.path.exists(pdf):
-                try:
-                    merger.append(pdf)
-                except Exception as e:
-                    print(f"合并 {pdf} 时出错: {str(e)}")
-        
-        merger.write(output_file)
-        merger.close()
+    def set(self, namespace, key, blob, deps=(), headers=None):
+        """Map `key` to `blob`, which needs the blobs in `deps`.
+
+        `headers` keeps the HTTP validators of the blob's source, so that it
+        can be revalidated later.
+        """
+        record = {'blob': blob, 'deps': sorted(set(deps))}
+        if headers:
+            record['headers'] = headers
+        path = self._key_path(namespace, key)
+        path.parent.mkdir(exist_ok=True)
+        write_atomic(path, json.dumps(record).encode('utf-8'))
+        self._use(blob, *record['deps'])
+        return record
+
+    def lock(self, namespace, key):
+        """Return a lock for producing the blob of `key` only once.
+
+        Keys share a fixed number of lock files, so the lock directory does
+        not grow with the store.
+        """
+        digest = hashlib.sha256(f"{namespace}:{key}".encode('utf-8')).digest()
+        stripe = digest[0] % STORE_LOCK_STRIPES
+        return FileLock(self.locks_dir / f"{stripe:02x}.lock")
 
-        # 清理临时文件
-        for pdf in pdf_files:
+    def save_ref(self, name):
+        """Record the blobs used so far as the references of `name`."""
+        with self._lock:
+            data = json.dumps(sorted(self._used)).encode('utf-8')
+        write_atomic(self.refs_dir / f"{name}.json", data)
+
+    def reference_counts(self):
+        """Return the number of ref manifests referencing each blob."""
+        counts = {}
+        for path in self.refs_dir.glob('*.json'):
             try:
-                os.remove(pdf)
-            except:
-                pass
+                with open(path, encoding='utf-8') as f:
+                    blobs = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable store ref {path}: {str(e)}")
+                continue
+            for blob in blobs:
+                counts[blob] = counts.get(blob, 0) + 1
+        return counts
+
+    def collect_garbage(self, blocking=False, force=False):
+        """Delete unreferenced blobs and the keys that point at them.
+
+        Returns the number of deleted blobs, or None when the store was
+        collected less than `gc_interval` seconds ago (unless `force`) or
+        another process is already collecting and `blocking` is false.
+        """
+        stamp = self.directory / self.GC_STAMP
+        if not force and self._collected_recently(stamp):
+            return None
+        lock = FileLock(self.directory / 'gc.lock')
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            if not force and self._collected_recently(stamp):
+                return None
+            stamp.touch()
+            counts = self.reference_counts()
+            cutoff = time.time() - self.grace_period
+            removed = 0
+            for directory in (self.objects_dir, self.tmp_dir):
+                for path in directory.rglob('*'):
+                    try:
+                        if (path.is_file() and not counts.get(path.name) and
+                                path.stat().st_mtime < cutoff):
+                            os.remove(path)
+                            removed += directory is self.objects_dir
+                    except OSError:
+                        pass
+            for path in self.keys_dir.rglob('*.json'):
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        record = json.load(f)
+                    blobs = [record['blob'], *record['deps']]
+                    if all(self.path(blob).exists() for blob in blobs):
+                        continue
+                except (OSError, ValueError, KeyError):
+                    pass
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return removed
+        finally:
+            lock.release()
+
+    def _collected_recently(self, stamp):
+        try:
+            return time.time() - stamp.stat().st_mtime < self.gc_interval
+        except FileNotFoundError:
+            return False
+
+
+def image_extension(url, response):
+    """Return the file extension of an image, from its URL or content type."""
+    extension = os.path.splitext(urlparse(url).path)[1]
+    if not extension:
+        content_type = response.headers.get('content-type', '')
+        extension = mimetypes.guess_extension(
+            content_type.split(';')[0].strip()
+        ) or '.jpg'
+    return extension
+
+
+def new_process_pool(max_workers=None):
+    """Return a process pool whose workers are not forked from this process.
+
+    The pools are started from crawl and download threads; forking a process
+    while other threads hold locks can deadlock the child, so workers come
+    from a fork server where available and are spawned otherwise.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn'
+    )
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+# A4 宽度减去 HTML 方法的左右页边距（各 2.5cm）
+A4_CONTENT_WIDTH_INCHES = (210 - 2 * 25) / 25.4
+DEFAULT_IMAGE_QUALITY = 85
+
+
+def optimize_image(source, output_dir, max_width=None, quality=DEFAULT_IMAGE_QUALITY):
+    """Downscale and recompress one image; return the path to use.
+
+    Opaque images are re-encoded as JPEG at `quality` and images with
+    transparency as optimized PNG, without any metadata. Results are named
+    after the source content hash and the settings, so an image is only
+    processed once. Images Pillow cannot open, animations and re-encodings
+    that would not save space are returned unchanged.
+    """
+    with open(source, 'rb') as f:
+        data = f.read()
+    key = hashlib.sha256(data + f":{max_width}:{quality}".encode()).hexdigest()
+    output_dir = Path(output_dir)
+    for extension in ('.jpg', '.png'):
+        candidate = output_dir / f"{key}{extension}"
+        if candidate.exists():
+            return str(candidate)
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if getattr(image, 'is_animated', False):
+                return source
+            image.load()
+            # 重新编码会丢弃 EXIF，先按 Orientation 标签旋转像素
+            rotated = image.getexif().get(0x0112, 1) != 1
+            if rotated:
+                image = ImageOps.exif_transpose(image)
+            resized = bool(max_width and image.width > max_width)
+            if resized:
+                height = max(1, round(image.height * max_width / image.width))
+                image = image.resize((max_width, height), Image.LANCZOS)
+            has_alpha = image.mode in ('RGBA', 'LA') or (
+                image.mode == 'P' and 'transparency' in image.info
+            )
+            buffer = io.BytesIO()
+            if has_alpha:
+                extension = '.png'
+                image.convert('RGBA').save(buffer, format='PNG', optimize=True)
+            else:
+                extension = '.jpg'
+                image.convert('RGB').save(
+                    buffer,
+                    format='JPEG',
+                    quality=quality,
+                    optimize=True,
+                    progressive=True,
+                )
+    except Exception as e:
+        logging.warning(f"Could not optimize image {source}: {str(e)}")
+        return source
+
+    if not resized and not rotated and buffer.tell() >= len(data):
+        return source
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output = output_dir / f"{key}{extension}"
+    write_atomic(output, buffer.getvalue())
+    return str(output)
+
+
+class StreamingPdfMerger:
+    """Concatenate PDF files into one, writing objects as they are read.
+
+    Each input is opened on its own, its pages and every object they
+    reference are renumbered and written to the output straight away, and
+    the input is released before the next one is read. Peak memory is
+    bounded by the largest input rather than the whole document. Only the
+    page tree, the outline and the cross-reference offsets are kept until
+    `close()`.
+    """
+
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, output_file):
+        self._stream = open(output_file, 'wb')
+        self._stream.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self._offsets = {}
+        self._next_id = self.PAGES_ID + 1
+        self._page_ids = []
+        self._outline = []
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+    def _allocate(self):
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write_object(self, object_id, obj):
+        start = self._stream.tell()
+        try:
+            self._stream.write(f"{object_id} 0 obj\n".encode('ascii'))
+            (NullObject() if obj is None else obj).write_to_stream(
+                self._stream, None
+            )
+            self._stream.write(b"\nendobj\n")
+        except BaseException:
+            self._stream.seek(start)
+            self._stream.truncate()
+            raise
+        self._offsets[object_id] = start
+
+    def append(self, pdf_file, title=None):
+        """Append every page of `pdf_file`, with an outline entry if titled."""
+        reader = PdfReader(pdf_file)
+        ids = {}
+        pending = deque()
+        copied = set()
+
+        def reference(ref):
+            key = (ref.idnum, ref.generation)
+            if key not in ids:
+                ids[key] = self._allocate()
+                pending.append((key, ref))
+            return IndirectObject(ids[key], 0, None)
+
+        def renumber(obj):
+            if isinstance(obj, IndirectObject):
+                return reference(obj)
+            if isinstance(obj, (DictionaryObject, ArrayObject)):
+                # 继承的页面属性可能在多个页面间共享，只处理一次
+                if id(obj) in copied:
+                    return obj
+                copied.add(id(obj))
+                if isinstance(obj, DictionaryObject):
+                    for key, value in list(dict.items(obj)):
+                        dict.__setitem__(obj, key, renumber(value))
+                else:
+                    for position, value in enumerate(list(obj)):
+                        obj[position] = renumber(value)
+            return obj
+
+        pages = {}
+        page_ids = []
+        for page in reader.pages:
+            ref = page.indirect_reference
+            page_ids.append(reference(ref).idnum)
+            pages[(ref.idnum, ref.generation)] = page
+
+        while pending:
+            key, ref = pending.popleft()
+            if key in pages:
+                obj = pages.pop(key)
+                dict.pop(obj, NameObject('/Parent'), None)
+                renumber(obj)
+                obj[NameObject('/Parent')] = IndirectObject(
+                    self.PAGES_ID, 0, None
+                )
+            else:
+                obj = renumber(reader.get_object(ref))
+            self._write_object(ids[key], obj)
+
+        if title and page_ids:
+            self._outline.append((title, page_ids[0]))
+        self._page_ids.extend(page_ids)
+
+    def _write_outline(self):
+        if not self._outline:
+            return None
+        outline_id = self._allocate()
+        item_ids = [self._allocate() for _ in self._outline]
+        for position, (title, page_id) in enumerate(self._outline):
+            item = DictionaryObject({
+                NameObject('/Title'): TextStringObject(title),
+                NameObject('/Parent'): IndirectObject(outline_id, 0, None),
+                NameObject('/Dest'): ArrayObject([
+                    IndirectObject(page_id, 0, None), NameObject('/Fit')
+                ]),
+            })
+            if position > 0:
+                item[NameObject('/Prev')] = IndirectObject(
+                    item_ids[position - 1], 0, None
+                )
+            if position + 1 < len(item_ids):
+                item[NameObject('/Next')] = IndirectObject(
+                    item_ids[position + 1], 0, None
+                )
+            self._write_object(item_ids[position], item)
+        self._write_object(outline_id, DictionaryObject({
+            NameObject('/Type'): NameObject('/Outlines'),
+            NameObject('/First'): IndirectObject(item_ids[0], 0, None),
+            NameObject('/Last'): IndirectObject(item_ids[-1], 0, None),
+            NameObject('/Count'): NumberObject(len(item_ids)),
+        }))
+        return outline_id
+
+    def close(self):
+        """Write the page tree, outline, catalog and cross-reference table."""
+        if self._stream is None:
+            return
+        try:
+            self._write_object(self.PAGES_ID, DictionaryObject({
+                NameObject('/Type'): NameObject('/Pages'),
+                NameObject('/Kids'): ArrayObject(
+                    IndirectObject(page_id, 0, None)
+                    for page_id in self._page_ids
+                ),
+                NameObject('/Count'): NumberObject(len(self._page_ids)),
+            }))
+            catalog = DictionaryObject({
+                NameObject('/Type'): NameObject('/Catalog'),
+                NameObject('/Pages'): IndirectObject(self.PAGES_ID, 0, None),
+            })
+            outline_id = self._write_outline()
+            if outline_id is not None:
+                catalog[NameObject('/Outlines')] = IndirectObject(
+                    outline_id, 0, None
+                )
+                catalog[NameObject('/PageMode')] = NameObject('/UseOutlines')
+            self._write_object(self.CATALOG_ID, catalog)
+
+            # 读取失败的输入可能留下已分配但未写出的对象编号
+            for object_id in range(1, self._next_id):
+                if object_id not in self._offsets:
+                    self._write_object(object_id, None)
+
+            xref_offset = self._stream.tell()
+            self._stream.write(f"xref\n0 {self._next_id}\n".encode('ascii'))
+            self._stream.write(b"0000000000 65535 f \n")
+            for object_id in range(1, self._next_id):
+                self._stream.write(
+                    f"{self._offsets[object_id]:010d} 00000 n \n".encode('ascii')
+                )
+            self._stream.write(
+                f"trailer\n<< /Size {self._next_id} /Root {self.CATALOG_ID} 0 R >>\n"
+                f"startxref\n{xref_offset}\n%%EOF\n".encode('ascii')
+            )
+        finally:
+            stream = self._stream
+            self._stream = None
+            stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def merge_pdf_files(pdf_files, output_file, titles=None, check=None):
+    """Merge `pdf_files` into `output_file`, bookmarking each titled file.
+
+    Missing and unreadable files are skipped. `check` is called before each
+    file, so that a cancelled export stops merging.
+    """
+    titles = titles or [None] * len(pdf_files)
+    with StreamingPdfMerger(output_file) as merger:
+        for pdf, title in zip(pdf_files, titles):
+            if check is not None:
+                check()
+            if pdf and os.path.exists(pdf):
+                try:
+                    merger.append(pdf, title)
+                except Exception as e:
+                    print(f"合并 {pdf} 时出错: {str(e)}")
+
+
+def count_pdf_pages(pdf_files):
+    """Return the total number of pages of `pdf_files`."""
+    return sum(len(PdfReader(pdf).pages) for pdf in pdf_files)
+
+
+def stamp_page_numbers(chunk_pdfs, numbers_pdf, output_file):
+    """Merge `chunk_pdfs` into `output_file` with continuous page numbers.
+
+    The transparent pages of `numbers_pdf` carry only the page numbers and
+    are stamped over the pages of the chunks. When their count does not
+    match, the chunks are merged without numbers.
+    """
+    total_pages = count_pdf_pages(chunk_pdfs)
+    numbers = PdfReader(numbers_pdf)
+    if len(numbers.pages) != total_pages:
+        logging.warning(
+            "Page number overlay does not match the chunk page count; "
+            "pages will not be numbered"
+        )
+        numbers = None
+
+    page_number = 0
+    with StreamingPdfMerger(output_file) as merger:
+        for pdf in chunk_pdfs:
+            if numbers is not None:
+                writer = PdfWriter()
+                for page in PdfReader(pdf).pages:
+                    page.merge_page(numbers.pages[page_number])
+                    writer.add_page(page)
+                    page_number += 1
+                pdf = pdf[:-len(".pdf")] + "_numbered.pdf"
+                with open(pdf, 'wb') as f:
+                    writer.write(f)
+            merger.append(pdf)
+
+
+def remove_files(paths):
+    """Delete temporary files, ignoring those that are already gone."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+QUERY_POLICIES = ('keep', 'strip-tracking', 'drop')
+TRACKING_PARAMETERS = ('fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref', 'source')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonical_netloc(parsed):
+    """Return the lower-cased host of a parsed URL without its default port."""
+    host = (parsed.hostname or '').lower()
+    if parsed.port and parsed.port != DEFAULT_PORTS.get(parsed.scheme.lower()):
+        host = f"{host}:{parsed.port}"
+    return host
+
+
+def canonicalize_url(url, query_policy='strip-tracking', trailing_slash=False):
+    """Return the canonical form used to decide whether two URLs are one page.
+
+    The fragment is dropped, scheme and host are lower-cased, default ports
+    are removed and an empty path becomes ``/``. Unless `trailing_slash` is
+    set, a trailing slash is removed from any other path. `query_policy`
+    keeps the query, strips tracking parameters (``utm_*`` and friends)
+    and sorts the rest, or drops the query entirely.
+    """
+    if query_policy not in QUERY_POLICIES:
+        raise ValueError(f"unknown query policy: {query_policy}")
+    parsed = urlparse(url.strip())
+    path = parsed.path or '/'
+    if not trailing_slash and path != '/' and path.endswith('/'):
+        path = path.rstrip('/') or '/'
+
+    query = parsed.query
+    if query_policy == 'drop':
+        query = ''
+    elif query_policy == 'strip-tracking':
+        query = urlencode(sorted(
+            (name, value)
+            for name, value in parse_qsl(query, keep_blank_values=True)
+            if not name.lower().startswith('utm_') and
+            name.lower() not in TRACKING_PARAMETERS
+        ))
+
+    return urlunparse((
+        parsed.scheme.lower(),
+        canonical_netloc(parsed),
+        path,
+        parsed.params,
+        query,
+        '',
+    ))
+
+
+class VisitedIndex:
+    """Set of visited pages keyed by a 64-bit hash of the canonical URL.
+
+    Each entry costs one small integer instead of the URL string, and the
+    index can be saved to and loaded from a file of packed hashes.
+    """
+
+    def __init__(self, query_policy='strip-tracking', trailing_slash=False):
+        self.query_policy = query_policy
+        self.trailing_slash = trailing_slash
+        self._hashes = set()
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        canonical = canonicalize_url(
+            url, self.query_policy, self.trailing_slash
+        )
+        digest = hashlib.blake2b(canonical.encode('utf-8'), digest_size=8)
+        return int.from_bytes(digest.digest(), 'big')
+
+    def add(self, url):
+        """Mark `url` as visited; return False if it already was."""
+        key = self._key(url)
+        with self._lock:
+            if key in self._hashes:
+                return False
+            self._hashes.add(key)
+            return True
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+    def __contains__(self, url):
+        return self._key(url) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __eq__(self, other):
+        if not isinstance(other, VisitedIndex):
+            return NotImplemented
+        return self._hashes == other._hashes
+
+    def save(self, path):
+        """Atomically write the index as packed 64-bit hashes."""
+        with self._lock:
+            packed = array.array('Q', sorted(self._hashes))
+        write_atomic(path, packed.tobytes())
+
+    def load(self, path):
+        """Add the hashes stored in `path` by `save()`."""
+        packed = array.array('Q')
+        packed.frombytes(Path(path).read_bytes())
+        with self._lock:
+            self._hashes.update(packed)
+
+
+CHECKPOINT_INTERVAL = 5
+
+
+class ExportCheckpoint:
+    """Progress of an export, saved atomically in its work directory.
+
+    ``checkpoint.json`` holds the crawl frontier or print queue together
+    with the per-page artifact paths, and ``visited.idx`` the visited
+    index. Saves are throttled to one every `interval` seconds unless
+    forced.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory, interval=CHECKPOINT_INTERVAL):
+        directory = Path(directory)
+        self.path = directory / 'checkpoint.json'
+        self.visited_path = directory / 'visited.idx'
+        self.interval = interval
+        self._last_saved = 0
+        self._lock = threading.Lock()
+
+    def load(self, base_url, method, visited):
+        """Return the saved state of this export and restore `visited`.
+
+        Returns None when there is no checkpoint or it belongs to another
+        export.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint: {str(e)}")
+            return None
+        if (state.get('version') != self.VERSION or
+                state.get('base_url') != base_url or
+                state.get('method') != method):
+            logging.warning(f"Checkpoint {self.path} is for another export; starting over")
+            return None
+        if self.visited_path.exists():
+            visited.load(self.visited_path)
+        return state
+
+    def save(self, base_url, method, state, visited, force=False):
+        """Atomically persist `state` and the visited index."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_saved < self.interval:
+                return
+            self._last_saved = now
+            visited.save(self.visited_path)
+            state = dict(state, version=self.VERSION, base_url=base_url, method=method)
+            write_atomic(self.path, json.dumps(state).encode('utf-8'))
+
+    def clear(self):
+        """Forget the saved progress once the export has completed."""
+        with self._lock:
+            for path in (self.path, self.visited_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+# 按优先级排列的正文容器选择器
+DEFAULT_CONTENT_SELECTORS = ('article', 'main', 'div.page-inner')
+
+_SELECTOR_PART = re.compile(
+    r'#(?P<id>[\w-]+)'
+    r'|\.(?P<cls>[\w-]+)'
+    r'|\[(?P<attr>[\w:-]+)(?:=(?P<quote>["\']?)(?P<value>[^"\'\]]*)(?P=quote))?\]'
+)
+
+
+def compile_selector(selector):
+    """Compile a simple CSS selector into a predicate over tags.
+
+    Supported are a single compound selector made of an optional tag name
+    followed by any number of ``#id``, ``.class``, ``[attr]`` and
+    ``[attr="value"]`` parts, e.g. ``div.page-inner`` or
+    ``[data-testid="page.contentEditor"]``. Matching is a few dictionary
+    lookups, so it can be applied to every element during one traversal.
+    """
+    text = selector.strip()
+    name = re.match(r'[A-Za-z][\w-]*', text)
+    position = name.end() if name else 0
+    name = name.group().lower() if name else None
+    element_id = None
+    classes = set()
+    attributes = []
+    while position < len(text):
+        part = _SELECTOR_PART.match(text, position)
+        if part is None:
+            raise ValueError(f"unsupported selector: {selector!r}")
+        if part.group('id'):
+            element_id = part.group('id')
+        elif part.group('cls'):
+            classes.add(part.group('cls'))
+        else:
+            attributes.append((part.group('attr'), part.group('value')))
+        position = part.end()
+    if not (name or element_id or classes or attributes):
+        raise ValueError(f"unsupported selector: {selector!r}")
+
+    def matches(tag):
+        if name is not None and tag.name != name:
+            return False
+        attrs = tag.attrs
+        if element_id is not None and attrs.get('id') != element_id:
+            return False
+        if classes and not classes.issubset(attrs.get('class') or ()):
+            return False
+        for attribute, value in attributes:
+            actual = attrs.get(attribute)
+            if actual is None:
+                return False
+            if isinstance(actual, list):
+                actual = ' '.join(actual)
+            if value is not None and actual != value:
+                return False
+        return True
+
+    return matches
+
+
+class PageExtractor:
+    """Collect what the converter needs from a page in one traversal.
+
+    Stylesheets, links, the title, the content root and the images inside
+    it are gathered while walking the parsed tree once. The content root is
+    the first element matching the earliest of `content_selectors`.
+    """
+
+    def __init__(self, content_selectors=None, parser=None):
+        self.content_selectors = tuple(
+            content_selectors or DEFAULT_CONTENT_SELECTORS
+        )
+        self._matchers = [
+            compile_selector(selector) for selector in self.content_selectors
+        ]
+        self.parser = parser or HTML_PARSER
+
+    def extract(self, html, url):
+        """Return the parsed page as a dict.
+
+        ``content`` is the content root tag (or None) and ``images`` lists
+        ``(img, absolute_url)`` pairs for the images inside it, so callers
+        can rewrite their ``src`` before serializing the content.
+        """
+        soup = BeautifulSoup(html, self.parser)
+        matchers = self._matchers
+        roots = [None] * len(matchers)
+        title = None
+        stylesheets = []
+        links = []
+        images = []
+        for node in soup.descendants:
+            if not isinstance(node, Tag):
+                continue
+            name = node.name
+            if name == 'a':
+                href = node.get('href')
+                if href is not None:
+                    links.append(urljoin(url, href))
+            elif name == 'img':
+                if node.get('src'):
+                    images.append(node)
+            elif name == 'link':
+                href = node.get('href')
+                if href and 'stylesheet' in (node.get('rel') or ()):
+                    stylesheets.append(urljoin(url, href))
+            elif name == 'title':
+                if title is None and node.string:
+                    title = str(node.string)
+            for position, matches in enumerate(matchers):
+                if roots[position] is None and matches(node):
+                    roots[position] = node
+
+        content = next((root for root in roots if root is not None), None)
+        if content is not None:
+            images = [
+                (img, urljoin(url, img['src']))
+                for img in images
+                if img is content or content in img.parents
+            ]
+        else:
+            images = []
+        return {
+            'title': title,
+            'stylesheets': stylesheets,
+            'links': links,
+            'content': content,
+            'images': images,
+        }
+
+
+IMAGE_PLACEHOLDER = 'gitbook-to-pdf-image:{}'
+_extractors = {}
+
+
+def parse_page(text, url, content_selectors=None):
+    """Extract a page into plain, picklable data.
+
+    This is the CPU-bound part of handling a page and runs in worker
+    processes. The ``src`` of every content image is replaced by a
+    numbered placeholder; ``images`` lists ``(absolute_url, original_src)``
+    pairs in placeholder order so that `localize_content` can fill them in
+    once the images have been downloaded.
+    """
+    key = tuple(content_selectors or ())
+    extractor = _extractors.get(key)
+    if extractor is None:
+        extractor = _extractors[key] = PageExtractor(content_selectors)
+    page = extractor.extract(text, url)
+    images = []
+    for index, (img, img_url) in enumerate(page['images']):
+        images.append((img_url, img['src']))
+        img['src'] = IMAGE_PLACEHOLDER.format(index)
+    content = page['content']
+    page['content'] = str(content) if content is not None else None
+    page['images'] = images
+    return page
+
+
+def localize_content(content, sources):
+    """Replace the image placeholders of `parse_page` with `sources`."""
+    for index, source in enumerate(sources):
+        content = content.replace(
+            f'src="{IMAGE_PLACEHOLDER.format(index)}"',
+            f'src="{html.escape(source, quote=True)}"',
+            1,
+        )
+    return content
+
+
+_CSS_STRING = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+_CSS_COMMENTS = re.compile(rf'({_CSS_STRING})|/\*.*?\*/', re.S)
+_CSS_TOKENS = re.compile(
+    rf'{_CSS_STRING}|url\(\s*[^"\'\s)][^)]*\)|[{{}};]'
+)
+_CSS_STRINGS = re.compile(rf'({_CSS_STRING}|url\(\s*[^"\'\s)][^)]*\))')
+# 其内容仍是普通样式规则、可以逐条裁剪的 at 规则
+_CSS_GROUPING_RULES = ('@media', '@supports', '@layer', '@container', '@document')
+_HTML_TAGS = re.compile(r'<([a-zA-Z][\w:-]*)')
+_HTML_CLASSES = re.compile(r'\sclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+_HTML_IDS = re.compile(r'\sid\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+
+
+def parse_css_rules(css):
+    """Split a style sheet into top-level ``(prelude, block)`` pairs.
+
+    Comments are dropped. `block` is the text between the braces, or None
+    for statements such as ``@import`` that end with a semicolon. Strings
+    and unquoted ``url(...)`` values are skipped so that braces and
+    semicolons inside them do not end a rule.
+    """
+    css = _CSS_COMMENTS.sub(lambda m: m.group(1) or '', css)
+    rules = []
+    depth = 0
+    start = block_start = 0
+    prelude = None
+    for token in _CSS_TOKENS.finditer(css):
+        char = token.group()
+        if char == '{':
+            if depth == 0:
+                prelude = css[start:token.start()].strip()
+                block_start = token.end()
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                rules.append((prelude, css[block_start:token.start()]))
+                start = token.end()
+        elif char == ';' and depth == 0:
+            statement = css[start:token.start()].strip()
+            if statement:
+                rules.append((statement, None))
+            start = token.end()
+    return rules
+
+
+def minify_css(text, selector=False):
+    """Collapse whitespace outside strings and drop it around punctuation.
+
+    Spaces around ``:`` are significant in selectors (descendant
+    combinator), so they are only removed from declarations.
+    """
+    punctuation = r'\s*([{},;>])\s*' if selector else r'\s*([{}:;,])\s*'
+    parts = _CSS_STRINGS.split(text)
+    for index in range(0, len(parts), 2):
+        part = re.sub(r'\s+', ' ', parts[index])
+        part = re.sub(punctuation, r'\1', part)
+        parts[index] = re.sub(r';+(?=})', '', part)
+    return ''.join(parts).strip().rstrip(';')
+
+
+class CSSUsage:
+    """Index of the tag names, classes and ids used by a set of documents.
+
+    Used to drop style rules that cannot match anything in the book. The
+    check is conservative: a selector is kept unless it names a tag, class
+    or id that never appears.
+    """
+
+    def __init__(self):
+        self.tags = {'html', 'head', 'body'}
+        self.classes = set()
+        self.ids = set()
+
+    def add_html(self, text):
+        self.tags.update(tag.lower() for tag in _HTML_TAGS.findall(text))
+        for match in _HTML_CLASSES.finditer(text):
+            self.classes.update(''.join(match.groups('')).split())
+        for match in _HTML_IDS.finditer(text):
+            self.ids.add(''.join(match.groups('')))
+
+    def may_match(self, selector):
+        # 属性选择器、字符串和函数参数（如 :not(...)）里的内容不参与判断
+        selector = re.sub(rf'{_CSS_STRING}|\[[^\]]*\]', '', selector)
+        while True:
+            reduced = re.sub(r'\([^()]*\)', '', selector)
+            if reduced == selector:
+                break
+            selector = reduced
+        for prefix, names in (('.', self.classes), ('#', self.ids)):
+            for name in re.findall(rf'\{prefix}((?:[\w-]|\\.)+)', selector):
+                if re.search(r'\\[0-9a-fA-F]', name):
+                    continue
+                if re.sub(r'\\(.)', r'\1', name) not in names:
+                    return False
+        selector = re.sub(r'[.#:]+(?:[\w-]|\\.)+', '', selector)
+        for tag in re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)', selector):
+            if tag.lower() not in self.tags:
+                return False
+        return True
+
+
+def _split_selectors(prelude):
+    selectors = []
+    depth = 0
+    start = 0
+    for match in re.finditer(rf'{_CSS_STRING}|[()\[\],]', prelude):
+        char = match.group()
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:match.start()])
+            start = match.end()
+    selectors.append(prelude[start:])
+    return [selector.strip() for selector in selectors if selector.strip()]
+
+
+def optimize_css(css, usage=None):
+    """Return `css` minified, without rules that `usage` says cannot match."""
+    output = []
+    for prelude, block in parse_css_rules(css):
+        if block is None:
+            output.append(minify_css(prelude) + ';')
+        elif prelude.startswith('@'):
+            if prelude.lower().startswith(_CSS_GROUPING_RULES):
+                block = optimize_css(block, usage)
+                if not block:
+                    continue
+            else:
+                block = minify_css(block)
+            output.append(f"{minify_css(prelude, selector=True)}{{{block}}}")
+        else:
+            selectors = _split_selectors(prelude)
+            if usage is not None:
+                selectors = [s for s in selectors if usage.may_match(s)]
+            if selectors:
+                output.append(
+                    minify_css(','.join(selectors), selector=True) +
+                    f"{{{minify_css(block)}}}"
+                )
+    return ''.join(output)
+
+
+def run_steps(steps, perform):
+    """Run a step generator, carrying out its requests with `perform`.
+
+    Every value `steps` yields (a URL to fetch, a CDP command, ...) is passed
+    to `perform` and the result is sent back; an exception raised by
+    `perform` is raised inside the generator instead. Returns the value the
+    generator returns. Steps written this way are shared by the threaded
+    converter and `AsyncGitbookToPDF`, which runs them with
+    `run_steps_async`.
+    """
+    result = error = None
+    while True:
+        try:
+            if error is not None:
+                request = steps.throw(error)
+            else:
+                request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            error = None
+        try:
+            result = perform(request)
+        except BaseException as e:
+            result, error = None, e
+
+
+async def run_steps_async(steps, perform):
+    """Like `run_steps`, for a coroutine function `perform`."""
+    result = error = None
+    while True:
+        try:
+            if error is not None:
+                request = steps.throw(error)
+            else:
+                request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            error = None
+        try:
+            result = await perform(request)
+        except BaseException as e:
+            result, error = None, e
+
+
+# 按优先级排列的 GitBook 侧边栏/目录选择器（旧版 GitBook 使用 ul.summary）
+NAVIGATION_SELECTORS = (
+    'ul.summary',
+    '[data-testid="table-of-contents"]',
+    'aside nav',
+    'aside',
+    'nav',
+)
+MAX_SITEMAPS = 50
+
+
+GITBOOK_CONTENT_SELECTOR = (
+    'article, main, div.page-inner, [data-testid="page.contentEditor"]'
+)
+
+READINESS_SCRIPT = """(() => {
+    const selector = %s;
+    if (window.__gitbookToPdfResources === undefined) {
+        // 默认缓冲区只保留 250 条资源记录，写满后计数便不再变化，
+        // 因此改用 PerformanceObserver 计数
+        performance.setResourceTimingBufferSize(100000);
+        window.__gitbookToPdfResources =
+            performance.getEntriesByType('resource').length;
+        new PerformanceObserver(list => {
+            window.__gitbookToPdfResources += list.getEntries().length;
+        }).observe({type: 'resource'});
+    }
+    return {
+        readyState: document.readyState,
+        fonts: !document.fonts || document.fonts.status === 'loaded',
+        images: Array.from(document.images).every(image => image.complete),
+        resources: window.__gitbookToPdfResources,
+        content: !selector || document.querySelector(selector) !== null,
+    };
+})()"""
+
+
+def wait_for_page_ready(
+    driver,
+    timeout=10,
+    content_selector=GITBOOK_CONTENT_SELECTOR,
+    idle_time=0.5,
+    poll_interval=0.05,
+):
+    """Wait until the page in `driver` has settled; return seconds waited.
+
+    The page state is polled over CDP. A page is ready once the document
+    has loaded, its fonts and images have finished loading, and no network
+    resource has finished for `idle_time` seconds. Resources are counted
+    from Resource Timing entries, which only appear once a request
+    completes, so a long request still in flight is not seen. Pages without
+    the content selector are accepted after a longer idle period. When
+    `timeout` expires the page is used as it is.
+    """
+    check = _ReadinessCheck(content_selector, timeout, idle_time)
+    while True:
+        waited = check.update(driver.execute_cdp_cmd(*check.command))
+        if waited is not None:
+            return waited
+        time.sleep(poll_interval)
+
+
+async def wait_for_page_ready_async(
+    page,
+    timeout=10,
+    content_selector=GITBOOK_CONTENT_SELECTOR,
+    idle_time=0.5,
+    poll_interval=0.05,
+):
+    """Like `wait_for_page_ready`, for a `CDPPage`."""
+    check = _ReadinessCheck(content_selector, timeout, idle_time)
+    while True:
+        waited = check.update(await page.execute_cdp_cmd(*check.command))
+        if waited is not None:
+            return waited
+        await asyncio.sleep(poll_interval)
+
+
+class _ReadinessCheck:
+    """The readiness decision of `wait_for_page_ready`, fed one poll at a time."""
+
+    def __init__(self, content_selector, timeout, idle_time):
+        self.command = ('Runtime.evaluate', {
+            'expression': READINESS_SCRIPT % json.dumps(content_selector),
+            'returnByValue': True,
+        })
+        self.timeout = timeout
+        self.idle_time = idle_time
+        self.started = time.monotonic()
+        self._idle_since = self.started
+        self._resources = None
+
+    def update(self, result):
+        """Record a poll result; return the seconds waited once done, else None."""
+        now = time.monotonic()
+        state = result.get('result', {}).get('value') or {}
+        if state.get('resources') != self._resources:
+            self._resources = state.get('resources')
+            self._idle_since = now
+        idle = now - self._idle_since
+        loaded = (
+            state.get('readyState') == 'complete' and
+            state.get('fonts') and
+            state.get('images')
+        )
+        if loaded and (
+            (state.get('content') and idle >= self.idle_time) or
+            idle >= self.idle_time * 4
+        ):
+            return now - self.started
+        if now - self.started >= self.timeout:
+            logging.warning(
+                f"Page was not ready after {self.timeout}s; continuing anyway"
+            )
+            return now - self.started
+        return None
+
+
+PDF_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def print_to_file(driver, path, options, chunk_size=PDF_STREAM_CHUNK_SIZE):
+    """Print the loaded page with ``Page.printToPDF`` straight into `path`.
+
+    The PDF is requested as a stream and copied with ``IO.read`` in chunks
+    of about `chunk_size` bytes, so memory use does not grow with the size
+    of the page. Returns the number of bytes written.
+    """
+    return run_steps(
+        _print_steps(path, options, chunk_size),
+        lambda command: driver.execute_cdp_cmd(*command),
+    )
+
+
+async def print_to_file_async(page, path, options,
+                              chunk_size=PDF_STREAM_CHUNK_SIZE):
+    """Like `print_to_file`, for a `CDPPage`."""
+    return await run_steps_async(
+        _print_steps(path, options, chunk_size),
+        lambda command: page.execute_cdp_cmd(*command),
+    )
+
+
+def _print_steps(path, options, chunk_size):
+    """Step generator behind `print_to_file`: yields CDP commands."""
+    result = yield (
+        "Page.printToPDF", dict(options, transferMode="ReturnAsStream")
+    )
+    partial_path = f"{path}.partial"
+    size = 0
+    try:
+        with open(partial_path, 'wb') as f:
+            handle = result.get('stream')
+            if handle is None:
+                # 不支持流式传输的 Chrome 仍一次性返回 base64 数据
+                data = base64.b64decode(result['data'])
+                f.write(data)
+                size = len(data)
+            else:
+                try:
+                    while True:
+                        chunk = yield (
+                            "IO.read", {"handle": handle, "size": chunk_size}
+                        )
+                        data = chunk.get('data', '')
+                        if chunk.get('base64Encoded'):
+                            data = base64.b64decode(data)
+                        else:
+                            data = data.encode('utf-8')
+                        f.write(data)
+                        size += len(data)
+                        if chunk.get('eof'):
+                            break
+                finally:
+                    yield ("IO.close", {"handle": handle})
+        os.replace(partial_path, path)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+
+# 逐页打印模式使用的页面设置
+PAGE_PRINT_OPTIONS = {
+    "printBackground": True,
+    "paperWidth": 8.27,
+    "paperHeight": 11.69,
+    "marginTop": 0.4,
+    "marginBottom": 0.4,
+    "marginLeft": 0.4,
+    "marginRight": 0.4,
+    "scale": 1,
+}
+# 单文档打印模式使用的页面设置，与 HTML 方法的 A4 页边距一致
+DOCUMENT_PRINT_OPTIONS = {
+    "printBackground": True,
+    "paperWidth": 8.27,
+    "paperHeight": 11.69,
+    "marginTop": 0.79,
+    "marginBottom": 0.79,
+    "marginLeft": 0.98,
+    "marginRight": 0.98,
+    "displayHeaderFooter": True,
+}
+CHROME_HEADER_TEMPLATE = (
+    '<div style="width:100%;padding:0 2.5cm;font-size:9px;color:#666;'
+    'text-align:right"><span class="title"></span></div>'
+)
+
+
+def chrome_footer_template(date='', page_numbers=True):
+    """Return a Chrome footer with the page number and `date`."""
+    number = '<span class="pageNumber"></span>' if page_numbers else ''
+    return (
+        '<div style="width:100%;padding:0 2.5cm;font-size:10px;display:flex">'
+        '<span style="flex:1"></span>'
+        f'<span style="flex:1;text-align:center">{number}</span>'
+        '<span style="flex:1;text-align:right;font-size:9px;color:#666">'
+        f'{html.escape(date)}</span></div>'
+    )
+
+
+def document_print_options(date='', page_numbers=True):
+    """Return the ``Page.printToPDF`` options of the single-document mode."""
+    return dict(
+        DOCUMENT_PRINT_OPTIONS,
+        headerTemplate=CHROME_HEADER_TEMPLATE,
+        footerTemplate=chrome_footer_template(date, page_numbers),
+    )
+
+
+def page_number_print_options():
+    """Return print options for transparent pages carrying only a number."""
+    return dict(
+        DOCUMENT_PRINT_OPTIONS,
+        printBackground=False,
+        headerTemplate='<span></span>',
+        footerTemplate=chrome_footer_template(),
+    )
+
+
+CHROME_ARGUMENTS = (
+    '--headless',
+    '--disable-gpu',
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--window-size=1920,1080',
+)
+
+
+def setup_chrome_driver(allow_install=True, driver_path=None, incognito=False):
+    """设置 Chrome 驱动
+
+    With `allow_install` false the driver is started from `driver_path` or
+    the ``chromedriver`` on PATH and nothing is downloaded at runtime.
+    """
+    if driver_path or not allow_install:
+        driver_path = driver_path or shutil.which('chromedriver')
+        if not driver_path:
+            raise RuntimeError(
+                "chromedriver was not found. Install it on PATH or pass its path."
+            )
+    try:
+        chrome_options = Options()
+        for argument in CHROME_ARGUMENTS:
+            chrome_options.add_argument(argument)
+        if incognito:
+            chrome_options.add_argument('--incognito')
+        
+        # 添加 PDF 打印首选项
+        chrome_options.add_experimental_option('prefs', {
+            'printing.print_preview_sticky_settings.appState': json.dumps({
+                'recentDestinations': [{
+                    'id': 'Save as PDF',
+                    'origin': 'local',
+                    'account': ''
+                }],
+                'selectedDestinationId': 'Save as PDF',
+                'version': 2,
+                'isHeaderFooterEnabled': False,
+                'isLandscapeEnabled': False,
+            })
+        })
+
+        if driver_path:
+            return webdriver.Chrome(
+                service=Service(executable_path=driver_path),
+                options=chrome_options,
+            )
+        try:
+            driver = webdriver.Chrome(options=chrome_options)
+        except WebDriverException:
+            print("正在安装 ChromeDriver...")
+            service = Service(ChromeDriverManager().install())
+            driver = webdriver.Chrome(service=service, options=chrome_options)
+        
+        return driver
+    except Exception as error:
+        raise RuntimeError(
+            "Could not start Chrome. Ensure Google Chrome is installed."
+        ) from error
+
+
+CHROME_EXECUTABLES = (
+    'google-chrome',
+    'google-chrome-stable',
+    'chromium',
+    'chromium-browser',
+    'chrome',
+)
+
+
+def find_chrome():
+    """Return the path of the Chrome (or Chromium) executable on PATH."""
+    for name in CHROME_EXECUTABLES:
+        path = shutil.which(name)
+        if path:
+            return path
+    raise RuntimeError(
+        "Chrome was not found. Install it on PATH or pass its path."
+    )
+
+
+class CDPError(Exception):
+    """Chrome rejected a DevTools command or closed the connection."""
+
+
+class AsyncChrome:
+    """Headless Chrome driven over the DevTools protocol from asyncio.
+
+    Commands to the browser and all of its tabs share one websocket and are
+    matched to their replies by id, so a single event loop can drive any
+    number of pages without a thread or chromedriver per browser. `launch`
+    starts Chrome with a temporary profile and `connect` attaches to one
+    that is already running. Requires the optional aiohttp package.
+    """
+
+    def __init__(self, session, websocket):
+        self._session = session
+        self._websocket = websocket
+        self._process = None
+        self._profile = None
+        self._next_id = 0
+        self._replies = {}
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    @classmethod
+    async def connect(cls, url):
+        """Attach to the browser whose DevTools websocket is at `url`."""
+        if aiohttp is None:
+            raise RuntimeError("AsyncChrome requires aiohttp: pip install aiohttp")
+        session = aiohttp.ClientSession()
+        try:
+            websocket = await session.ws_connect(url, max_msg_size=0)
+        except BaseException:
+            await session.close()
+            raise
+        return cls(session, websocket)
+
+    @classmethod
+    async def launch(cls, chrome_path=None, timeout=30):
+        """Start headless Chrome and connect to it.
+
+        Chrome is started from `chrome_path`, or the first executable found
+        by `find_chrome`, with a temporary profile that is removed again by
+        `close`.
+        """
+        profile = tempfile.TemporaryDirectory(prefix="gitbook-to-pdf-chrome-")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                chrome_path or find_chrome(),
+                *CHROME_ARGUMENTS,
+                '--remote-debugging-port=0',
+                f'--user-data-dir={profile.name}',
+                'about:blank',
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except BaseException:
+            profile.cleanup()
+            raise
+        try:
+            url = await asyncio.wait_for(
+                cls._devtools_url(process, Path(profile.name)), timeout
+            )
+            chrome = await cls.connect(url)
+        except BaseException:
+            await _stop_process(process)
+            _remove_profile(profile)
+            raise
+        chrome._process = process
+        chrome._profile = profile
+        return chrome
+
+    @staticmethod
+    async def _devtools_url(process, profile_dir):
+        # 使用随机端口启动，Chrome 就绪后把端口和路径写入 DevToolsActivePort
+        port_file = profile_dir / 'DevToolsActivePort'
+        while True:
+            if process.returncode is not None:
+                raise RuntimeError(
+                    "Could not start Chrome. Ensure Google Chrome is installed."
+                )
+            try:
+                lines = port_file.read_text().splitlines()
+            except OSError:
+                lines = []
+            if len(lines) >= 2 and lines[0] and lines[1]:
+                return f"ws://127.0.0.1:{lines[0]}{lines[1]}"
+            await asyncio.sleep(0.05)
+
+    async def send(self, method, params=None, session_id=None):
+        """Run a DevTools command and return its result.
+
+        `session_id` addresses a tab attached with `new_page`. Raises
+        `CDPError` when Chrome reports an error or the connection is lost.
+        """
+        if self._reader.done():
+            raise CDPError("Chrome closed the DevTools connection")
+        self._next_id += 1
+        message_id = self._next_id
+        message = {'id': message_id, 'method': method, 'params': params or {}}
+        if session_id is not None:
+            message['sessionId'] = session_id
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[message_id] = reply
+        try:
+            await self._websocket.send_str(json.dumps(message))
+            return await reply
+        finally:
+            self._replies.pop(message_id, None)
+
+    async def _read(self):
+        """Hand every reply to the command waiting for it; events are ignored."""
+        try:
+            async for message in self._websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                reply = self._replies.get(data.get('id'))
+                if reply is None or reply.done():
+                    continue
+                if 'error' in data:
+                    reply.set_exception(CDPError(
+                        f"{data['error'].get('message')} "
+                        f"({data['error'].get('code')})"
+                    ))
+                else:
+                    reply.set_result(data.get('result', {}))
+        finally:
+            for reply in self._replies.values():
+                if not reply.done():
+                    reply.set_exception(
+                        CDPError("Chrome closed the DevTools connection")
+                    )
+
+    async def new_context(self):
+        """Create an isolated browser context and return its id.
+
+        Contexts share nothing (cookies, storage, cache) with each other,
+        like incognito windows.
+        """
+        result = await self.send('Target.createBrowserContext')
+        return result['browserContextId']
+
+    async def close_context(self, context_id):
+        """Dispose of a browser context together with its tabs."""
+        await self.send(
+            'Target.disposeBrowserContext', {'browserContextId': context_id}
+        )
+
+    async def new_page(self, context_id=None):
+        """Open a blank tab, in `context_id` if given, and return its `CDPPage`."""
+        params = {'url': 'about:blank'}
+        if context_id is not None:
+            params['browserContextId'] = context_id
+        target_id = (await self.send('Target.createTarget', params))['targetId']
+        result = await self.send(
+            'Target.attachToTarget', {'targetId': target_id, 'flatten': True}
+        )
+        return CDPPage(self, target_id, result['sessionId'])
+
+    async def close(self):
+        """Close the connection; a browser started by `launch` is shut down."""
+        try:
+            if self._process is not None and not self._reader.done():
+                try:
+                    await asyncio.wait_for(self.send('Browser.close'), 5)
+                except (CDPError, asyncio.TimeoutError):
+                    pass
+        finally:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            await self._websocket.close()
+            await self._session.close()
+            if self._process is not None:
+                process = self._process
+                self._process = None
+                await _stop_process(process)
+                _remove_profile(self._profile)
+
+
+async def _stop_process(process, timeout=5):
+    """Wait for `process` to exit, killing it after `timeout` seconds."""
+    if process.returncode is None:
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+            return
+        except asyncio.TimeoutError:
+            process.kill()
+    await process.wait()
+
+
+def _remove_profile(profile):
+    try:
+        profile.cleanup()
+    except OSError as e:  # Chrome 子进程可能仍占用个别文件
+        logging.warning(f"Could not remove Chrome profile {profile.name}: {e}")
+
+
+class CDPPage:
+    """One tab of an `AsyncChrome`.
+
+    Provides the calls `wait_for_page_ready_async` and
+    `print_to_file_async` need in place of a Selenium driver.
+    """
+
+    def __init__(self, chrome, target_id, session_id):
+        self.chrome = chrome
+        self.target_id = target_id
+        self.session_id = session_id
+        self.url = None
+
+    async def execute_cdp_cmd(self, method, params=None):
+        return await self.chrome.send(method, params, self.session_id)
+
+    async def get(self, url):
+        """Navigate to `url`; use `wait_for_page_ready_async` to let it settle."""
+        result = await self.execute_cdp_cmd('Page.navigate', {'url': url})
+        if result.get('errorText'):
+            raise CDPError(f"Could not load {url}: {result['errorText']}")
+        self.url = url
+
+    async def evaluate(self, expression):
+        """Return the value of a JavaScript expression in the page."""
+        result = await self.execute_cdp_cmd('Runtime.evaluate', {
+            'expression': expression,
+            'returnByValue': True,
+        })
+        if 'exceptionDetails' in result:
+            raise CDPError(
+                f"JavaScript error: {result['exceptionDetails'].get('text')}"
+            )
+        return result.get('result', {}).get('value')
+
+    async def title(self):
+        return await self.evaluate('document.title')
+
+    async def close(self):
+        await self.chrome.send('Target.closeTarget', {'targetId': self.target_id})
+
+
+def url_origin(url):
+    """Return the ``scheme://host[:port]`` origin of an http(s) URL, or None."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+        return None
+    return f"{parsed.scheme}://{canonical_netloc(parsed)}"
+
+
+def browser_memory(driver):
+    """Return the resident memory of the Chrome processes of `driver`.
+
+    The processes are the children of the chromedriver process. Returns
+    None when psutil is not installed or the processes cannot be read.
+    """
+    if psutil is None:
+        return None
+    try:
+        service = psutil.Process(driver.service.process.pid)
+        return sum(
+            process.memory_info().rss
+            for process in service.children(recursive=True)
+        )
+    except (AttributeError, psutil.Error):
+        return None
+
+
+class BrowserPool:
+    """Long-lived Chrome drivers shared by several print exports.
+
+    Up to `size` drivers are kept; with `warm` they are all started up
+    front, so an export only waits for a page load, not for Chrome. Drivers
+    run incognito and are reset whenever they are released: cookies and the
+    cache are cleared, and so is the site storage (local storage,
+    IndexedDB, service workers, ...) of every origin the export reported
+    visiting, so exports do not see each other's state. A driver is
+    replaced after printing `max_pages` pages, when its Chrome processes use
+    more than `max_memory_mb` of memory, or when it stops responding.
+    Without psutil, the JavaScript heap of the last page is measured
+    instead of the processes.
+    Drivers are started from `driver_path` or the ``chromedriver`` on PATH
+    and are never downloaded at runtime.
+
+    Pass the pool to `GitbookToPDF(browser_pool=...)`; drivers are returned
+    to it by `GitbookToPDF.close`.
+    """
+
+    def __init__(self, size=2, max_pages=200, max_memory_mb=None,
+                 driver_path=None, warm=True):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.driver_path = driver_path
+        self.started = 0
+        self.recycled = 0
+        self._idle = deque()
+        self._pages = {}
+        self._total = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        if warm:
+            with self._condition:
+                self._total = size
+            drivers = []
+            first_error = None
+            with ThreadPoolExecutor(max_workers=size) as executor:
+                futures = [executor.submit(self._start) for _ in range(size)]
+                for future in futures:
+                    try:
+                        drivers.append(future.result())
+                    except BaseException as error:
+                        with self._condition:
+                            self._total -= 1
+                        if first_error is None:
+                            first_error = error
+            with self._condition:
+                self._idle.extend(drivers)
+            if first_error is not None:
+                # 已启动的驱动已进入空闲队列，close() 会将它们全部退出
+                self.close()
+                raise first_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _start(self):
+        driver = setup_chrome_driver(
+            allow_install=False, driver_path=self.driver_path, incognito=True
+        )
+        with self._condition:
+            self._pages[id(driver)] = 0
+            self.started += 1
+        return driver
+
+    def acquire(self, block=True, timeout=None):
+        """Return an idle driver, starting one if the pool is not full.
+
+        When every driver is in use, wait for one to be released, or return
+        None right away if `block` is false.
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("browser pool is closed")
+                    if self._idle:
+                        driver = self._idle.popleft()
+                        break
+                    if self._total < self.size:
+                        self._total += 1
+                        driver = None
+                        break
+                    if not block:
+                        return None
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError("no browser became available")
+            if driver is None:
+                try:
+                    return self._start()
+                except BaseException:
+                    with self._condition:
+                        self._total -= 1
+                        self._condition.notify()
+                    raise
+            try:
+                driver.execute_script("return 1")
+                return driver
+            except Exception:
+                logging.info("Replacing a browser that stopped responding")
+                self._discard(driver)
+
+    def release(self, driver, pages=0, origins=()):
+        """Return `driver` after it printed `pages` pages.
+
+        `origins` are the origins (``scheme://host[:port]``) the export
+        loaded; their site storage is cleared.
+        """
+        with self._condition:
+            served = self._pages.get(id(driver), 0) + pages
+            self._pages[id(driver)] = served
+            closed = self._closed
+        if closed:
+            self._discard(driver)
+            return
+        if served >= self.max_pages or self._over_memory(driver) or \
+                not self._reset(driver, origins):
+            self._discard(driver)
+            with self._condition:
+                self.recycled += 1
+            self._replenish()
+            return
+        with self._condition:
+            self._idle.append(driver)
+            self._condition.notify()
+
+    def _reset(self, driver, origins=()):
+        """Clear everything an export left in the browser."""
+        try:
+            origins = set(origins)
+            current_url = driver.current_url
+            if isinstance(current_url, str):
+                origins.add(url_origin(current_url))
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+            # 存储只能按具体的源清除，没有通配符
+            for origin in sorted(origins - {None}):
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
+                    'origin': origin,
+                    'storageTypes': 'all',
+                })
+            driver.get('about:blank')
+            return True
+        except Exception as e:
+            logging.info(f"Could not reset a pooled browser: {str(e)}")
+            return False
+
+    def _over_memory(self, driver):
+        if not self.max_memory_mb:
+            return False
+        memory = browser_memory(driver)
+        if memory is not None:
+            return memory > self.max_memory_mb * 2**20
+        try:
+            driver.execute_cdp_cmd('Performance.enable', {})
+            metrics = driver.execute_cdp_cmd('Performance.getMetrics', {})
+        except Exception:
+            return True
+        heap = next(
+            (metric['value'] for metric in metrics.get('metrics', [])
+             if metric['name'] == 'JSHeapTotalSize'),
+            0,
+        )
+        return heap > self.max_memory_mb * 2**20
+
+    def _discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self._condition:
+            self._pages.pop(id(driver), None)
+            self._total -= 1
+            self._condition.notify()
+
+    def _replenish(self):
+        """Start a replacement driver in the background to keep the pool warm."""
+        with self._condition:
+            if self._closed or self._total >= self.size:
+                return
+            self._total += 1
+
+        def start():
+            try:
+                driver = self._start()
+            except Exception as e:
+                logging.error(f"Could not start a pooled browser: {str(e)}")
+                with self._condition:
+                    self._total -= 1
+                    self._condition.notify()
+                return
+            self.release(driver)
+
+        threading.Thread(target=start, daemon=True).start()
+
+    def close(self):
+        """Quit the idle drivers; drivers in use are quit when released."""
+        with self._condition:
+            self._closed = True
+            drivers = list(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+        for driver in drivers:
+            self._discard(driver)
+
+
+class GitbookToPDF:
+    def __init__(
+        self,
+        base_url,
+        method='html',
+        wkhtmltopdf_path=None,
+        concurrency=4,
+        max_per_host=None,
+        rate_limit=None,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        print_workers=1,
+        image_workers=None,
+        max_image_dpi=None,
+        image_quality=None,
+        chunk_pages=None,
+        render_workers=None,
+        discover=True,
+        query_policy='strip-tracking',
+        content_selectors=None,
+        parse_workers=None,
+        prune_css=True,
+        single_document=False,
+        ready_timeout=10,
+        cache_dir=None,
+        cache_size_mb=DEFAULT_CACHE_SIZE_MB,
+        store_dir=None,
+        work_dir=None,
+        resume=False,
+        metrics=None,
+        browser_pool=None,
+        start_browser=True,
+    ):
+        if resume and not work_dir:
+            raise ValueError("resume requires a work directory")
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if print_workers < 1:
+            raise ValueError("print_workers must be at least 1")
+        self.base_url = base_url
+        self.query_policy = query_policy
+        self.visited_urls = VisitedIndex(query_policy)
+        self.page_fragments = []
+        self.concurrency = concurrency
+        self.max_per_host = max_per_host or concurrency
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        self.metrics = metrics or Metrics()
+        self._cancelled = threading.Event()
+        self.rate_limiter = HostRateLimiter(rate_limit)
+        self.timeout = timeout
+        self.retries = retries
+        self.image_workers = image_workers or concurrency
+        self.session = requests.Session()
+        # 页面与图片下载线程共用同一个连接池
+        adapter = HTTPAdapter(
+            pool_connections=concurrency,
+            pool_maxsize=concurrency + self.image_workers,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = None
+        self.manifest = None
+        if cache_dir:
+            self.cache = HTTPCache(cache_dir, max_bytes=cache_size_mb * 2**20)
+            manifest_name = f"manifest-{method}"
+            if method == 'print' and single_document:
+                # 单文档模式缓存的是页面片段而不是逐页 PDF
+                manifest_name += "-document"
+            self.manifest = BuildManifest(cache_dir, manifest_name)
+        self.store = None
+        if store_dir:
+            self.store = ContentStore(store_dir)
+            # 每本书（及导出方式）一份引用清单，重复导出时替换旧的引用
+            self._store_ref = hashlib.sha256(
+                f"{method}:{canonicalize_url(base_url, query_policy)}".encode()
+            ).hexdigest()
+        self.css_files = {}  # 保持首次出现的顺序，层叠顺序依赖于此
+        self.title = ""
+        self.images = {}
+        self._image_executor = None
+        self._image_downloads = {}
+        self._image_lock = threading.Lock()
+        self.optimize_images = bool(max_image_dpi or image_quality)
+        self.max_image_width = None
+        if max_image_dpi:
+            self.max_image_width = round(A4_CONTENT_WIDTH_INCHES * max_image_dpi)
+        self.image_quality = image_quality or DEFAULT_IMAGE_QUALITY
+        self._image_process_pool = None
+        if self.optimize_images and Image is None:
+            logging.warning(
+                "Pillow is not installed; images will not be optimized"
+            )
+            self.optimize_images = False
+        self.method = method
+        self.wkhtmltopdf_path = wkhtmltopdf_path
+        self.chunk_pages = chunk_pages
+        self.discover = discover
+        self.content_selectors = None
+        if content_selectors:
+            self.content_selectors = tuple(content_selectors)
+            for selector in self.content_selectors:
+                compile_selector(selector)
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.prune_css = prune_css
+        self.single_document = method == 'print' and single_document
+        self._parse_process_pool = None
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.driver = None
+        self.browser_pool = browser_pool
+        self._driver_pages = {}
+        self._driver_origins = {}
+        self.print_workers = print_workers
+        self.ready_timeout = ready_timeout
+        self.readiness_times = {}
+        self.pdf_titles = {}
+        self._printed = {}
+        self._printed_lock = threading.Lock()
+        self._print_jobs = []
+        self._extra_drivers = []
+        self.checkpoint = None
+        self._resume_state = None
+        self._export_complete = False
+        if work_dir:
+            # 持久工作目录：close() 不会删除，便于中断后继续
+            self._temporary_directory = None
+            self.workspace_dir = Path(work_dir).expanduser().resolve()
+            self.workspace_dir.mkdir(parents=True, exist_ok=True)
+            self.checkpoint = ExportCheckpoint(self.workspace_dir)
+            if resume:
+                self._resume_state = self.checkpoint.load(
+                    base_url, method, self.visited_urls
+                )
+            else:
+                self.checkpoint.clear()
+        else:
+            self._temporary_directory = tempfile.TemporaryDirectory(
+                prefix="gitbook-to-pdf-"
+            )
+            self.workspace_dir = Path(self._temporary_directory.name)
+        self.image_dir = self.workspace_dir / "images"
+        self.temp_dir = self.workspace_dir / "pages"
+        self.fragment_dir = self.workspace_dir / "fragments"
+        # 有持久缓存时，压缩后的图片也放在缓存目录里，供以后的导出复用
+        self.optimized_image_dir = (
+            self.cache.directory / "optimized"
+            if self.cache is not None
+            else self.image_dir / "optimized"
+        )
+        self.image_dir.mkdir(exist_ok=True)
+        self.temp_dir.mkdir(exist_ok=True)
+        self.fragment_dir.mkdir(exist_ok=True)
+
+        try:
+            if self.method == 'print' and start_browser:
+                self.driver = self._new_driver()
+        except Exception:
+            if self._temporary_directory is not None:
+                self._temporary_directory.cleanup()
+                self._temporary_directory = None
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Release browser and temporary workspace resources."""
+        try:
+            try:
+                if self._image_executor is not None:
+                    executor = self._image_executor
+                    self._image_executor = None
+                    executor.shutdown(wait=True)
+                if self._image_process_pool is not None:
+                    process_pool = self._image_process_pool
+                    self._image_process_pool = None
+                    process_pool.shutdown(wait=True)
+                if self._parse_process_pool is not None:
+                    process_pool = self._parse_process_pool
+                    self._parse_process_pool = None
+                    process_pool.shutdown(wait=True)
+                if self.manifest is not None:
+                    manifest = self.manifest
+                    self.manifest = None
+                    # 只有完整导出后才能判断哪些页面已不存在
+                    manifest.save(prune=self._export_complete)
+                if self.cache is not None:
+                    cache = self.cache
+                    self.cache = None
+                    cache.save()
+                if self.store is not None:
+                    store = self.store
+                    self.store = None
+                    store.save_ref(self._store_ref)
+                    store.collect_garbage()
+            except BaseException:
+                # 保存失败时仍要退出或归还浏览器，并抛出最先出现的错误
+                try:
+                    self._quit_drivers()
+                except Exception:
+                    pass
+                raise
+            self._quit_drivers()
+        finally:
+            if self._temporary_directory is not None:
+                temporary_directory = self._temporary_directory
+                self._temporary_directory = None
+                temporary_directory.cleanup()
+    
+    def _quit_drivers(self):
+        """Quit every started Chrome driver, re-raising the first failure."""
+        drivers = self._extra_drivers
+        self._extra_drivers = []
+        if self.driver is not None:
+            drivers.append(self.driver)
+            self.driver = None
+
+        first_error = None
+        for driver in drivers:
+            try:
+                if self.browser_pool is not None:
+                    self.browser_pool.release(
+                        driver,
+                        self._driver_pages.pop(id(driver), 0),
+                        self._driver_origins.pop(id(driver), ()),
+                    )
+                else:
+                    driver.quit()
+            except Exception as error:
+                if first_error is None:
+                    first_error = error
+        if first_error is not None:
+            raise first_error
+
+    def _load(self, driver, url):
+        """Open `url` in `driver`, remembering its origin for the pool reset."""
+        with self._printed_lock:
+            self._driver_origins.setdefault(id(driver), set()).add(
+                url_origin(url)
+            )
+        driver.get(url)
+
+    def _new_driver(self, block=True):
+        if self.browser_pool is not None:
+            return self.browser_pool.acquire(block=block)
+        return setup_chrome_driver()
+
+    def _start_print_drivers(self, count):
+        """Return up to `count` Chrome drivers, starting extra ones as needed.
+
+        With a browser pool, extra drivers are only taken while the pool has
+        one to spare, so exports sharing the pool cannot deadlock.
+        """
+        missing = count - 1 - len(self._extra_drivers)
+        if missing > 0:
+            with ThreadPoolExecutor(max_workers=missing) as executor:
+                futures = [
+                    executor.submit(self._new_driver, False)
+                    for _ in range(missing)
+                ]
+                first_error = None
+                for future in futures:
+                    # 先收下所有启动成功的驱动，close() 才能把它们全部退出
+                    try:
+                        driver = future.result()
+                    except Exception as error:
+                        if first_error is None:
+                            first_error = error
+                        continue
+                    if driver is not None:
+                        self._extra_drivers.append(driver)
+            if first_error is not None:
+                raise first_error
+        return [self.driver] + self._extra_drivers[:count - 1]
+
+    def _record_printed(self, index, url, path):
+        """Remember a printed page and checkpoint the print queue."""
+        with self._printed_lock:
+            self._printed[index] = {
+                'url': url,
+                'path': path,
+                'title': self.pdf_titles.get(path),
+            }
+        if self._print_jobs:
+            self._save_checkpoint(self._print_state())
+
+    def _print_state(self):
+        with self._printed_lock:
+            return {
+                'stage': 'print',
+                'jobs': self._print_jobs,
+                'printed': {
+                    str(index): page for index, page in self._printed.items()
+                    if page['path']
+                },
+            }
+
+    def print_pages(self, jobs):
+        """Print (index, url) jobs on the driver pool, preserving order.
+
+        Every driver runs in its own thread and takes the next job from a
+        shared queue, so slow pages do not hold up the other workers.
+        """
+        if not jobs:
+            return []
+
+        drivers = self._start_print_drivers(min(self.print_workers, len(jobs)))
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        results = {}
+        errors = []
+
+        def work(driver):
+            while not errors:
+                try:
+                    index, url = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._check_cancelled()
+                    print(f"处理页面 {index}/{len(jobs)}: {url}")
+                    results[index] = self.print_to_pdf(url, index, driver)
+                    self._record_printed(index, url, results[index])
+                except BaseException as error:
+                    errors.append(error)
+                    return
+
+        threads = [
+            threading.Thread(target=work, args=(driver,), daemon=True)
+            for driver in drivers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        return [results.get(index) for index, _ in jobs]
+
+    def write_metrics(self, path, format='json'):
+        """Write the metrics of this export to `path`.
+
+        `format` is ``'json'`` for the run report or ``'prometheus'`` for
+        the Prometheus text format.
+        """
+        if self.cache is not None:
+            self.metrics.set('cache_hits', self.cache.hits)
+            self.metrics.set('cache_misses', self.cache.misses)
+        if self.manifest is not None:
+            self.metrics.set('artifacts_reused', self.manifest.reused)
+        if self.page_fragments:
+            self.metrics.set('pages_extracted', len(self.page_fragments))
+        if format == 'prometheus':
+            data = self.metrics.prometheus()
+        else:
+            data = json.dumps(self.metrics.report(), indent=2) + '\n'
+        write_atomic(path, data.encode('utf-8'))
+
+    def cancel(self):
+        """Ask a running export to stop as soon as possible.
+
+        Safe to call from any thread. The running stage raises
+        `ExportCancelled`; with a work directory the checkpoint is kept, so
+        the export can be resumed later.
+        """
+        self._cancelled.set()
+
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise ExportCancelled("export was cancelled")
+
+    def _save_checkpoint(self, state, force=False):
+        if self.checkpoint is not None:
+            self.checkpoint.save(
+                self.base_url, self.method, state, self.visited_urls, force
+            )
+
+    def _take_resume_state(self, stage):
+        """Return the checkpointed state for `stage` once, if resuming."""
+        state = self._resume_state
+        if state is None or state.get('stage') != stage:
+            return None
+        self._resume_state = None
+        print(f"Resuming from checkpoint {self.checkpoint.path}")
+        return state
+
+    def wait_until_ready(self, driver, url):
+        """Wait for `url` to settle in `driver` and record how long it took."""
+        self.readiness_times[url] = wait_for_page_ready(
+            driver, timeout=self.ready_timeout
+        )
+
+    def _page_hash(self, url):
+        """Return the content hash of `url`, or None if it cannot be fetched."""
+        try:
+            response = self._get(url)
+            response.raise_for_status()
+            return hashlib.sha256(response.content).hexdigest()
+        except Exception as e:
+            logging.error(f"Error fetching {url}: {str(e)}")
+            return None
+
+    def print_to_pdf(self, url, index, driver=None):
+        """使用 Chrome 打印方式生成 PDF"""
+        driver = driver or self.driver
+        filepath = os.path.join(self.temp_dir, f"page_{index:03d}.pdf")
+        content_hash = None
+        if self.manifest is not None:
+            content_hash = self._page_hash(url)
+            if self._reuse_printed_page(url, content_hash, filepath):
+                return filepath
+
+        try:
+            with self.metrics.timer('print_to_pdf', url=url):
+                self.rate_limiter.acquire(url)
+                self._load(driver, url)
+                with self._printed_lock:
+                    self._driver_pages[id(driver)] = (
+                        self._driver_pages.get(id(driver), 0) + 1
+                    )
+                self.wait_until_ready(driver, url)
+                title = driver.title or url
+
+                size = print_to_file(driver, filepath, PAGE_PRINT_OPTIONS)
+            return self._printed_page(url, filepath, title, size, content_hash)
+        except ExportCancelled:
+            raise
+        except Exception as e:
+            print(f"处理 {url} 时出错: {str(e)}")
+            return None
+
+    def _reuse_printed_page(self, url, content_hash, filepath):
+        """Copy the PDF of an unchanged page from the manifest, if there is one."""
+        artifact = self.manifest.artifact(url, content_hash)
+        if artifact is None:
+            return False
+        shutil.copyfile(artifact, filepath)
+        self.pdf_titles[filepath] = self.manifest.details(url).get('title')
+        print(f"未变化，复用 {os.path.basename(filepath)}")
+        return True
+
+    def _printed_page(self, url, filepath, title, size, content_hash):
+        """Record a freshly printed page; return its path."""
+        self.metrics.increment('pages_printed')
+        self.metrics.increment('pdf_bytes', size)
+        self.pdf_titles[filepath] = title
+        if content_hash is not None:
+            self.manifest.store_file(url, content_hash, filepath, title=title)
+
+        print(f"已保存 {os.path.basename(filepath)}")
+        return filepath
+
+    def merge_pdfs(self, pdf_files, output_file, titles=None):
+        """合并多个 PDF 文件，并为每个带标题的文件添加书签"""
+        with self.metrics.timer('merge_pdfs'):
+            merge_pdf_files(pdf_files, output_file, titles, self._check_cancelled)
+        remove_files(pdf_files)
+
+    def download_image(self, img_url):
+        """下载图片并保存到本地，返回本地路径；失败时返回原始 URL"""
+        try:
+            if self.store is not None:
+                return self._download_image_to_store(img_url)
+
+            img_path = self._downloaded_image(img_url)
+            if img_path is not None:
+                return str(img_path)
+
+            with self.metrics.timer('download_image', url=img_url):
+                response = self._get(img_url, stream=True)
+                response.raise_for_status()
+                img_path = self._image_path(img_url, response)
+                partial_path = img_path.with_name(
+                    f".{img_path.name}.{threading.get_ident()}"
+                )
+                size = 0
+                with open(partial_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk:
+                            f.write(chunk)
+                            size += len(chunk)
+                os.replace(partial_path, img_path)
+            self.metrics.increment('images_downloaded')
+            self.metrics.increment('image_bytes', size)
+
+            return str(img_path)
+
+        except Exception as e:
+            logging.error(f"Error downloading image {img_url}: {str(e)}")
+            return img_url
+
+    def _downloaded_image(self, img_url):
+        """Return the path of an earlier download of `img_url`, or None."""
+        img_hash = hashlib.md5(img_url.encode()).hexdigest()
+        extension = os.path.splitext(urlparse(img_url).path)[1]
+        if extension:
+            existing = [self.image_dir / f"{img_hash}{extension}"]
+        else:
+            existing = sorted(self.image_dir.glob(f"{img_hash}.*"))
+        for img_path in existing:
+            if img_path.exists():
+                return img_path
+        return None
+
+    def _image_path(self, img_url, response):
+        img_hash = hashlib.md5(img_url.encode()).hexdigest()
+        return self.image_dir / f"{img_hash}{image_extension(img_url, response)}"
+
+    def _revalidate(self, namespace, url, **kwargs):
+        """GET `url` unless the stored copy is still current.
+
+        Returns ``(record, response)``: `response` is None when the server
+        confirmed the stored copy with 304 Not Modified, and otherwise the
+        response with the new body. Stored copies without validators are
+        downloaded again. The request bypasses the HTTP cache; the store
+        keeps the validators itself.
+        """
+        record, headers = self._stored_validators(namespace, url)
+        return self._revalidated(
+            namespace, record, headers,
+            self._send(url, headers=headers, **kwargs),
+        )
+
+    def _stored_validators(self, namespace, url):
+        """Return the store record of `url` and the headers to revalidate it."""
+        record = self.store.get(namespace, url)
+        headers = {}
+        if record is not None:
+            validators = record.get('headers', {})
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+        return record, headers
+
+    def _revalidated(self, namespace, record, headers, response):
+        if record is not None and headers and response.status_code == 304:
+            response.close()
+            self._count_store_lookup(namespace, record)
+            return record, None
+        response.raise_for_status()
+        self._count_store_lookup(namespace, None)
+        return record, response
+
+    def _store_response(self, namespace, url, blob, response):
+        return self.store.set(namespace, url, blob, headers={
+            name: response.headers[name]
+            for name in HTTPCache.STORED_HEADERS
+            if response.headers.get(name)
+        })
+
+    def _download_image_to_store(self, img_url):
+        """Return the stored copy of `img_url`, revalidating it.
+
+        The body is only transferred when it changed. The key lock keeps
+        exports in other threads and processes from downloading the same
+        image at the same time.
+        """
+        with self.store.lock('image', img_url):
+            with self.metrics.timer('download_image', url=img_url):
+                record, response = self._revalidate(
+                    'image', img_url, stream=True
+                )
+                if response is None:
+                    return str(self.store.path(record['blob']))
+                blob = self.store.add_stream(
+                    response.iter_content(chunk_size=8192),
+                    image_extension(img_url, response),
+                )
+            self.metrics.increment('images_downloaded')
+            self.metrics.increment(
+                'image_bytes', self.store.path(blob).stat().st_size
+            )
+            self._store_response('image', img_url, blob, response)
+            return str(self.store.path(blob))
+
+    def _count_store_lookup(self, kind, record):
+        self.metrics.increment(
+            'store_hits' if record is not None else 'store_misses', kind=kind
+        )
+
+    def _prepare_image(self, img_url):
+        """Download one image and, when enabled, optimize it."""
+        img_path = self.download_image(img_url)
+        if not self.optimize_images or img_path == img_url:
+            return img_path
+
+        settings, optimized = self._stored_optimized_image(img_path)
+        if optimized is not None:
+            return optimized
+        try:
+            optimized = self._optimize_image(img_path).result()
+        except Exception as e:
+            logging.error(f"Error optimizing image {img_url}: {str(e)}")
+            return img_path
+        return self._store_optimized_image(settings, img_path, optimized)
+
+    def _stored_optimized_image(self, img_path):
+        """Return the store key for optimizing `img_path` and any stored result."""
+        if self.store is None:
+            return None, None
+        settings = (
+            f"{Path(img_path).name}:{self.max_image_width}:"
+            f"{self.image_quality}"
+        )
+        record = self.store.get('optimized-image', settings)
+        self._count_store_lookup('optimized-image', record)
+        if record is None:
+            return settings, None
+        return settings, str(self.store.path(record['blob']))
+
+    def _optimize_image(self, img_path):
+        """Submit `img_path` to the image process pool; return the future."""
+        with self._image_lock:
+            if self._image_process_pool is None:
+                self._image_process_pool = new_process_pool()
+            process_pool = self._image_process_pool
+        return process_pool.submit(
+            optimize_image,
+            img_path,
+            str(self.optimized_image_dir),
+            self.max_image_width,
+            self.image_quality,
+        )
+
+    def _store_optimized_image(self, settings, img_path, optimized):
+        if settings is None:
+            return optimized
+        blob = Path(img_path).name
+        if optimized != img_path:
+            blob = self.store.add_file(optimized)
+        self.store.set('optimized-image', settings, blob)
+        return str(self.store.path(blob))
+
+    def fetch_image(self, img_url):
+        """Return a future for the local copy of `img_url`.
+
+        Downloads run on a bounded pool shared by all pages. Requests for a
+        URL that is already being fetched, or was fetched before, share the
+        same future instead of downloading the image again.
+        """
+        with self._image_lock:
+            future = self._image_downloads.get(img_url)
+            if future is None:
+                if self._image_executor is None:
+                    self._image_executor = ThreadPoolExecutor(
+                        max_workers=self.image_workers,
+                        thread_name_prefix='image',
+                    )
+                future = self._image_executor.submit(
+                    self._prepare_image, img_url
+                )
+                self._image_downloads[img_url] = future
+            return future
+
+    def is_same_domain(self, url):
+        """检查URL是否属于同一个域名"""
+        base_domain = canonical_netloc(urlparse(self.base_url))
+        url_domain = canonical_netloc(urlparse(url))
+        return base_domain == url_domain
+
+    @contextmanager
+    def _host_slot(self, url):
+        """Limit the number of concurrent requests sent to one host."""
+        host = canonical_netloc(urlparse(url))
+        with self._host_slots_lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self._host_slots[host] = slot
+        with slot:
+            yield
+
+    def _get(self, url, **kwargs):
+        """Issue a GET through the shared session, cache and host limits."""
+        if self.cache is not None:
+            return self.cache.fetch(self._send, url, **kwargs)
+        return self._send(url, **kwargs)
+
+    def _send(self, url, **kwargs):
+        """GET `url`, retrying connection errors, timeouts, 429 and 5xx.
+
+        Each attempt waits for the host's rate limiter and a host slot;
+        the slot is released while backing off so other requests proceed.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self._check_cancelled()
+            self.rate_limiter.acquire(url)
+            self.metrics.increment('http_requests')
+            try:
+                with self._host_slot(url):
+                    response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = retry_delay(attempt)
+                reason = str(e)
+            else:
+                if (response.status_code not in RETRY_STATUSES or
+                        attempt >= self.retries):
+                    if not kwargs.get('stream'):
+                        self.metrics.increment('http_bytes', len(response.content))
+                    return response
+                delay = retry_delay(
+                    attempt,
+                    retry_after=parse_retry_after(
+                        response.headers.get('Retry-After')
+                    ),
+                )
+                reason = f"HTTP {response.status_code}"
+                response.close()
+            attempt += 1
+            self.metrics.increment('http_retries')
+            logging.info(
+                f"Retrying {url} in {delay:.1f}s "
+                f"({attempt}/{self.retries}): {reason}"
+            )
+            self._cancelled.wait(delay)
+
+    def _should_follow(self, url):
+        """Return whether a discovered link should be crawled."""
+        path = urlparse(url).path.lower()
+        return (
+            urlparse(url).scheme in ('http', 'https') and
+            self.is_same_domain(url) and
+            not path.endswith(('.png', '.jpg', '.jpeg', '.gif', '.pdf'))
+        )
+
+    def _fetch_page(self, url):
+        """Fetch and extract one page; return None when it fails."""
+        with self.metrics.timer('fetch_page', url=url):
+            try:
+                print(f"Processing: {url}")
+                response = self._get(url)
+                response.raise_for_status()
+                page, key = self._reused_page(url, response.content)
+                if page is None:
+                    page = self._parse_pool().submit(
+                        parse_page, response.text, url, self.content_selectors
+                    ).result()
+                    self._remember_page(url, key, page)
+                images = self._page_images(page)
+                futures = [self.fetch_image(img_url) for img_url, _ in images]
+                return self._finish_page(
+                    url, page, images, [future.result() for future in futures]
+                )
+            except ExportCancelled:
+                raise
+            except Exception as e:
+                logging.error(f"Error processing {url}: {str(e)}")
+                return None
+
+    def _reused_page(self, url, content):
+        """Return ``(page, key)`` for a fetched page body.
+
+        `page` is the extraction stored by an earlier export, or None, and
+        `key` is what a new extraction is remembered under.
+        """
+        if self.store is not None:
+            key = self._page_key(url, hashlib.sha256(content).hexdigest())
+            return self._stored_page(key), key
+        if self.manifest is not None:
+            content_hash = hashlib.sha256(content).hexdigest()
+            artifact = self.manifest.artifact(url, content_hash)
+            page = None
+            if artifact is not None:
+                with open(artifact, encoding='utf-8') as f:
+                    page = json.load(f)
+                # 旧格式的片段引用已本地化的图片路径，不能复用
+                if 'images' not in page:
+                    page = None
+            return page, content_hash
+        return None, None
+
+    def _remember_page(self, url, key, page):
+        # 保存本地化之前的片段：图片每次仍会重新验证
+        if self.store is not None:
+            self._store_page(key, page)
+        elif self.manifest is not None:
+            self.manifest.store_bytes(
+                url, key, json.dumps(page).encode('utf-8'), '.json',
+            )
+
+    def _page_images(self, page):
+        """Remove and return the ``(url, src)`` images to localize in `page`."""
+        images = page.pop('images')
+        return images if page['content'] is not None else []
+
+    def _finish_page(self, url, page, images, paths):
+        """Point the images of `page` at their local `paths` and spool it."""
+        if images:
+            sources = []
+            for (img_url, src), img_path in zip(images, paths):
+                self.images[img_url] = img_path
+                if img_path != img_url:
+                    src = os.path.abspath(img_path)
+                sources.append(src)
+            page['content'] = localize_content(page['content'], sources)
+        return self._spool_fragment(url, page)
+
+    def _page_key(self, url, content_hash):
+        # 提取结果还取决于内容选择器
+        return json.dumps([url, content_hash, self.content_selectors])
+
+    def _stored_page(self, key):
+        """Return the extracted page stored under `key`, or None."""
+        record = self.store.get('page', key)
+        self._count_store_lookup('page', record)
+        if record is None:
+            return None
+        try:
+            page = json.loads(
+                self.store.path(record['blob']).read_text(encoding='utf-8')
+            )
+            if page['content'] is not None:
+                page['content'] = self.store.path(page['content']).read_text(
+                    encoding='utf-8'
+                )
+        except OSError:
+            # 被其他进程的垃圾回收删除，按未命中处理
+            return None
+        return page
+
+    def _store_page(self, key, page):
+        """Store an extracted page and its fragment for other exports.
+
+        Pages are stored before their images are localized, so the images
+        are revalidated whenever the page is reused. The fragment is a blob
+        of its own, so books sharing a chapter keep one copy of it even when
+        the surrounding pages differ.
+        """
+        stored = dict(page)
+        deps = []
+        if page['content'] is not None:
+            stored['content'] = self.store.add(
+                page['content'].encode('utf-8'), '.html'
+            )
+            deps.append(stored['content'])
+        blob = self.store.add(json.dumps(stored).encode('utf-8'), '.json')
+        self.store.set('page', key, blob, deps)
+
+    def _parse_pool(self):
+        """Return the process pool that runs `parse_page`."""
+        with self._image_lock:
+            if self._parse_process_pool is None:
+                self._parse_process_pool = new_process_pool(
+                    max_workers=self.parse_workers
+                )
+            return self._parse_process_pool
+
+    def _spool_fragment(self, url, page):
+        """Move the page content into a fragment file under the workspace.
+
+        Only the fragment path stays in memory, so the assembled book never
+        has to be held in memory at once.
+        """
+        content = page.pop('content')
+        page['fragment'] = None
+        if content is not None:
+            title = page['title'] or "Untitled"
+            path = self.fragment_dir / (
+                hashlib.sha256(url.encode()).hexdigest() + ".html"
+            )
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f'<div class="page-break"></div><h1>{title}</h1>')
+                f.write(content)
+            page['fragment'] = str(path)
+        return page
+
+    def crawl(self, start_url, urls=None):
+        """Fetch every same-domain page reachable from start_url.
+
+        The frontier is processed one link depth at a time on a thread pool.
+        Links are scheduled in frontier order as pages complete, and each page
+        is keyed by the link positions that led to it, so the page order is
+        the same for any worker count. When the complete page list is already
+        known, `urls` are fetched in that order and links are not followed.
+        With a work directory, progress is checkpointed as pages complete and
+        a resumed crawl only fetches the pages that are still missing.
+        """
+        levels = self._crawl_levels(start_url, urls)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                frontier = next(levels)
+                while True:
+                    frontier = levels.send(
+                        executor.map(self._fetch_page, frontier)
+                    )
+            except StopIteration:
+                pass
+
+    def _crawl_levels(self, start_url, urls=None):
+        """Generator behind `crawl`: yields each frontier of page URLs.
+
+        The caller fetches the frontier and sends back the `_fetch_page`
+        results in frontier order; once the crawl is complete the pages are
+        added to the book.
+        """
+        state = self._take_resume_state('crawl')
+        if state is not None:
+            following = state['following']
+            frontier = state['failed'] + state['frontier']
+            next_frontier = state['next_frontier']
+            order_keys = {
+                url: tuple(key) for url, key in state['order_keys'].items()
+            }
+            pages = state['pages']
+        else:
+            following = urls is None
+            frontier = [
+                url.split('#', 1)[0]
+                for url in ([start_url] if urls is None else urls)
+                if self.visited_urls.add(url)
+            ]
+            next_frontier = []
+            order_keys = {
+                url: (position,) for position, url in enumerate(frontier)
+            }
+            pages = {}
+        failed = []
+
+        def checkpoint(remaining, force=False):
+            self._save_checkpoint({
+                'stage': 'crawl',
+                'following': following,
+                'frontier': remaining,
+                'next_frontier': next_frontier,
+                'failed': failed,
+                'order_keys': order_keys,
+                'pages': pages,
+            }, force=force)
+
+        while frontier:
+            results = yield frontier
+            for done, (url, page) in enumerate(zip(frontier, results), 1):
+                if page is None:
+                    failed.append(url)
+                else:
+                    pages[url] = page
+                    links = page.pop('links')
+                    for position, next_url in enumerate(
+                        links if following else []
+                    ):
+                        next_url = next_url.split('#', 1)[0]
+                        if (self._should_follow(next_url) and
+                                self.visited_urls.add(next_url)):
+                            order_keys[next_url] = (
+                                order_keys[url] + (position,)
+                            )
+                            next_frontier.append(next_url)
+                checkpoint(frontier[done:])
+            frontier, next_frontier = next_frontier, []
+        checkpoint([], force=True)
+
+        for url in sorted(pages, key=order_keys.__getitem__):
+            page = pages.pop(url)
+            if not self.title and page['title']:
+                self.title = page['title']
+            self.css_files.update(dict.fromkeys(page['stylesheets']))
+            if page['fragment'] is not None:
+                self.page_fragments.append(page['fragment'])
+
+    def get_page_content(self, url):
+        """获取页面内容并解析"""
+        if self.method == 'print' and not self.single_document:
+            return self.print_to_pdf(url, len(self.visited_urls))
+
+        with self.metrics.timer('get_page_content'):
+            if self._resume_state is not None:
+                return self.crawl(url)
+            self.crawl(url, self.discover_urls(url) if self.discover else None)
+
+    def _in_scope(self, url, start_url):
+        """Return whether `url` lies under the directory of `start_url`."""
+        scope = urlparse(start_url).path.rsplit('/', 1)[0] + '/'
+        return urlparse(url).path.startswith(scope) or (
+            urlparse(url).path + '/' == scope
+        )
+
+    def discover_urls(self, start_url):
+        """Return the ordered page list from site metadata, or None.
+
+        The GitBook sidebar, the legacy SUMMARY.md and search index, and
+        the sitemap are consulted before any crawling. Navigation gives the
+        book order; pages only listed by the other sources are appended.
+        Returns None when none of them lists any page, so the caller can
+        fall back to following links.
+        """
+        return run_steps(self._discovered_urls(start_url), self._get)
+
+    def _discovered_urls(self, start_url):
+        """Step generator behind `discover_urls`: yields URLs to fetch."""
+        urls = [start_url]
+        seen = VisitedIndex(self.query_policy)
+        seen.add(start_url)
+
+        def add(found):
+            for url in found:
+                url = url.split('#', 1)[0]
+                if (url and self._should_follow(url) and
+                        self._in_scope(url, start_url) and seen.add(url)):
+                    urls.append(url)
+
+        for source in (
+            self._navigation_urls,
+            self._summary_urls,
+            self._sitemap_urls,
+        ):
+            try:
+                add((yield from source(start_url)))
+            except Exception as e:
+                logging.info(f"Page discovery via {source.__name__} failed: {str(e)}")
+
+        if len(urls) == 1:
+            return None
+        print(f"Discovered {len(urls)} pages from site navigation and sitemaps")
+        return urls
+
+    def _navigation_urls(self, start_url):
+        """Links of the largest GitBook navigation block on the start page."""
+        response = yield start_url
+        response.raise_for_status()
+        soup = BeautifulSoup(response.text, HTML_PARSER)
+        best = []
+        for selector in NAVIGATION_SELECTORS:
+            for container in soup.select(selector):
+                links = [
+                    urljoin(start_url, link['href'])
+                    for link in container.find_all('a', href=True)
+                ]
+                links = [link for link in links if self.is_same_domain(link)]
+                if len(links) > len(best):
+                    best = links
+        return best
+
+    def _summary_urls(self, start_url):
+        """Pages listed by a legacy GitBook SUMMARY.md or search index."""
+        urls = []
+        try:
+            response = yield urljoin(start_url, 'SUMMARY.md')
+            response.raise_for_status()
+            for target in re.findall(r'\[[^\]]*\]\(([^)\s]+)\)', response.text):
+                path = target.split('#', 1)[0]
+                if path.endswith('README.md'):
+                    path = path[:-len('README.md')]
+                elif path.endswith('.md'):
+                    path = path[:-len('.md')] + '.html'
+                urls.append(urljoin(start_url, path))
+        except Exception as e:
+            logging.info(f"No SUMMARY.md found: {str(e)}")
+
+        for name in ('search_plus_index.json', 'search_index.json'):
+            try:
+                response = yield urljoin(start_url, name)
+                response.raise_for_status()
+                index = json.loads(response.text)
+            except Exception:
+                continue
+            entries = index.get('store', index)
+            urls.extend(urljoin(start_url, path) for path in entries)
+            break
+        return urls
+
+    def _sitemap_urls(self, start_url):
+        """Page URLs listed by the site's sitemaps, in document order."""
+        root = f"{urlparse(start_url).scheme}://{urlparse(start_url).netloc}/"
+        pending = [urljoin(start_url, 'sitemap.xml'), urljoin(root, 'sitemap.xml')]
+        try:
+            response = yield urljoin(root, 'robots.txt')
+            response.raise_for_status()
+            pending.extend(
+                line.split(':', 1)[1].strip()
+                for line in response.text.splitlines()
+                if line.lower().startswith('sitemap:')
+            )
+        except Exception:
+            pass
+
+        urls = []
+        fetched = set()
+        while pending and len(fetched) < MAX_SITEMAPS:
+            sitemap_url = pending.pop(0)
+            if sitemap_url in fetched:
+                continue
+            fetched.add(sitemap_url)
+            try:
+                response = yield sitemap_url
+                response.raise_for_status()
+                document = ElementTree.fromstring(response.content)
+            except Exception:
+                continue
+            is_index = document.tag.endswith('sitemapindex')
+            for element in document.iter():
+                if element.tag.endswith('loc') and element.text:
+                    location = element.text.strip()
+                    if is_index:
+                        pending.append(location)
+                    else:
+                        urls.append(location)
+        return urls
+
+    def get_all_links(self, url):
+        """获取页面中的所有链接
+
+        服务端渲染的页面直接通过 HTTP 获取链接；否则在 Chrome 中用一次
+        execute_script 调用取回所有 href，而不是逐个元素读取属性。
+        """
+        try:
+            hrefs = self._http_links(url)
+            if not hrefs:
+                hrefs = self._browser_links(url)
+            return self._new_links(hrefs)
+        except Exception as e:
+            print(f"获取链接时出错: {str(e)}")
+            return []
+
+    def _new_links(self, hrefs):
+        """Return the followable, not yet visited links in `hrefs`, once each."""
+        urls = []
+        seen = VisitedIndex(self.query_policy)
+        for href in hrefs:
+            if (href and self._should_follow(href) and
+                    href not in self.visited_urls and seen.add(href)):
+                urls.append(href.split('#', 1)[0])
+        return urls
+
+    def _http_links(self, url):
+        """Return the same-domain links of a server-rendered page.
+
+        Returns an empty list when the page cannot be fetched or its
+        GitBook content is missing from the HTML, i.e. it is rendered by
+        JavaScript and needs a browser.
+        """
+        try:
+            response = self._get(url)
+            response.raise_for_status()
+        except Exception as e:
+            logging.info(f"Fetching {url} over HTTP failed: {str(e)}")
+            return []
+        return self._content_links(url, response.text)
+
+    def _content_links(self, url, text):
+        """Return the links of a page, or [] when its GitBook content is missing."""
+        soup = BeautifulSoup(text, HTML_PARSER)
+        if soup.select_one(GITBOOK_CONTENT_SELECTOR) is None:
+            return []
+        links = [
+            urljoin(url, link['href'])
+            for link in soup.find_all('a', href=True)
+        ]
+        return [link for link in links if self._should_follow(link)]
+
+    def _browser_links(self, url):
+        """Return every href of the page rendered in Chrome in one call."""
+        current_url = getattr(self.driver, 'current_url', None)
+        if not isinstance(current_url, str) or (
+            canonicalize_url(current_url, self.query_policy) !=
+            canonicalize_url(url, self.query_policy)
+        ):
+            self.rate_limiter.acquire(url)
+            self._load(self.driver, url)
+            self.wait_until_ready(self.driver, url)
+        return self.driver.execute_script(
+            "return Array.from(document.querySelectorAll('a[href]'), "
+            "link => link.href);"
+        ) or []
+
+    def _fetch_css(self, css_url):
+        try:
+            if self.store is None:
+                css_response = self._get(css_url)
+                css_response.raise_for_status()
+                return css_response.text
+            with self.store.lock('stylesheet', css_url):
+                return self._stored_stylesheet(
+                    css_url, *self._revalidate('stylesheet', css_url)
+                )
+        except Exception as e:
+            logging.error(f"Error downloading CSS from {css_url}: {str(e)}")
+            return None
+
+    def _stored_stylesheet(self, css_url, record, css_response):
+        """Store a changed stylesheet and return the text of the stored copy."""
+        if css_response is not None:
+            record = self._store_response(
+                'stylesheet',
+                css_url,
+                self.store.add(css_response.text.encode('utf-8'), '.css'),
+                css_response,
+            )
+        return self.store.path(record['blob']).read_text(encoding='utf-8')
+
+    def download_css(self, extra_html='', sheets=None):
+        """Download the stylesheets and return them as one minified sheet.
+
+        Stylesheets are fetched concurrently and kept in the order they were
+        first seen; identical files are included once. Unless pruning is
+        disabled, rules that cannot match the extracted pages or
+        `extra_html` are dropped. `sheets` are the texts of the stylesheets
+        when they have already been downloaded (None for failed ones).
+        """
+        with self.metrics.timer('download_css'):
+            css_urls = list(self.css_files)
+            if sheets is None:
+                with ThreadPoolExecutor(
+                    max_workers=max(1, min(self.concurrency, len(css_urls)))
+                ) as executor:
+                    sheets = list(executor.map(self._fetch_css, css_urls))
+
+            css_content = []
+            seen = set()
+            for sheet in sheets:
+                if sheet is None:
+                    continue
+                digest = hashlib.sha256(sheet.encode('utf-8')).digest()
+                if digest not in seen:
+                    seen.add(digest)
+                    css_content.append(sheet)
+            css = '\n'.join(css_content)
+
+            usage = None
+            if self.prune_css:
+                usage = CSSUsage()
+                usage.add_html(extra_html)
+                for fragment in self.page_fragments:
+                    with open(fragment, encoding='utf-8') as f:
+                        usage.add_html(f.read())
+            optimized = optimize_css(css, usage)
+            if css:
+                print(
+                    f"CSS: {len(css_urls)} 个样式表，{len(css) // 1024} KB → "
+                    f"{len(optimized) // 1024} KB"
+                )
+            return optimized
+
+    def _from_file(self, html_path, pdf_path, options, pdfkit_config):
+        """Render one HTML file with wkhtmltopdf."""
+        self._check_cancelled()
+        with self.metrics.timer('render', path=str(html_path)):
+            pdfkit.from_file(
+                html_path,
+                pdf_path,
+                options=options,
+                configuration=pdfkit_config,
+            )
+
+    def _write_document(self, path, html_head, fragments):
+        """Write an HTML document made of `html_head` and page fragments."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html_head)
+            # 逐页流式写入，避免在内存中拼接整本书
+            for fragment in fragments:
+                with open(fragment, encoding='utf-8') as page:
+                    shutil.copyfileobj(page, f)
+            f.write("""
+        </body>
+        </html>
+        """)
+
+    def render_chunks(self, html_head, html_cover, options, pdfkit_config, output_file):
+        """Render the book in chunks of pages on parallel wkhtmltopdf runs.
+
+        Chunks are rendered without page numbers. Once their page counts are
+        known, one blank document carrying only the continuous page numbers
+        is rendered and stamped over the merged chunks.
+        """
+        chunk_options = dict(options)
+        chunk_options.pop('footer-center', None)
+        jobs = self._write_chunks(html_head, html_cover)
+
+        print(f"Rendering {len(jobs)} chunks with {self.render_workers} workers...")
+        with ThreadPoolExecutor(max_workers=self.render_workers) as executor:
+            list(executor.map(
+                lambda job: self._from_file(
+                    job[0], job[1], chunk_options, pdfkit_config
+                ),
+                jobs,
+            ))
+
+        self._stamp_page_numbers(
+            [pdf_path for _, pdf_path in jobs],
+            lambda total_pages: self._render_page_numbers(
+                total_pages, options, pdfkit_config
+            ),
+            output_file,
+        )
+
+    def _write_chunks(self, html_head, html_cover):
+        """Write the chunk documents; return their (html, pdf) path pairs."""
+        jobs = []
+        for number, start in enumerate(
+            range(0, len(self.page_fragments), self.chunk_pages)
+        ):
+            html_path = self.workspace_dir / f"chunk_{number:03d}.html"
+            pdf_path = self.workspace_dir / f"chunk_{number:03d}.pdf"
+            self._write_document(
+                html_path,
+                html_head + (html_cover if number == 0 else ''),
+                self.page_fragments[start:start + self.chunk_pages],
+            )
+            jobs.append((str(html_path), str(pdf_path)))
+        return jobs
+
+    def _stamp_page_numbers(self, chunk_pdfs, render_numbers, output_file):
+        """Merge `chunk_pdfs` into `output_file` with continuous page numbers.
+
+        `render_numbers(total_pages)` returns the path of a PDF whose
+        transparent pages carry only the page numbers; they are stamped over
+        the pages of the chunks.
+        """
+        stamp_page_numbers(
+            chunk_pdfs, render_numbers(count_pdf_pages(chunk_pdfs)), output_file
+        )
+
+    def _write_blank_pages(self, total_pages):
+        """Write an HTML document of `total_pages` empty pages."""
+        html_path = self.workspace_dir / "page_numbers.html"
+        page = '<div style="page-break-after: always">&nbsp;</div>'
+        with open(html_path, 'w', encoding='utf-8') as f:
+            f.write('<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body>')
+            for _ in range(total_pages - 1):
+                f.write(page)
+            f.write('<div>&nbsp;</div></body></html>')
+        return html_path
+
+    def _render_page_numbers(self, total_pages, options, pdfkit_config):
+        """Render `total_pages` transparent pages carrying only page numbers."""
+        html_path = self._write_blank_pages(total_pages)
+        pdf_path = self.workspace_dir / "page_numbers.pdf"
+
+        self._from_file(
+            str(html_path), str(pdf_path),
+            wkhtmltopdf_number_options(options), pdfkit_config,
+        )
+        return str(pdf_path)
+
+    def _document_parts(self, sheets=None):
+        """Return the date, the HTML head and the cover page of the book.
+
+        `sheets` are passed on to `download_css`.
+        """
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        html_cover = f"""
+            <h1 class="cover-title">{self.title}</h1>
+            <div class="generation-date">Generated on {current_date}</div>
+        """
+        html_head = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <title>{self.title}</title>
+            <style>
+                {self.download_css(html_cover, sheets)}
+                @page {{
+                    size: A4;
+                    margin: 2cm 2.5cm;
+                    @top-right {{
+                        content: "{self.title}";
+                        font-size: 9pt;
+                        color: #666;
+                    }}
+                    @bottom-center {{
+                        content: counter(page);
+                        font-size: 10pt;
+                    }}
+                    @bottom-right {{
+                        content: "{current_date}";
+                        font-size: 9pt;
+                        color: #666;
+                    }}
+                }}
+                body {{
+                    font-family: "Arial", sans-serif;
+                    font-size: 11pt;
+                    line-height: 1.6;
+                    max-width: 100%;
+                }}
+                h1 {{
+                    font-size: 20pt;
+                    color: #333;
+                    margin-top: 2em;
+                    page-break-before: always;
+                }}
+                h2 {{
+                    font-size: 16pt;
+                    color: #444;
+                    margin-top: 1.5em;
+                }}
+                h3 {{
+                    font-size: 14pt;
+                    color: #555;
+                }}
+                img {{
+                    max-width: 100%;
+                    height: auto;
+                    margin: 1em 0;
+                }}
+                code {{
+                    font-family: "Consolas", monospace;
+                    background-color: #f5f5f5;
+                    padding: 2px 4px;
+                    border-radius: 3px;
+                }}
+                pre {{
+                    background-color: #f5f5f5;
+                    padding: 1em;
+                    border-radius: 5px;
+                    overflow-x: auto;
+                    font-size: 10pt;
+                }}
+                table {{
+                    width: 100%;
+                    border-collapse: collapse;
+                    margin: 1em 0;
+                }}
+                th, td {{
+                    border: 1px solid #ddd;
+                    padding: 8px;
+                    text-align: left;
+                }}
+                th {{
+                    background-color: #f5f5f5;
+                }}
+                .page-break {{
+                    page-break-before: always;
+                }}
+                a {{
+                    color: #0366d6;
+                    text-decoration: none;
+                }}
+                blockquote {{
+                    border-left: 4px solid #ddd;
+                    margin: 1em 0;
+                    padding-left: 1em;
+                    color: #666;
+                }}
+            </style>
+        </head>
+        <body>
+        """
+        return current_date, html_head, html_cover
+
+    def _print_local(self, driver, html_path, pdf_path, options):
+        """Print a local HTML file with Chrome."""
+        self._check_cancelled()
+        with self.metrics.timer('render', path=str(html_path)):
+            driver.get(Path(html_path).resolve().as_uri())
+            wait_for_page_ready(
+                driver, timeout=self.ready_timeout, content_selector=None
+            )
+            print_to_file(driver, str(pdf_path), options)
+
+    def print_document(self, output_file):
+        """Print the crawled pages as one document in a single Chrome job.
+
+        The page fragments are assembled as for the HTML method and printed
+        with a header and page-numbered footer. With `chunk_pages`, chunks
+        are printed on the print drivers and numbered continuously by a
+        stamped overlay.
+        """
+        current_date, html_head, html_cover = self._document_parts()
+        if self.chunk_pages and len(self.page_fragments) > self.chunk_pages:
+            self._print_chunks(html_head, html_cover, current_date, output_file)
+        else:
+            html_path = self.workspace_dir / "document.html"
+            self._write_document(
+                html_path, html_head + html_cover, self.page_fragments
+            )
+            self._print_local(
+                self.driver, html_path, output_file,
+                document_print_options(current_date),
+            )
+        print(f"PDF has been generated: {output_file}")
+        self._finish_export()
+
+    def _print_chunks(self, html_head, html_cover, current_date, output_file):
+        # 分块打印时页码由叠加层统一盖印，保证跨块连续
+        chunk_options = document_print_options(current_date, page_numbers=False)
+        pending = queue.Queue()
+        chunk_pdfs = []
+        for html_path, pdf_path in self._write_chunks(html_head, html_cover):
+            pending.put((html_path, pdf_path))
+            chunk_pdfs.append(pdf_path)
+
+        drivers = self._start_print_drivers(
+            min(self.print_workers, len(chunk_pdfs))
+        )
+
+        def work(driver):
+            while True:
+                try:
+                    html_path, pdf_path = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self._print_local(driver, html_path, pdf_path, chunk_options)
+
+        print(f"Printing {len(chunk_pdfs)} chunks with {len(drivers)} browsers...")
+        with ThreadPoolExecutor(max_workers=len(drivers)) as executor:
+            list(executor.map(work, drivers))
+
+        def render_numbers(total_pages):
+            pdf_path = self.workspace_dir / "page_numbers.pdf"
+            self._print_local(
+                self.driver,
+                self._write_blank_pages(total_pages),
+                pdf_path,
+                page_number_print_options(),
+            )
+            return str(pdf_path)
+
+        self._stamp_page_numbers(chunk_pdfs, render_numbers, output_file)
+
+    def _resumed_print_jobs(self):
+        """Restore the print queue from the checkpoint; None when not resuming."""
+        state = self._take_resume_state('print')
+        if state is None:
+            return None
+        self._printed = {
+            int(index): page for index, page in state['printed'].items()
+        }
+        return [tuple(job) for job in state['jobs']]
+
+    def _plan_print_jobs(self, urls):
+        """Return the (index, url) print jobs for the home page and `urls`."""
+        urls = [url for url in urls if url != self.base_url]
+        print(f"找到 {len(urls)} 个子页面")
+
+        jobs = [(0, self.base_url)]
+        for i, url in enumerate(urls, 1):
+            if self.visited_urls.add(url):
+                jobs.append((i, url))
+        return jobs
+
+    def _printed_files(self, jobs):
+        """Return the PDFs printed for `jobs`, in job order."""
+        pdf_files = []
+        for index, _ in jobs:
+            page = self._printed.get(index)
+            if page and page['path']:
+                pdf_files.append(page['path'])
+                self.pdf_titles[page['path']] = page['title']
+        return pdf_files
+
+    def _finish_export(self):
+        """Mark the export as complete once the output PDF is written."""
+        self._export_complete = True
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+    def generate_pdf(self, output_file='output.pdf'):
+        """生成PDF文件"""
+        if self.single_document:
+            return self.print_document(output_file)
+
+        if self.method == 'print':
+            jobs = self._resumed_print_jobs()
+            if jobs is None:
+                self._printed = {}
+                self.visited_urls.add(self.base_url)
+
+                # 处理主页
+                print(f"处理主页: {self.base_url}")
+                self._record_printed(
+                    0, self.base_url, self.print_to_pdf(self.base_url, 0)
+                )
+
+                # 优先从导航/站点地图获取页面列表，失败时再抓取主页链接
+                urls = self.discover_urls(self.base_url) if self.discover else None
+                if urls is None:
+                    urls = self.get_all_links(self.base_url)
+                jobs = self._plan_print_jobs(urls)
+            self._print_jobs = jobs
+            self._save_checkpoint(self._print_state(), force=True)
+
+            # 处理每个子页面（恢复时跳过已完成的页面）
+            self.print_pages([
+                (index, url) for index, url in jobs
+                if index not in self._printed
+            ])
+            self._save_checkpoint(self._print_state(), force=True)
+
+            pdf_files = self._printed_files(jobs)
+            if pdf_files:
+                print(f"合并 {len(pdf_files)} 个 PDF 文件...")
+                self.merge_pdfs(
+                    pdf_files,
+                    output_file,
+                    titles=[self.pdf_titles.get(pdf) for pdf in pdf_files],
+                )
+                print(f"PDF 生成完成: {output_file}")
+                self._finish_export()
+
+            return
+
+        # HTML 方法
+        current_date, html_head, html_cover = self._document_parts()
+        options = wkhtmltopdf_options(current_date)
+        pdfkit_config = self._pdfkit_configuration()
+
+        try:
+            if self.chunk_pages and len(self.page_fragments) > self.chunk_pages:
+                self.render_chunks(
+                    html_head, html_cover, options, pdfkit_config, output_file
+                )
+            else:
+                temp_html = str(self.workspace_dir / "document.html")
+                self._write_document(
+                    temp_html, html_head + html_cover, self.page_fragments
+                )
+                self._from_file(temp_html, output_file, options, pdfkit_config)
+            print(f"PDF has been generated: {output_file}")
+            self._finish_export()
+        except ExportCancelled:
+            raise
+        except Exception as e:
+            self._render_failed(e)
+
+    def _pdfkit_configuration(self):
+        return pdfkit.configuration(
+            wkhtmltopdf=resolve_wkhtmltopdf(self.wkhtmltopdf_path)
+        )
+
+    def _render_failed(self, error):
+        print(f"Error generating PDF: {str(error)}")
+        print("Please make sure wkhtmltopdf is installed on your system.")
+        print("You can download it from: https://wkhtmltopdf.org/downloads.html")
+
+
+class AsyncGitbookToPDF:
+    """Asyncio-native converter for use inside async services.
+
+    Pages, images and stylesheets are downloaded with aiohttp, Chrome is
+    driven over the DevTools protocol (`AsyncChrome`) and wkhtmltopdf runs
+    as an asyncio subprocess, so an export needs no threads for its I/O and
+    one event loop can run dozens of exports at once. The CPU-bound steps
+    (page extraction, image optimization, counting, merging and stamping
+    PDFs) run in the converter's process pools. Requires the optional
+    aiohttp package.
+
+    `options` are passed to the `GitbookToPDF` that keeps the state of the
+    export (workspace, cache, store, checkpoint and metrics); it is
+    available as `converter` once the exporter is open. Chrome is launched
+    from `chrome_path` when the export first needs it, unless `chrome`, an
+    `AsyncChrome` shared by several exports, is given. Every export works in
+    a browser context of its own, which is discarded when it closes.
+    `browser_pool` is not supported.
+
+    `progress` is called as ``progress(stage, completed, url)`` whenever a
+    page is fetched (``'fetch_page'``), an image is downloaded
+    (``'download_image'``), a page is printed (``'print_to_pdf'``) or a
+    document is rendered (``'render'``); it may be a coroutine function.
+    Cancelling a task awaiting one of the methods stops the export at once;
+    `cancel` stops it at its next request or page and may be called from
+    any thread.
+    """
+
+    PROGRESS_STAGES = ('fetch_page', 'download_image', 'print_to_pdf', 'render')
+
+    def __init__(self, base_url, progress=None, chrome=None, chrome_path=None,
+                 **options):
+        if options.get('browser_pool') is not None:
+            raise ValueError(
+                "AsyncGitbookToPDF does not use a browser pool; pass chrome"
+            )
+        self.base_url = base_url
+        self.progress = progress
+        self.chrome = chrome
+        self.chrome_path = chrome_path
+        self.options = options
+        self.converter = None
+        self._owns_chrome = chrome is None
+        self._loop = None
+        self._completed = {}
+        self._progress_tasks = set()
+        self._session = None
+        self._context = None
+        self._pages = []
+        self._page_slots = None
+        self._image_slots = None
+        self._images = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def open(self):
+        """Create the converter and the HTTP session of the export."""
+        if self.converter is not None:
+            return self.converter
+        if aiohttp is None:
+            raise RuntimeError(
+                "AsyncGitbookToPDF requires aiohttp: pip install aiohttp"
+            )
+        self._loop = asyncio.get_running_loop()
+        options = dict(self.options)
+        metrics = options.pop('metrics', None) or Metrics()
+        metrics.add_hook(self._on_metric)
+        converter = GitbookToPDF(
+            self.base_url, metrics=metrics, start_browser=False, **options
+        )
+        timeout = converter.timeout
+        if not isinstance(timeout, (tuple, list)):
+            timeout = (timeout, timeout)
+        # 页面与图片下载共用同一个连接池，并按主机限制并发连接数
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=converter.concurrency + converter.image_workers,
+                limit_per_host=converter.max_per_host,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=timeout[0], sock_read=timeout[1]
+            ),
+        )
+        self._page_slots = asyncio.Semaphore(converter.concurrency)
+        self._image_slots = asyncio.Semaphore(converter.image_workers)
+        self.converter = converter
+        return converter
+
+    async def crawl(self):
+        """Fetch and extract every page (HTML method and single document).
+
+        The page-by-page print method discovers its pages while rendering,
+        so this only opens the exporter.
+        """
+        converter = await self.open()
+        if converter.method == 'print' and not converter.single_document:
+            return
+        with converter.metrics.timer('get_page_content'):
+            if converter._resume_state is not None:
+                return await self._crawl(self.base_url)
+            urls = None
+            if converter.discover:
+                urls = await run_steps_async(
+                    converter._discovered_urls(self.base_url), self._get
+                )
+            await self._crawl(self.base_url, urls)
+
+    async def render(self, output_file='output.pdf'):
+        """Write the PDF for the pages crawled so far."""
+        converter = await self.open()
+        if converter.single_document:
+            await self._print_document(output_file)
+        elif converter.method == 'print':
+            await self._print_book(output_file)
+        else:
+            await self._render_html(output_file)
+        return output_file
+
+    async def export(self, output_file='output.pdf'):
+        """Crawl and render the book to `output_file`."""
+        await self.crawl()
+        return await self.render(output_file)
+
+    def cancel(self):
+        """Cancel the running export from any thread."""
+        if self.converter is not None:
+            self.converter.cancel()
+
+    async def close(self):
+        """Close the browser context, the HTTP session and the converter."""
+        if self.converter is None:
+            return
+        converter = self.converter
+        self.converter = None
+        for task in self._images.values():
+            task.cancel()
+        self._images = {}
+        try:
+            await self._close_browser()
+        finally:
+            try:
+                await self._session.close()
+            finally:
+                # 关闭进程池、保存缓存和回收存储会阻塞，放到线程中执行
+                await self._loop.run_in_executor(None, converter.close)
+
+    async def _close_browser(self):
+        self._pages = []
+        try:
+            if self._context is not None:
+                context = self._context
+                self._context = None
+                await self.chrome.close_context(context)
+        finally:
+            if self._owns_chrome and self.chrome is not None:
+                chrome = self.chrome
+                self.chrome = None
+                await chrome.close()
+
+    async def _get(self, url):
+        """Issue a GET through the cache like `GitbookToPDF._get`."""
+        if self.converter.cache is not None:
+            return await self.converter.cache.fetch_async(self._send, url)
+        return await self._send(url)
+
+    async def _send(self, url, headers=None):
+        """GET `url` with aiohttp, retrying like `GitbookToPDF._send`.
+
+        The body is read in full into a `BufferedResponse`.
+        """
+        converter = self.converter
+        attempt = 0
+        while True:
+            converter._check_cancelled()
+            await converter.rate_limiter.acquire_async(url)
+            converter.metrics.increment('http_requests')
+            try:
+                async with self._session.get(url, headers=headers) as reply:
+                    response = BufferedResponse(
+                        url, reply.status, await reply.read(), reply.headers
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= converter.retries:
+                    raise
+                delay = retry_delay(attempt)
+                reason = str(e) or type(e).__name__
+            else:
+                if (response.status_code not in RETRY_STATUSES or
+                        attempt >= converter.retries):
+                    converter.metrics.increment(
+                        'http_bytes', len(response.content)
+                    )
+                    return response
+                delay = retry_delay(
+                    attempt,
+                    retry_after=parse_retry_after(
+                        response.headers.get('Retry-After')
+                    ),
+                )
+                reason = f"HTTP {response.status_code}"
+            attempt += 1
+            converter.metrics.increment('http_retries')
+            logging.info(
+                f"Retrying {url} in {delay:.1f}s "
+                f"({attempt}/{converter.retries}): {reason}"
+            )
+            await asyncio.sleep(delay)
+
+    async def _revalidate(self, namespace, url):
+        """Like `GitbookToPDF._revalidate`."""
+        converter = self.converter
+        record, headers = converter._stored_validators(namespace, url)
+        return converter._revalidated(
+            namespace, record, headers, await self._send(url, headers=headers)
+        )
+
+    @asynccontextmanager
+    async def _store_lock(self, namespace, key):
+        """Hold the store's lock for `key` without blocking the event loop."""
+        lock = self.converter.store.lock(namespace, key)
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(STORE_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    async def _in_process(self, function, *args):
+        """Run a CPU-bound module function in the converter's process pool."""
+        return await asyncio.wrap_future(
+            self.converter._parse_pool().submit(function, *args)
+        )
+
+    async def _gather(self, coroutines):
+        """Run `coroutines` concurrently; cancel the rest when one fails."""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _crawl(self, start_url, urls=None):
+        """Crawl like `GitbookToPDF.crawl`, fetching each frontier concurrently."""
+        levels = self.converter._crawl_levels(start_url, urls)
+        try:
+            frontier = next(levels)
+            while True:
+                frontier = levels.send(
+                    await self._gather(self._fetch_page(url) for url in frontier)
+                )
+        except StopIteration:
+            pass
+
+    async def _fetch_page(self, url):
+        """Fetch and extract one page; return None when it fails."""
+        converter = self.converter
+        async with self._page_slots:
+            with converter.metrics.timer('fetch_page', url=url):
+                try:
+                    print(f"Processing: {url}")
+                    response = await self._get(url)
+                    response.raise_for_status()
+                    page, key = converter._reused_page(url, response.content)
+                    if page is None:
+                        page = await self._in_process(
+                            parse_page, response.text, url,
+                            converter.content_selectors,
+                        )
+                        converter._remember_page(url, key, page)
+                    images = converter._page_images(page)
+                    paths = await asyncio.gather(*(
+                        self._fetch_image(img_url) for img_url, _ in images
+                    ))
+                    return converter._finish_page(url, page, images, paths)
+                except ExportCancelled:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error processing {url}: {str(e)}")
+                    return None
+
+    def _fetch_image(self, img_url):
+        """Return the task preparing `img_url`, shared by all pages using it."""
+        task = self._images.get(img_url)
+        if task is None:
+            task = asyncio.ensure_future(self._prepare_image(img_url))
+            self._images[img_url] = task
+        return task
+
+    async def _prepare_image(self, img_url):
+        """Download one image and, when enabled, optimize it."""
+        converter = self.converter
+        async with self._image_slots:
+            img_path = await self._download_image(img_url)
+        if not converter.optimize_images or img_path == img_url:
+            return img_path
+
+        settings, optimized = converter._stored_optimized_image(img_path)
+        if optimized is not None:
+            return optimized
+        try:
+            optimized = await asyncio.wrap_future(
+                converter._optimize_image(img_path)
+            )
+        except Exception as e:
+            logging.error(f"Error optimizing image {img_url}: {str(e)}")
+            return img_path
+        return converter._store_optimized_image(settings, img_path, optimized)
+
+    async def _download_image(self, img_url):
+        """Download an image; return its local path, or the URL on failure."""
+        converter = self.converter
+        try:
+            if converter.store is not None:
+                return await self._download_image_to_store(img_url)
+
+            img_path = converter._downloaded_image(img_url)
+            if img_path is not None:
+                return str(img_path)
+
+            with converter.metrics.timer('download_image', url=img_url):
+                response = await self._get(img_url)
+                response.raise_for_status()
+                img_path = converter._image_path(img_url, response)
+                write_atomic(img_path, response.content)
+            converter.metrics.increment('images_downloaded')
+            converter.metrics.increment('image_bytes', len(response.content))
+            return str(img_path)
 
-    def download_image(self, img_url):
-        """下载图片并转换为base64或保存到本地"""
-        try:
-            img_hash = hashlib.md5(img_url.encode()).hexdigest()
-            extension = os.path.splitext(urlparse(img_url).path)[1]
-            if not extension:
-                response = requests.head(img_url)
-                content_type = response.headers.get('content-type', '')
-                extension = mimetypes.guess_extension(content_type) or '.jpg'
-            
-            img_filename = f"{img_hash}{extension}"
-            img_path = os.path.join(self.image_dir, img_filename)
-            
-            if os.path.exists(img_path):
-                return img_path
-            
-            response = self.session.get(img_url, stream=True)
-            response.raise_for_status()
-            
-            with open(img_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            
-            return img_path
-            
         except Exception as e:
             logging.error(f"Error downloading image {img_url}: {str(e)}")
             return img_url
 
-    def process_images(self, soup, base_url):
-        """处理页面中的所有图片"""
-        for img in soup.find_all('img'):
-            if img.get('src'):
-                img_url = urljoin(base_url, img.get('src'))
-                img_path = self.download_image(img_url)
-                if img_path:
-                    img['src'] = os.path.abspath(img_path)
-
-    def is_same_domain(self, url):
-        """检查URL是否属于同一个域名"""
-        base_domain = urlparse(self.base_url).netloc
-        url_domain = urlparse(url).netloc
-        return base_domain == url_domain
+    async def _download_image_to_store(self, img_url):
+        converter = self.converter
+        store = converter.store
+        async with self._store_lock('image', img_url):
+            with converter.metrics.timer('download_image', url=img_url):
+                record, response = await self._revalidate('image', img_url)
+                if response is None:
+                    return str(store.path(record['blob']))
+                blob = store.add(
+                    response.content, image_extension(img_url, response)
+                )
+            converter.metrics.increment('images_downloaded')
+            converter.metrics.increment('image_bytes', len(response.content))
+            converter._store_response('image', img_url, blob, response)
+            return str(store.path(blob))
 
-    def get_page_content(self, url):
-        """获取页面内容并解析"""
-        if self.method == 'print':
-            return self.print_to_pdf(url, len(self.visited_urls))
+    async def _download_stylesheets(self):
+        """Return the texts of the book's stylesheets for `download_css`."""
+        return await asyncio.gather(*(
+            self._fetch_css(css_url) for css_url in self.converter.css_files
+        ))
 
+    async def _fetch_css(self, css_url):
+        converter = self.converter
         try:
-            print(f"Processing: {url}")
-            response = self.session.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            if not self.title and soup.title:
-                self.title = soup.title.string
-            
-            for css_link in soup.find_all('link', rel='stylesheet'):
-                if css_link.get('href'):
-                    css_url = urljoin(url, css_link.get('href'))
-                    self.css_files.add(css_url)
-            
-            self.process_images(soup, url)
-            
-            content = soup.find('article') or soup.find('main') or soup.find('div', class_='page-inner')
-            if content:
-                title = soup.title.string if soup.title else "Untitled"
-                self.all_content.append(f'<div class="page-break"></div><h1>{title}</h1>')
-                self.all_content.append(str(content))
-            
-            links = soup.find_all('a', href=True)
-            for link in links:
-                next_url = urljoin(url, link['href'])
-                if (next_url not in self.visited_urls and 
-                    self.is_same_domain(next_url) and 
-                    not next_url.startswith('#') and
-                    not next_url.endswith(('.png', '.jpg', '.jpeg', '.gif', '.pdf'))):
-                    self.visited_urls.add(next_url)
-                    self.get_page_content(next_url)
-                    
+            if converter.store is None:
+                response = await self._get(css_url)
+                response.raise_for_status()
+                return response.text
+            async with self._store_lock('stylesheet', css_url):
+                return converter._stored_stylesheet(
+                    css_url, *await self._revalidate('stylesheet', css_url)
+                )
         except Exception as e:
-            logging.error(f"Error processing {url}: {str(e)}")
+            logging.error(f"Error downloading CSS from {css_url}: {str(e)}")
+            return None
 
-    def get_all_links(self, url):
-        """获取页面中的所有链接"""
-        try:
-            self.driver.get(url)
-            time.sleep(2)  # 等待页面加载
-            
-            # 等待内容加载
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
-            
-            # 获取所有链接
-            links = self.driver.find_elements(By.TAG_NAME, "a")
-            urls = []
-            for link in links:
-                href = link.get_attribute('href')
-                if href and self.is_same_domain(href) and href not in self.visited_urls:
-                    urls.append(href)
-            
-            return list(set(urls))  # 去重
+    async def _browser_pages(self, count):
+        """Return `count` tabs in the export's browser context."""
+        if self.chrome is None:
+            self.chrome = await AsyncChrome.launch(self.chrome_path)
+        if self._context is None:
+            self._context = await self.chrome.new_context()
+        while len(self._pages) < count:
+            self._pages.append(await self.chrome.new_page(self._context))
+        return self._pages[:count]
+
+    async def _wait_until_ready(self, page, url):
+        self.converter.readiness_times[url] = await wait_for_page_ready_async(
+            page, timeout=self.converter.ready_timeout
+        )
+
+    async def _get_all_links(self, url):
+        """Like `GitbookToPDF.get_all_links`."""
+        converter = self.converter
+        try:
+            hrefs = await self._http_links(url)
+            if not hrefs:
+                hrefs = await self._browser_links(url)
+            return converter._new_links(hrefs)
         except Exception as e:
             print(f"获取链接时出错: {str(e)}")
             return []
 
-    def download_css(self):
-        """下载所有CSS文件的内容"""
-        css_content = []
-        for css_url in self.css_files:
-            try:
-                css_response = self.session.get(css_url)
-                css_response.raise_for_status()
-                css_content.append(css_response.text)
-            except Exception as e:
-                logging.error(f"Error downloading CSS from {css_url}: {str(e)}")
-        return '\n'.join(css_content)
+    async def _http_links(self, url):
+        try:
+            response = await self._get(url)
+            response.raise_for_status()
+        except Exception as e:
+            logging.info(f"Fetching {url} over HTTP failed: {str(e)}")
+            return []
+        return self.converter._content_links(url, response.text)
 
-    def generate_pdf(self, output_file='output.pdf'):
-        """生成PDF文件"""
-        if self.method == 'print':
-            pdf_files = []
-            self.visited_urls.add(self.base_url)
-            
-            # 处理主页
-            print(f"处理主页: {self.base_url}")
-            main_pdf = self.print_to_pdf(self.base_url, 0)
-            if main_pdf:
-                pdf_files.append(main_pdf)
-            
-            # 获取所有链接
-            urls = self.get_all_links(self.base_url)
-            print(f"找到 {len(urls)} 个子页面")
-            
-            # 处理每个子页面
-            for i, url in enumerate(urls, 1):
-                if url not in self.visited_urls:
-                    print(f"处理页面 {i}/{len(urls)}: {url}")
-                    self.visited_urls.add(url)
-                    pdf_file = self.print_to_pdf(url, i)
-                    if pdf_file:
-                        pdf_files.append(pdf_file)
-                    time.sleep(1)  # 避免请求过快
-            
-            if pdf_files:
-                print(f"合并 {len(pdf_files)} 个 PDF 文件...")
-                self.merge_pdfs(pdf_files, output_file)
-                print(f"PDF 生成完成: {output_file}")
-            
+    async def _browser_links(self, url):
+        """Return every href of the page rendered in Chrome in one call."""
+        converter = self.converter
+        page = (await self._browser_pages(1))[0]
+        if page.url is None or (
+            canonicalize_url(page.url, converter.query_policy) !=
+            canonicalize_url(url, converter.query_policy)
+        ):
+            await converter.rate_limiter.acquire_async(url)
+            await page.get(url)
+            await self._wait_until_ready(page, url)
+        return await page.evaluate(
+            "Array.from(document.querySelectorAll('a[href]'), "
+            "link => link.href)"
+        ) or []
+
+    async def _page_hash(self, url):
+        """Return the content hash of `url`, or None if it cannot be fetched."""
+        try:
+            response = await self._get(url)
+            response.raise_for_status()
+            return hashlib.sha256(response.content).hexdigest()
+        except Exception as e:
+            logging.error(f"Error fetching {url}: {str(e)}")
+            return None
+
+    async def _print_to_pdf(self, url, index, page):
+        """Like `GitbookToPDF.print_to_pdf`, in a tab of the export."""
+        converter = self.converter
+        filepath = os.path.join(converter.temp_dir, f"page_{index:03d}.pdf")
+        content_hash = None
+        if converter.manifest is not None:
+            content_hash = await self._page_hash(url)
+            if converter._reuse_printed_page(url, content_hash, filepath):
+                return filepath
+
+        try:
+            with converter.metrics.timer('print_to_pdf', url=url):
+                await converter.rate_limiter.acquire_async(url)
+                await page.get(url)
+                await self._wait_until_ready(page, url)
+                title = await page.title() or url
+
+                size = await print_to_file_async(
+                    page, filepath, PAGE_PRINT_OPTIONS
+                )
+            return converter._printed_page(
+                url, filepath, title, size, content_hash
+            )
+        except ExportCancelled:
+            raise
+        except Exception as e:
+            print(f"处理 {url} 时出错: {str(e)}")
+            return None
+
+    async def _print_pages(self, jobs):
+        """Print (index, url) jobs, each tab taking the next job when free."""
+        if not jobs:
             return
+        converter = self.converter
+        pages = await self._browser_pages(min(converter.print_workers, len(jobs)))
+        pending = iter(jobs)
 
-        # HTML 方法
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>{self.title}</title>
-            <style>
-                {self.download_css()}
-                @page {{
-                    size: A4;
-                    margin: 2cm 2.5cm;
-                    @top-right {{
-                        content: "{self.title}";
-                        font-size: 9pt;
-                        color: #666;
-                    }}
-                    @bottom-center {{
-                        content: counter(page);
-                        font-size: 10pt;
-                    }}
-                    @bottom-right {{
-                        content: "{current_date}";
-                        font-size: 9pt;
-                        color: #666;
-                    }}
-                }}
-                body {{
-                    font-family: "Arial", sans-serif;
-                    font-size: 11pt;
-                    line-height: 1.6;
-                    max-width: 100%;
-                }}
-                h1 {{
-                    font-size: 20pt;
-                    color: #333;
-                    margin-top: 2em;
-                    page-break-before: always;
-                }}
-                h2 {{
-                    font-size: 16pt;
-                    color: #444;
-                    margin-top: 1.5em;
-                }}
-                h3 {{
-                    font-size: 14pt;
-                    color: #555;
-                }}
-                img {{
-                    max-width: 100%;
-                    height: auto;
-                    margin: 1em 0;
-                }}
-                code {{
-                    font-family: "Consolas", monospace;
-                    background-color: #f5f5f5;
-                    padding: 2px 4px;
-                    border-radius: 3px;
-                }}
-                pre {{
-                    background-color: #f5f5f5;
-                    padding: 1em;
-                    border-radius: 5px;
-                    overflow-x: auto;
-                    font-size: 10pt;
-                }}
-                table {{
-                    width: 100%;
-                    border-collapse: collapse;
-                    margin: 1em 0;
-                }}
-                th, td {{
-                    border: 1px solid #ddd;
-                    padding: 8px;
-                    text-align: left;
-                }}
-                th {{
-                    background-color: #f5f5f5;
-                }}
-                .page-break {{
-                    page-break-before: always;
-                }}
-                a {{
-                    color: #0366d6;
-                    text-decoration: none;
-                }}
-                blockquote {{
-                    border-left: 4px solid #ddd;
-                    margin: 1em 0;
-                    padding-left: 1em;
-                    color: #666;
-                }}
-            </style>
-        </head>
-        <body>
-            <h1 class="cover-title">{self.title}</h1>
-            <div class="generation-date">Generated on {current_date}</div>
-            {''.join(self.all_content)}
-        </body>
-        </html>
-        """
-        
-        temp_html = str(self.workspace_dir / "document.html")
-        with open(temp_html, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        
-        options = {
-            'encoding': 'UTF-8',
-            'page-size': 'A4',
-            'margin-top': '2cm',
-            'margin-right': '2.5cm',
-            'margin-bottom': '2cm',
-            'margin-left': '2.5cm',
-            'header-right': '[title]',
-            'header-font-size': '9',
-            'header-spacing': '10',
-            'footer-center': '[page]',
-            'footer-font-size': '10',
-            'footer-right': current_date,
-            'footer-spacing': '10',
-            'zoom': '1.2',
-            'enable-local-file-access': None,
-            'quiet': ''
-        }
-        
-        wkhtmltopdf_executable = resolve_wkhtmltopdf(
-            self.wkhtmltopdf_path
+        async def work(page):
+            for index, url in pending:
+                converter._check_cancelled()
+                print(f"处理页面 {index}/{len(jobs)}: {url}")
+                converter._record_printed(
+                    index, url, await self._print_to_pdf(url, index, page)
+                )
+
+        await self._gather(work(page) for page in pages)
+
+    async def _print_book(self, output_file):
+        """Print the book page by page, like `GitbookToPDF.generate_pdf`."""
+        converter = self.converter
+        base_url = converter.base_url
+        jobs = converter._resumed_print_jobs()
+        if jobs is None:
+            converter._printed = {}
+            converter.visited_urls.add(base_url)
+
+            print(f"处理主页: {base_url}")
+            page = (await self._browser_pages(1))[0]
+            converter._record_printed(
+                0, base_url, await self._print_to_pdf(base_url, 0, page)
+            )
+
+            urls = None
+            if converter.discover:
+                urls = await run_steps_async(
+                    converter._discovered_urls(base_url), self._get
+                )
+            if urls is None:
+                urls = await self._get_all_links(base_url)
+            jobs = converter._plan_print_jobs(urls)
+        converter._print_jobs = jobs
+        converter._save_checkpoint(converter._print_state(), force=True)
+
+        await self._print_pages([
+            (index, url) for index, url in jobs
+            if index not in converter._printed
+        ])
+        converter._save_checkpoint(converter._print_state(), force=True)
+
+        pdf_files = converter._printed_files(jobs)
+        if pdf_files:
+            print(f"合并 {len(pdf_files)} 个 PDF 文件...")
+            converter._check_cancelled()
+            with converter.metrics.timer('merge_pdfs'):
+                await self._in_process(
+                    merge_pdf_files,
+                    pdf_files,
+                    output_file,
+                    [converter.pdf_titles.get(pdf) for pdf in pdf_files],
+                )
+            remove_files(pdf_files)
+            print(f"PDF 生成完成: {output_file}")
+            converter._finish_export()
+
+    async def _print_local(self, page, html_path, pdf_path, options):
+        """Print a local HTML file in a tab of the export."""
+        converter = self.converter
+        converter._check_cancelled()
+        with converter.metrics.timer('render', path=str(html_path)):
+            await page.get(Path(html_path).resolve().as_uri())
+            await wait_for_page_ready_async(
+                page, timeout=converter.ready_timeout, content_selector=None
+            )
+            await print_to_file_async(page, str(pdf_path), options)
+
+    async def _print_document(self, output_file):
+        """Like `GitbookToPDF.print_document`."""
+        converter = self.converter
+        current_date, html_head, html_cover = converter._document_parts(
+            await self._download_stylesheets()
+        )
+        if (converter.chunk_pages and
+                len(converter.page_fragments) > converter.chunk_pages):
+            await self._print_chunks(
+                html_head, html_cover, current_date, output_file
+            )
+        else:
+            html_path = converter.workspace_dir / "document.html"
+            converter._write_document(
+                html_path, html_head + html_cover, converter.page_fragments
+            )
+            page = (await self._browser_pages(1))[0]
+            await self._print_local(
+                page, html_path, output_file,
+                document_print_options(current_date),
+            )
+        print(f"PDF has been generated: {output_file}")
+        converter._finish_export()
+
+    async def _print_chunks(self, html_head, html_cover, current_date, output_file):
+        converter = self.converter
+        chunk_options = document_print_options(current_date, page_numbers=False)
+        jobs = converter._write_chunks(html_head, html_cover)
+        pages = await self._browser_pages(min(converter.print_workers, len(jobs)))
+        pending = iter(jobs)
+
+        async def work(page):
+            for html_path, pdf_path in pending:
+                await self._print_local(page, html_path, pdf_path, chunk_options)
+
+        print(f"Printing {len(jobs)} chunks in {len(pages)} tabs...")
+        await self._gather(work(page) for page in pages)
+
+        chunk_pdfs = [pdf_path for _, pdf_path in jobs]
+        numbers_pdf = str(converter.workspace_dir / "page_numbers.pdf")
+        await self._print_local(
+            pages[0],
+            converter._write_blank_pages(
+                await self._in_process(count_pdf_pages, chunk_pdfs)
+            ),
+            numbers_pdf,
+            page_number_print_options(),
         )
-        pdfkit_config = pdfkit.configuration(
-            wkhtmltopdf=wkhtmltopdf_executable
+        await self._in_process(
+            stamp_page_numbers, chunk_pdfs, numbers_pdf, output_file
+        )
+
+    async def _render_html(self, output_file):
+        """Render the book with wkhtmltopdf, like `GitbookToPDF.generate_pdf`."""
+        converter = self.converter
+        current_date, html_head, html_cover = converter._document_parts(
+            await self._download_stylesheets()
         )
+        options = wkhtmltopdf_options(current_date)
+        pdfkit_config = converter._pdfkit_configuration()
 
         try:
-            pdfkit.from_file(
-                temp_html,
-                output_file,
-                options=options,
-                configuration=pdfkit_config,
-            )
+            if (converter.chunk_pages and
+                    len(converter.page_fragments) > converter.chunk_pages):
+                await self._render_chunks(
+                    html_head, html_cover, options, pdfkit_config, output_file
+                )
+            else:
+                temp_html = str(converter.workspace_dir / "document.html")
+                converter._write_document(
+                    temp_html, html_head + html_cover, converter.page_fragments
+                )
+                await self._from_file(
+                    temp_html, output_file, options, pdfkit_config
+                )
             print(f"PDF has been generated: {output_file}")
+            converter._finish_export()
+        except ExportCancelled:
+            raise
         except Exception as e:
-            print(f"Error generating PDF: {str(e)}")
-            print("Please make sure wkhtmltopdf is installed on your system.")
-            print("You can download it from: https://wkhtmltopdf.org/downloads.html")
+            converter._render_failed(e)
+
+    async def _from_file(self, html_path, pdf_path, options, pdfkit_config):
+        """Render one HTML file with wkhtmltopdf."""
+        converter = self.converter
+        converter._check_cancelled()
+        with converter.metrics.timer('render', path=str(html_path)):
+            await run_wkhtmltopdf(html_path, pdf_path, options, pdfkit_config)
+
+    async def _render_chunks(self, html_head, html_cover, options, pdfkit_config,
+                             output_file):
+        """Like `GitbookToPDF.render_chunks`, with `render_workers` subprocesses."""
+        converter = self.converter
+        chunk_options = dict(options)
+        chunk_options.pop('footer-center', None)
+        jobs = converter._write_chunks(html_head, html_cover)
+        slots = asyncio.Semaphore(converter.render_workers)
+
+        async def render(html_path, pdf_path):
+            async with slots:
+                await self._from_file(
+                    html_path, pdf_path, chunk_options, pdfkit_config
+                )
+
+        print(f"Rendering {len(jobs)} chunks with {converter.render_workers} workers...")
+        await self._gather(render(*job) for job in jobs)
+
+        chunk_pdfs = [pdf_path for _, pdf_path in jobs]
+        numbers_pdf = str(converter.workspace_dir / "page_numbers.pdf")
+        await self._from_file(
+            str(converter._write_blank_pages(
+                await self._in_process(count_pdf_pages, chunk_pdfs)
+            )),
+            numbers_pdf,
+            wkhtmltopdf_number_options(options),
+            pdfkit_config,
+        )
+        await self._in_process(
+            stamp_page_numbers, chunk_pdfs, numbers_pdf, output_file
+        )
+
+    def _on_metric(self, kind, name, value, labels):
+        if kind != 'timer' or name not in self.PROGRESS_STAGES:
+            return
+        if self.progress is None or self._loop is None:
+            return
+        url = labels.get('url') or labels.get('path')
+        try:
+            self._loop.call_soon_threadsafe(self._report_progress, name, url)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+    def _report_progress(self, stage, url):
+        self._completed[stage] = self._completed.get(stage, 0) + 1
+        result = self.progress(stage, self._completed[stage], url)
+        if asyncio.iscoroutine(result):
+            task = self._loop.create_task(result)
+            self._progress_tasks.add(task)
+            task.add_done_callback(self._progress_tasks.discard)
+
+
+def positive_int(value):
+    """argparse type for integers greater than zero."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
+
+def positive_float(value):
+    """argparse type for numbers greater than zero."""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value}")
+    return number
+
+
+def non_negative_int(value):
+    """argparse type for integers greater than or equal to zero."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            f"expected a non-negative integer, got {value}"
+        )
+    return number
+
+
+def content_selector(value):
+    """argparse type for a selector understood by `compile_selector`."""
+    try:
+        compile_selector(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return value
+
+
+def image_quality(value):
+    """argparse type for an image quality between 1 and 100."""
+    number = int(value)
+    if not 1 <= number <= 100:
+        raise argparse.ArgumentTypeError(
+            f"expected a quality between 1 and 100, got {value}"
+        )
+    return number
+
 
 def build_parser():
     parser = argparse.ArgumentParser(
@@ -513,24 +5067,230 @@ def build_parser():
         metavar='PATH',
         help='Path to wkhtmltopdf for the html method; defaults to PATH',
     )
+    parser.add_argument(
+        '--concurrency',
+        type=positive_int,
+        default=4,
+        metavar='N',
+        help='Number of pages fetched in parallel (default: 4)',
+    )
+    parser.add_argument(
+        '--max-per-host',
+        type=positive_int,
+        metavar='N',
+        help='Maximum parallel requests to one host; defaults to --concurrency',
+    )
+    parser.add_argument(
+        '--rate-limit',
+        type=positive_float,
+        metavar='REQUESTS',
+        help='Maximum requests per second to one host (default: unlimited)',
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        type=positive_float,
+        default=DEFAULT_TIMEOUT[0],
+        metavar='SECONDS',
+        help=f'Connection timeout for HTTP requests (default: {DEFAULT_TIMEOUT[0]})',
+    )
+    parser.add_argument(
+        '--read-timeout',
+        type=positive_float,
+        default=DEFAULT_TIMEOUT[1],
+        metavar='SECONDS',
+        help=f'Read timeout for HTTP requests (default: {DEFAULT_TIMEOUT[1]})',
+    )
+    parser.add_argument(
+        '--retries',
+        type=non_negative_int,
+        default=DEFAULT_RETRIES,
+        metavar='N',
+        help='Retries after a connection error, timeout, 429 or 5xx response, '
+             f'with exponential backoff (default: {DEFAULT_RETRIES})',
+    )
+    parser.add_argument(
+        '--no-discovery',
+        dest='discover',
+        action='store_false',
+        help='Always crawl links instead of reading the GitBook navigation '
+             'and sitemap first',
+    )
+    parser.add_argument(
+        '--query-params',
+        dest='query_policy',
+        choices=QUERY_POLICIES,
+        default='strip-tracking',
+        help='How query strings count when deciding whether two links are '
+             'the same page (default: strip-tracking)',
+    )
+    parser.add_argument(
+        '--content-selector',
+        dest='content_selectors',
+        action='append',
+        type=content_selector,
+        metavar='SELECTOR',
+        help='Element holding the page content, e.g. "div.markdown-body"; '
+             'repeat in priority order (default: article, main, '
+             'div.page-inner)',
+    )
+    parser.add_argument(
+        '--parse-workers',
+        type=positive_int,
+        metavar='N',
+        help='Number of processes parsing pages for the HTML method '
+             '(default: the number of CPUs)',
+    )
+    parser.add_argument(
+        '--keep-unused-css',
+        dest='prune_css',
+        action='store_false',
+        help='Do not drop style rules that match nothing in the extracted '
+             'pages',
+    )
+    parser.add_argument(
+        '--metrics-out',
+        metavar='PATH',
+        help='Write per-stage timings, counters and per-page latencies of '
+             'the export to PATH',
+    )
+    parser.add_argument(
+        '--metrics-format',
+        choices=('json', 'prometheus'),
+        default='json',
+        help='Format of --metrics-out (default: json)',
+    )
+    parser.add_argument(
+        '--work-dir',
+        metavar='PATH',
+        help='Keep intermediate files and a progress checkpoint in PATH '
+             'instead of a temporary directory',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted export from the checkpoint in --work-dir',
+    )
+    parser.add_argument(
+        '--image-workers',
+        type=positive_int,
+        metavar='N',
+        help='Number of parallel image downloads; defaults to --concurrency',
+    )
+    parser.add_argument(
+        '--max-image-dpi',
+        type=positive_int,
+        metavar='DPI',
+        help='Downscale images wider than the A4 text width at this DPI '
+             '(requires Pillow)',
+    )
+    parser.add_argument(
+        '--image-quality',
+        type=image_quality,
+        metavar='1-100',
+        help='Recompress images at this JPEG quality (requires Pillow; '
+             f'default with --max-image-dpi: {DEFAULT_IMAGE_QUALITY})',
+    )
+    parser.add_argument(
+        '--chunk-pages',
+        type=positive_int,
+        metavar='N',
+        help='Render the html method in chunks of N pages on parallel '
+             'wkhtmltopdf processes',
+    )
+    parser.add_argument(
+        '--render-workers',
+        type=positive_int,
+        metavar='N',
+        help='Number of parallel wkhtmltopdf processes for --chunk-pages; '
+             'defaults to the CPU count',
+    )
+    parser.add_argument(
+        '--print-workers',
+        type=positive_int,
+        default=1,
+        metavar='N',
+        help='Number of Chrome instances printing pages in parallel (default: 1)',
+    )
+    parser.add_argument(
+        '--single-document',
+        action='store_true',
+        help='With the print method, print the whole book as one Chrome '
+             'document instead of printing and merging every page',
+    )
+    parser.add_argument(
+        '--ready-timeout',
+        type=positive_float,
+        default=10,
+        metavar='SECONDS',
+        help='Longest wait for a page to finish loading in Chrome (default: 10)',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='PATH',
+        help='Persistent HTTP cache for pages, stylesheets and images',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=positive_int,
+        default=DEFAULT_CACHE_SIZE_MB,
+        metavar='MB',
+        help=f'Size limit of --cache-dir in MB (default: {DEFAULT_CACHE_SIZE_MB})',
+    )
+    parser.add_argument(
+        '--store-dir',
+        metavar='PATH',
+        help='Content store shared between exports of related books; images, '
+             'stylesheets and extracted pages in it are reused',
+    )
     return parser
 
 
 def main(argv=None):
     parser = build_parser()
     args = parser.parse_args(argv)
+    if args.resume and not args.work_dir:
+        parser.error("--resume requires --work-dir")
 
     try:
         with GitbookToPDF(
             args.url,
             method=args.method,
             wkhtmltopdf_path=args.wkhtmltopdf,
+            concurrency=args.concurrency,
+            max_per_host=args.max_per_host,
+            rate_limit=args.rate_limit,
+            timeout=(args.connect_timeout, args.read_timeout),
+            retries=args.retries,
+            print_workers=args.print_workers,
+            image_workers=args.image_workers,
+            max_image_dpi=args.max_image_dpi,
+            image_quality=args.image_quality,
+            chunk_pages=args.chunk_pages,
+            render_workers=args.render_workers,
+            discover=args.discover,
+            query_policy=args.query_policy,
+            content_selectors=args.content_selectors,
+            parse_workers=args.parse_workers,
+            prune_css=args.prune_css,
+            single_document=args.single_document,
+            ready_timeout=args.ready_timeout,
+            cache_dir=args.cache_dir,
+            cache_size_mb=args.cache_size,
+            store_dir=args.store_dir,
+            work_dir=args.work_dir,
+            resume=args.resume,
         ) as converter:
-            print("Starting to crawl the GitBook...")
-            if args.method == 'html':
-                converter.get_page_content(args.url)
-            print("Generating PDF...")
-            converter.generate_pdf(args.output)
+            try:
+                print("Starting to crawl the GitBook...")
+                if args.method == 'html' or args.single_document:
+                    converter.get_page_content(args.url)
+                print("Generating PDF...")
+                converter.generate_pdf(args.output)
+            finally:
+                if args.metrics_out:
+                    converter.write_metrics(
+                        args.metrics_out, args.metrics_format
+                    )
     except (FileNotFoundError, RuntimeError) as error:
         parser.exit(1, f"Error: {error}\n")
 
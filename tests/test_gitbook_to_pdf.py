@@ -1,13 +1,19 @@
+import asyncio
 import io
+import json
 import os
+import re
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
-from contextlib import contextmanager, redirect_stderr
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from pathlib import Path
 from unittest.mock import Mock, patch
+from urllib.parse import urlparse
 
 import gitbook_to_pdf
 
@@ -25,6 +31,34 @@ def working_directory(path):
         os.chdir(previous)
 
 
+def fake_site(pages):
+    """Return a session.get replacement serving the given HTML pages."""
+    def get(url, **kwargs):
+        response = Mock()
+        response.text = pages[url]
+        response.content = pages[url].encode("utf-8")
+        response.raise_for_status = Mock()
+        return response
+
+    return get
+
+
+def read_fragments(converter):
+    return [
+        Path(fragment).read_text(encoding="utf-8")
+        for fragment in converter.page_fragments
+    ]
+
+
+def link_page(title, *hrefs):
+    links = "".join(f'<a href="{href}">{href}</a>' for href in hrefs)
+    return (
+        f"<html><head><title>{title}</title></head>"
+        f"<body><nav>{links}</nav><article>{title} body</article></body>"
+        "</html>"
+    )
+
+
 class ImportIsolationTests(unittest.TestCase):
     def test_import_does_not_configure_wkhtmltopdf(self):
         code = """
@@ -147,6 +181,7 @@ class ConversionMethodIsolationTests(unittest.TestCase):
                     method="print",
                 )
                 converter.print_to_pdf = Mock(return_value=None)
+                converter.discover_urls = Mock(return_value=None)
                 converter.get_all_links = Mock(return_value=[])
                 converter.generate_pdf("output.pdf")
                 converter.close()
@@ -228,6 +263,2127 @@ class TemporaryWorkspaceTests(unittest.TestCase):
 
         self.assertFalse(workspace.exists())
 
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_close_quits_drivers_when_cache_save_fails(self, setup_driver):
+        setup_driver.return_value.quit.side_effect = RuntimeError(
+            "quit failed"
+        )
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com",
+            method="print",
+        )
+        converter.cache = Mock()
+        converter.cache.save.side_effect = OSError("disk full")
+        workspace = Path(converter.workspace_dir)
+
+        with self.assertRaisesRegex(OSError, "disk full"):
+            converter.close()
+
+        setup_driver.return_value.quit.assert_called_once_with()
+        self.assertIsNone(converter.driver)
+        self.assertFalse(workspace.exists())
+
+
+def page_state(**overrides):
+    state = {
+        "readyState": "complete",
+        "fonts": True,
+        "images": True,
+        "resources": 3,
+        "content": True,
+    }
+    state.update(overrides)
+    return {"result": {"value": state}}
+
+
+class PageReadinessTests(unittest.TestCase):
+    def driver_with_states(self, *states):
+        driver = Mock()
+        driver.execute_cdp_cmd.side_effect = (
+            list(states) + [states[-1]] * 1000
+        )
+        return driver
+
+    def test_settled_page_is_ready_after_the_idle_window(self):
+        driver = self.driver_with_states(page_state())
+
+        waited = gitbook_to_pdf.wait_for_page_ready(
+            driver, idle_time=0.05, poll_interval=0.01
+        )
+
+        self.assertGreaterEqual(waited, 0.05)
+        self.assertLess(waited, 1)
+        self.assertEqual(
+            driver.execute_cdp_cmd.call_args.args[0], "Runtime.evaluate"
+        )
+
+    def test_waits_for_loading_images_and_fonts(self):
+        driver = self.driver_with_states(
+            page_state(readyState="interactive"),
+            page_state(images=False),
+            page_state(fonts=False),
+            page_state(),
+        )
+
+        gitbook_to_pdf.wait_for_page_ready(
+            driver, idle_time=0, poll_interval=0
+        )
+
+        self.assertEqual(driver.execute_cdp_cmd.call_count, 4)
+
+    def test_resources_are_counted_past_the_timing_buffer_limit(self):
+        driver = self.driver_with_states(
+            *[page_state(resources=count) for count in (249, 250, 251)],
+        )
+
+        gitbook_to_pdf.wait_for_page_ready(
+            driver, idle_time=0.02, poll_interval=0
+        )
+
+        expression = driver.execute_cdp_cmd.call_args.args[1]["expression"]
+        self.assertIn("setResourceTimingBufferSize", expression)
+        self.assertIn("PerformanceObserver", expression)
+        self.assertGreater(driver.execute_cdp_cmd.call_count, 3)
+
+    def test_gives_up_after_the_timeout(self):
+        driver = self.driver_with_states(page_state(readyState="loading"))
+
+        with self.assertLogs(level="WARNING"):
+            waited = gitbook_to_pdf.wait_for_page_ready(
+                driver, timeout=0.05, poll_interval=0.01
+            )
+
+        self.assertGreaterEqual(waited, 0.05)
+
+    @patch("gitbook_to_pdf.wait_for_page_ready", return_value=0.25)
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_print_records_readiness_time(self, setup_driver, wait):
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com",
+            method="print",
+            ready_timeout=3,
+        )
+        self.addCleanup(converter.close)
+        converter.driver.execute_cdp_cmd.return_value = {"data": ""}
+
+        with redirect_stdout(io.StringIO()):
+            converter.print_to_pdf("https://example.com/page", 1)
+
+        wait.assert_called_once_with(converter.driver, timeout=3)
+        self.assertEqual(
+            converter.readiness_times, {"https://example.com/page": 0.25}
+        )
+
+
+class BrowserPoolTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch(
+            "gitbook_to_pdf.setup_chrome_driver",
+            side_effect=lambda **kwargs: Mock(name="driver"),
+        )
+        self.setup_driver = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pool(self, **kwargs):
+        pool = gitbook_to_pdf.BrowserPool(**kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_drivers_are_started_warm_without_installing(self):
+        pool = self.pool(size=2)
+
+        self.assertEqual(self.setup_driver.call_count, 2)
+        self.setup_driver.assert_called_with(
+            allow_install=False, driver_path=None, incognito=True
+        )
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNone(pool.acquire(block=False))
+        self.assertIsNot(first, second)
+        self.assertEqual(self.setup_driver.call_count, 2)
+
+    def test_started_drivers_are_quit_when_a_warm_start_fails(self):
+        started = []
+        calls = iter(range(3))
+
+        def start(**kwargs):
+            if next(calls) == 0:
+                raise gitbook_to_pdf.WebDriverException("no chrome")
+            driver = Mock(name="driver")
+            started.append(driver)
+            return driver
+
+        self.setup_driver.side_effect = start
+
+        with self.assertRaises(gitbook_to_pdf.WebDriverException):
+            gitbook_to_pdf.BrowserPool(size=3)
+
+        self.assertEqual(len(started), 2)
+        for driver in started:
+            driver.quit.assert_called_once_with()
+
+    def test_released_drivers_are_reset_and_reused(self):
+        pool = self.pool(size=1)
+        driver = pool.acquire()
+        driver.current_url = "https://docs.example.com/page"
+
+        pool.release(driver, pages=3, origins={"https://example.com"})
+
+        commands = [call.args[0] for call in driver.execute_cdp_cmd.call_args_list]
+        self.assertIn("Network.clearBrowserCookies", commands)
+        cleared = [
+            call.args[1]["origin"]
+            for call in driver.execute_cdp_cmd.call_args_list
+            if call.args[0] == "Storage.clearDataForOrigin"
+        ]
+        self.assertEqual(
+            cleared, ["https://docs.example.com", "https://example.com"]
+        )
+        driver.get.assert_called_with("about:blank")
+        self.assertIs(pool.acquire(), driver)
+
+    @patch("gitbook_to_pdf.browser_memory")
+    def test_drivers_over_the_memory_limit_are_recycled(self, memory):
+        pool = self.pool(size=1, max_memory_mb=512)
+        driver = pool.acquire()
+        memory.side_effect = lambda measured: (
+            600 * 2**20 if measured is driver else 100 * 2**20
+        )
+
+        pool.release(driver)
+
+        memory.assert_any_call(driver)
+        driver.quit.assert_called_once_with()
+        self.assertIsNot(pool.acquire(timeout=5), driver)
+        self.assertEqual(pool.recycled, 1)
+
+    def test_drivers_are_recycled_after_max_pages(self):
+        pool = self.pool(size=1, max_pages=5)
+        driver = pool.acquire()
+
+        pool.release(driver, pages=5)
+
+        driver.quit.assert_called_once_with()
+        replacement = pool.acquire(timeout=5)
+        self.assertIsNot(replacement, driver)
+        self.assertEqual(pool.recycled, 1)
+
+    def test_unresponsive_drivers_are_replaced(self):
+        pool = self.pool(size=1)
+        broken = pool.acquire()
+        pool.release(broken)
+        broken.execute_script.side_effect = gitbook_to_pdf.WebDriverException()
+
+        driver = pool.acquire()
+
+        self.assertIsNot(driver, broken)
+        broken.quit.assert_called_once_with()
+
+    def test_exports_borrow_and_return_pooled_drivers(self):
+        pool = self.pool(size=1)
+        driver = pool.acquire()
+        pool.release(driver)
+
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", method="print", browser_pool=pool
+        ) as converter:
+            self.assertIs(converter.driver, driver)
+            self.assertIsNone(pool.acquire(block=False))
+            converter._load(driver, "https://Example.com:443/a")
+
+        driver.quit.assert_not_called()
+        driver.execute_cdp_cmd.assert_any_call(
+            "Storage.clearDataForOrigin",
+            {"origin": "https://example.com", "storageTypes": "all"},
+        )
+        self.assertIs(pool.acquire(block=False), driver)
+        self.assertEqual(self.setup_driver.call_count, 1)
+
+
+class ChromeDriverSetupTests(unittest.TestCase):
+    @patch("gitbook_to_pdf.webdriver.Chrome")
+    @patch("gitbook_to_pdf.ChromeDriverManager")
+    def test_runtime_install_can_be_disabled(self, manager, chrome):
+        with patch("gitbook_to_pdf.shutil.which", return_value=None):
+            with self.assertRaisesRegex(RuntimeError, "chromedriver"):
+                gitbook_to_pdf.setup_chrome_driver(allow_install=False)
+
+        with patch(
+            "gitbook_to_pdf.shutil.which", return_value="/usr/bin/chromedriver"
+        ):
+            gitbook_to_pdf.setup_chrome_driver(allow_install=False)
+
+        manager.assert_not_called()
+        chrome.assert_called_once()
+        self.assertEqual(
+            chrome.call_args.kwargs["service"].path, "/usr/bin/chromedriver"
+        )
+
+
+class PrintLinkDiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("gitbook_to_pdf.setup_chrome_driver")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", method="print"
+        )
+        self.addCleanup(self.converter.close)
+
+    def test_server_rendered_pages_skip_chrome(self):
+        self.converter.session.get = Mock(side_effect=fake_site({
+            "https://example.com/": link_page(
+                "Home", "/a", "/a#part", "/b", "https://other.org/"
+            ),
+        }))
+
+        links = self.converter.get_all_links("https://example.com/")
+
+        self.assertEqual(
+            links, ["https://example.com/a", "https://example.com/b"]
+        )
+        self.converter.driver.get.assert_not_called()
+        self.converter.driver.execute_script.assert_not_called()
+
+    @patch("gitbook_to_pdf.wait_for_page_ready", return_value=0)
+    def test_client_rendered_pages_use_one_script_call(self, wait):
+        self.converter.session.get = Mock(side_effect=fake_site({
+            "https://example.com/": "<html><body><div id='app'></div></body></html>",
+        }))
+        self.converter.driver.execute_script.return_value = [
+            "https://example.com/a",
+            "https://example.com/a/",
+            "https://example.com/b",
+        ]
+
+        links = self.converter.get_all_links("https://example.com/")
+
+        self.assertEqual(
+            links, ["https://example.com/a", "https://example.com/b"]
+        )
+        self.converter.driver.get.assert_called_once_with("https://example.com/")
+        self.assertEqual(self.converter.driver.execute_script.call_count, 1)
+        self.converter.driver.find_elements.assert_not_called()
+
+
+class PDFStreamTests(unittest.TestCase):
+    def streaming_driver(self, chunks):
+        replies = iter(chunks)
+
+        def execute_cdp_cmd(command, params):
+            if command == "Page.printToPDF":
+                return {"stream": "stream-1"}
+            if command == "IO.read":
+                reply = next(replies)
+                if isinstance(reply, Exception):
+                    raise reply
+                return reply
+            return {}
+
+        return Mock(execute_cdp_cmd=Mock(side_effect=execute_cdp_cmd))
+
+    def test_pdf_is_copied_from_the_stream_in_chunks(self):
+        driver = self.streaming_driver([
+            {"data": "JVBERi0x", "base64Encoded": True, "eof": False},
+            {"data": "LjQK", "base64Encoded": True, "eof": True},
+        ])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "page.pdf")
+
+            size = gitbook_to_pdf.print_to_file(
+                driver, path, {"scale": 1}, chunk_size=6
+            )
+
+            self.assertEqual(Path(path).read_bytes(), b"%PDF-1.4\n")
+        self.assertEqual(size, 9)
+        calls = driver.execute_cdp_cmd.call_args_list
+        self.assertEqual(
+            calls[0].args,
+            ("Page.printToPDF", {"scale": 1, "transferMode": "ReturnAsStream"}),
+        )
+        self.assertEqual(calls[1].args[1], {"handle": "stream-1", "size": 6})
+        self.assertEqual(calls[-1].args, ("IO.close", {"handle": "stream-1"}))
+
+    def test_failed_streams_are_closed_and_leave_no_file(self):
+        driver = self.streaming_driver([
+            {"data": "JVBERi0x", "base64Encoded": True, "eof": False},
+            gitbook_to_pdf.WebDriverException("tab crashed"),
+        ])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "page.pdf")
+
+            with self.assertRaises(gitbook_to_pdf.WebDriverException):
+                gitbook_to_pdf.print_to_file(driver, path, {})
+
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(
+            driver.execute_cdp_cmd.call_args.args,
+            ("IO.close", {"handle": "stream-1"}),
+        )
+
+
+class PrintWorkerTests(unittest.TestCase):
+    @patch("gitbook_to_pdf.time.sleep")
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_pages_are_printed_in_parallel_and_merged_in_order(
+        self,
+        setup_driver,
+        sleep,
+    ):
+        setup_driver.side_effect = lambda: Mock()
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com",
+            method="print",
+            print_workers=3,
+        )
+        urls = [f"https://example.com/{index}" for index in range(1, 8)]
+        used_drivers = set()
+        all_workers_started = threading.Barrier(3)
+
+        def print_to_pdf(url, index, driver=None):
+            if driver is not None and driver not in used_drivers:
+                used_drivers.add(driver)
+                all_workers_started.wait(timeout=5)
+            return f"page_{index:03d}.pdf"
+
+        converter.print_to_pdf = Mock(side_effect=print_to_pdf)
+        converter.discover_urls = Mock(return_value=None)
+        converter.get_all_links = Mock(return_value=urls)
+        converter.merge_pdfs = Mock()
+        with redirect_stdout(io.StringIO()):
+            converter.generate_pdf("output.pdf")
+        drivers = [converter.driver] + converter._extra_drivers
+        converter.close()
+
+        merged = converter.merge_pdfs.call_args.args[0]
+        self.assertEqual(
+            merged,
+            [f"page_{index:03d}.pdf" for index in range(8)],
+        )
+        self.assertEqual(setup_driver.call_count, 3)
+        self.assertEqual(used_drivers, set(drivers))
+        for driver in drivers:
+            driver.quit.assert_called_once_with()
+
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_started_drivers_are_quit_when_another_fails_to_start(
+        self,
+        setup_driver,
+    ):
+        started = []
+        calls = iter(range(4))
+
+        def start():
+            if next(calls) == 1:
+                raise gitbook_to_pdf.WebDriverException("no chrome")
+            driver = Mock()
+            started.append(driver)
+            return driver
+
+        setup_driver.side_effect = start
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com", method="print", print_workers=4
+        )
+
+        with self.assertRaises(gitbook_to_pdf.WebDriverException):
+            converter._start_print_drivers(4)
+        converter.close()
+
+        self.assertEqual(len(started), 3)
+        for driver in started:
+            driver.quit.assert_called_once_with()
+
+    def test_print_workers_must_be_positive(self):
+        with self.assertRaisesRegex(ValueError, "at least 1"):
+            gitbook_to_pdf.GitbookToPDF(
+                "https://example.com", print_workers=0
+            )
+
+
+def http_response(status_code=200, content=b"", headers=None):
+    response = Mock()
+    response.status_code = status_code
+    response.content = content
+    response.headers = headers or {}
+    response.raise_for_status = Mock()
+    return response
+
+
+class HTTPCacheTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = Path(directory.name)
+
+    def test_revalidates_and_serves_not_modified_bodies_from_disk(self):
+        cache = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        get = Mock(return_value=http_response(
+            content=b"body {}",
+            headers={"content-type": "text/css", "etag": '"v1"'},
+        ))
+        first = cache.fetch(get, "https://example.com/a.css")
+        cache.save()
+
+        reopened = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        get = Mock(return_value=http_response(status_code=304))
+        second = reopened.fetch(get, "https://example.com/a.css")
+
+        self.assertEqual(first.text, "body {}")
+        self.assertEqual(second.content, b"body {}")
+        self.assertEqual(second.headers["Content-Type"], "text/css")
+        self.assertEqual(
+            get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'}
+        )
+        self.assertEqual((reopened.hits, reopened.misses), (1, 0))
+
+    def test_changed_bodies_replace_the_cached_copy(self):
+        cache = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        cache.fetch(
+            Mock(return_value=http_response(
+                content=b"old",
+                headers={"last-modified": "Mon, 01 Jan 2024 00:00:00 GMT"},
+            )),
+            "https://example.com/",
+        )
+        get = Mock(return_value=http_response(content=b"new"))
+
+        response = cache.fetch(get, "https://example.com/")
+
+        self.assertEqual(response.content, b"new")
+        self.assertEqual(
+            get.call_args.kwargs["headers"],
+            {"If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"},
+        )
+
+    def test_least_recently_used_bodies_are_evicted(self):
+        cache = gitbook_to_pdf.HTTPCache(self.cache_dir, max_bytes=10)
+        for name in ("a", "b", "c"):
+            cache.fetch(
+                Mock(return_value=http_response(content=name.encode() * 4)),
+                f"https://example.com/{name}",
+            )
+
+        stored = sorted(
+            path.read_bytes()
+            for path in (self.cache_dir / "objects").rglob("*")
+            if path.is_file()
+        )
+        self.assertEqual(stored, [b"bbbb", b"cccc"])
+        self.assertEqual(
+            sorted(cache._entries),
+            ["https://example.com/b", "https://example.com/c"],
+        )
+
+    def test_index_is_saved_while_bodies_are_stored(self):
+        cache = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        cache.SAVE_INTERVAL = 0
+
+        cache.fetch(
+            Mock(return_value=http_response(content=b"body")),
+            "https://example.com/a",
+        )
+
+        reopened = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        self.assertEqual(list(reopened._entries), ["https://example.com/a"])
+
+    def test_unindexed_bodies_are_removed_on_load(self):
+        cache = gitbook_to_pdf.HTTPCache(self.cache_dir)
+        cache.fetch(
+            Mock(return_value=http_response(content=b"kept")),
+            "https://example.com/a",
+        )
+        cache.save()
+        orphan = cache.object_path("ab" * 32)
+        orphan.parent.mkdir(exist_ok=True)
+        orphan.write_bytes(b"left by a crash")
+        recent = cache.object_path("cd" * 32)
+        recent.parent.mkdir(exist_ok=True)
+        recent.write_bytes(b"another process")
+        old = time.time() - gitbook_to_pdf.HTTPCache.ORPHAN_AGE - 1
+        os.utime(orphan, (old, old))
+
+        gitbook_to_pdf.HTTPCache(self.cache_dir)
+
+        self.assertFalse(orphan.exists())
+        self.assertTrue(recent.exists())
+        self.assertEqual(
+            cache.object_path(cache._entries["https://example.com/a"]["hash"])
+            .read_bytes(),
+            b"kept",
+        )
+
+    def test_converter_routes_requests_through_the_cache(self):
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/",
+            cache_dir=str(self.cache_dir),
+        )
+        converter.session.get = Mock(return_value=http_response(
+            content=link_page("Home").encode(),
+            headers={"content-type": "text/html; charset=utf-8"},
+        ))
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/")
+        fragments = read_fragments(converter)
+        converter.close()
+
+        self.assertIn("<article>Home body</article>", fragments[0])
+        self.assertTrue((self.cache_dir / "index.json").is_file())
+
+
+class HTTPClientTests(unittest.TestCase):
+    def setUp(self):
+        self.converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", retries=2
+        )
+        self.addCleanup(self.converter.close)
+        patcher = patch("gitbook_to_pdf.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(
+            self.converter._cancelled, "wait", return_value=False
+        )
+        self.backoff = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_use_the_configured_timeouts(self):
+        self.converter.session.get = Mock(return_value=http_response())
+
+        self.converter._get("https://example.com/")
+
+        self.assertEqual(
+            self.converter.session.get.call_args.kwargs["timeout"],
+            gitbook_to_pdf.DEFAULT_TIMEOUT,
+        )
+
+    def test_throttled_and_failing_responses_are_retried(self):
+        self.converter.session.get = Mock(side_effect=[
+            http_response(429, headers={"Retry-After": "7"}),
+            gitbook_to_pdf.requests.ConnectionError("reset"),
+            http_response(200, b"ok"),
+        ])
+
+        response = self.converter._get("https://example.com/")
+
+        self.assertEqual(response.content, b"ok")
+        self.assertEqual(self.converter.session.get.call_count, 3)
+        delays = [call.args[0] for call in self.backoff.call_args_list]
+        self.assertEqual(delays[0], 7)
+        self.assertLessEqual(delays[1], 2 * gitbook_to_pdf.DEFAULT_BACKOFF)
+
+    def test_last_response_is_returned_once_retries_run_out(self):
+        self.converter.session.get = Mock(return_value=http_response(503))
+
+        response = self.converter._get("https://example.com/")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.converter.session.get.call_count, 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.converter.session.get = Mock(return_value=http_response(404))
+
+        self.converter._get("https://example.com/")
+
+        self.assertEqual(self.converter.session.get.call_count, 1)
+        self.backoff.assert_not_called()
+
+    def test_retry_after_accepts_http_dates(self):
+        self.assertEqual(
+            gitbook_to_pdf.parse_retry_after(
+                "Thu, 01 Jan 1970 00:01:00 GMT", now=30
+            ),
+            30,
+        )
+        self.assertIsNone(gitbook_to_pdf.parse_retry_after("soon"))
+
+    def test_rate_limiter_spaces_requests_per_host(self):
+        clock = [100.0]
+        self.sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds
+        )
+        limiter = gitbook_to_pdf.HostRateLimiter(rate=2)
+
+        with patch("gitbook_to_pdf.time.monotonic", lambda: clock[0]):
+            for _ in range(3):
+                limiter.acquire("https://example.com/page")
+            limiter.acquire("https://other.org/")
+
+        self.assertAlmostEqual(clock[0], 101.0)
+
+
+    def test_host_slots_are_shared_by_spellings_of_one_host(self):
+        with self.converter._host_slot("https://Example.com:443/a"):
+            pass
+        with self.converter._host_slot("https://example.com/b"):
+            pass
+
+        self.assertEqual(list(self.converter._host_slots), ["example.com"])
+
+class ImageDownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", image_workers=4
+        )
+        self.addCleanup(self.converter.close)
+
+    def image_response(self, content_type="image/png"):
+        response = http_response(headers={"content-type": content_type})
+        response.iter_content = Mock(return_value=[b"image-bytes"])
+        return response
+
+    @patch("gitbook_to_pdf.requests.head")
+    def test_extension_comes_from_the_get_response(self, head):
+        self.converter.session.get = Mock(
+            return_value=self.image_response("image/png; charset=binary")
+        )
+
+        path = self.converter.download_image("https://cdn.example.com/image")
+
+        head.assert_not_called()
+        self.assertTrue(path.endswith(".png"))
+        self.assertEqual(Path(path).read_bytes(), b"image-bytes")
+        self.assertEqual(
+            self.converter.download_image("https://cdn.example.com/image"),
+            path,
+        )
+        self.assertEqual(self.converter.session.get.call_count, 1)
+
+    def test_concurrent_requests_for_one_image_are_collapsed(self):
+        release = threading.Event()
+
+        def get(url, **kwargs):
+            release.wait(timeout=5)
+            return self.image_response()
+
+        self.converter.session.get = Mock(side_effect=get)
+        futures = [
+            self.converter.fetch_image("https://cdn.example.com/a.png")
+            for _ in range(5)
+        ]
+        release.set()
+
+        self.assertEqual(len({future.result() for future in futures}), 1)
+        self.assertEqual(self.converter.session.get.call_count, 1)
+
+    def fetch_page(self, html, get_image):
+        def get(url, **kwargs):
+            if url == "https://example.com/page":
+                response = http_response(content=html.encode())
+                response.text = html
+                return response
+            return get_image(url, **kwargs)
+
+        self.converter.session.get = Mock(side_effect=get)
+        with redirect_stdout(io.StringIO()):
+            page = self.converter._fetch_page("https://example.com/page")
+        return Path(page["fragment"]).read_text(encoding="utf-8")
+
+    def test_sources_are_rewritten_after_downloads_finish(self):
+        fragment = self.fetch_page(
+            '<article><img src="/a.png"><img src="/b.png"><img src="/a.png">'
+            "</article>",
+            lambda url, **kwargs: self.image_response(),
+        )
+
+        sources = re.findall(r'src="([^"]+)"', fragment)
+        self.assertEqual(sources[0], sources[2])
+        self.assertNotEqual(sources[0], sources[1])
+        self.assertTrue(all(os.path.isabs(source) for source in sources))
+        self.assertEqual(self.converter.session.get.call_count, 3)
+
+    def test_failed_downloads_keep_the_original_source(self):
+        def get_image(url, **kwargs):
+            raise OSError("offline")
+
+        with self.assertLogs(level="ERROR"):
+            fragment = self.fetch_page(
+                '<article><img src="https://cdn.example.com/a.png"></article>',
+                get_image,
+            )
+
+        self.assertIn('src="https://cdn.example.com/a.png"', fragment)
+
+
+@unittest.skipIf(gitbook_to_pdf.Image is None, "Pillow is not installed")
+class ImageOptimizationTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def save_image(self, name, mode, size, **kwargs):
+        path = self.directory / name
+        image = gitbook_to_pdf.Image.new(mode, size, color="red")
+        image.save(path, **kwargs)
+        return str(path)
+
+    def test_wide_images_are_downscaled_to_jpeg(self):
+        source = self.save_image("wide.png", "RGB", (4000, 1000))
+
+        optimized = gitbook_to_pdf.optimize_image(
+            source, self.directory / "optimized", max_width=1000, quality=80
+        )
+
+        self.assertTrue(optimized.endswith(".jpg"))
+        with gitbook_to_pdf.Image.open(optimized) as image:
+            self.assertEqual(image.size, (1000, 250))
+            self.assertNotIn("exif", image.info)
+
+    def test_exif_orientation_is_applied_before_it_is_dropped(self):
+        exif = gitbook_to_pdf.Image.Exif()
+        exif[0x0112] = 6  # rotate 90° clockwise for display
+        source = self.save_image(
+            "photo.jpg", "RGB", (400, 100), exif=exif.tobytes()
+        )
+
+        optimized = gitbook_to_pdf.optimize_image(
+            source, self.directory / "optimized", max_width=1000
+        )
+
+        self.assertNotEqual(optimized, source)
+        with gitbook_to_pdf.Image.open(optimized) as image:
+            self.assertEqual(image.size, (100, 400))
+            self.assertNotIn(0x0112, image.getexif())
+
+    def test_transparent_images_stay_png(self):
+        source = self.save_image("alpha.png", "RGBA", (3000, 300))
+
+        optimized = gitbook_to_pdf.optimize_image(
+            source, self.directory / "optimized", max_width=600
+        )
+
+        self.assertTrue(optimized.endswith(".png"))
+        with gitbook_to_pdf.Image.open(optimized) as image:
+            self.assertEqual(image.mode, "RGBA")
+
+    def test_results_are_cached_by_content_and_settings(self):
+        source = self.save_image("wide.png", "RGB", (2000, 100))
+        output_dir = self.directory / "optimized"
+
+        first = gitbook_to_pdf.optimize_image(source, output_dir, 500)
+        with patch.object(gitbook_to_pdf.Image, "open") as image_open:
+            second = gitbook_to_pdf.optimize_image(source, output_dir, 500)
+
+        self.assertEqual(first, second)
+        image_open.assert_not_called()
+
+    def test_unreadable_images_are_returned_unchanged(self):
+        source = self.directory / "image.svg"
+        source.write_text("<svg></svg>")
+
+        with self.assertLogs(level="WARNING"):
+            result = gitbook_to_pdf.optimize_image(
+                str(source), self.directory / "optimized", 500
+            )
+
+        self.assertEqual(result, str(source))
+
+    def test_converter_optimizes_downloaded_images(self):
+        with open(self.save_image("big.png", "RGB", (4000, 400)), "rb") as f:
+            content = f.read()
+        response = http_response(headers={"content-type": "image/png"})
+        response.iter_content = Mock(return_value=[content])
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", max_image_dpi=100
+        ) as converter:
+            converter.session.get = Mock(return_value=response)
+            path = converter.fetch_image("https://example.com/a.png").result()
+            with gitbook_to_pdf.Image.open(path) as image:
+                size = image.size
+
+        self.assertEqual(size[0], round(gitbook_to_pdf.A4_CONTENT_WIDTH_INCHES * 100))
+
+    def test_optimized_images_are_kept_in_the_cache_dir(self):
+        with open(self.save_image("big.png", "RGB", (4000, 400)), "rb") as f:
+            content = f.read()
+        response = http_response(
+            content=content, headers={"content-type": "image/png"}
+        )
+        cache_dir = self.directory / "cache"
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", max_image_dpi=100, cache_dir=cache_dir
+        ) as converter:
+            converter.session.get = Mock(return_value=response)
+            path = converter.fetch_image("https://example.com/a.png").result()
+
+        self.assertEqual(Path(path).parent, cache_dir / "optimized")
+        self.assertTrue(Path(path).exists())
+
+    @patch("gitbook_to_pdf.Image", None)
+    def test_missing_pillow_disables_optimization(self):
+        with self.assertLogs(level="WARNING"):
+            converter = gitbook_to_pdf.GitbookToPDF(
+                "https://example.com/", image_quality=70
+            )
+        converter.close()
+
+        self.assertFalse(converter.optimize_images)
+
+
+class IncrementalRebuildTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = directory.name
+
+    def serve(self, converter, pages):
+        converter.session.get = Mock(side_effect=lambda url, **kwargs: (
+            http_response(content=pages[url].encode())
+        ))
+
+    def export_html(self, pages):
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", cache_dir=self.cache_dir, discover=False
+        ) as converter:
+            self.serve(converter, pages)
+            with redirect_stdout(io.StringIO()):
+                converter.get_page_content("https://example.com/")
+            return read_fragments(converter), converter.manifest.reused
+
+    def test_unchanged_html_pages_reuse_their_fragments(self):
+        pages = {
+            "https://example.com/": link_page("Home", "/a"),
+            "https://example.com/a": link_page("A"),
+        }
+        first_content, _ = self.export_html(pages)
+
+        pages["https://example.com/a"] = link_page("A2")
+        with patch(
+            "gitbook_to_pdf.new_process_pool",
+            gitbook_to_pdf.ThreadPoolExecutor,
+        ), patch(
+            "gitbook_to_pdf.BeautifulSoup",
+            wraps=gitbook_to_pdf.BeautifulSoup,
+        ) as parser:
+            second_content, reused = self.export_html(pages)
+
+        self.assertEqual(reused, 1)
+        self.assertEqual(parser.call_count, 1)
+        self.assertEqual(second_content[0], first_content[0])
+        self.assertIn("<article>A2 body</article>", second_content[1])
+
+    def test_images_of_reused_fragments_are_revalidated(self):
+        pages = {
+            "https://example.com/": (
+                "<html><head><title>Home</title></head><body><article>"
+                '<img src="/logo.png"></article></body></html>'
+            ),
+        }
+        fragments = []
+        for body in (b"OLD-IMAGE", b"NEW-IMAGE"):
+            image_requests = []
+
+            def get(url, **kwargs):
+                if url.endswith(".png"):
+                    image_requests.append(kwargs.get("headers", {}))
+                    return http_response(
+                        content=body, headers={"etag": body.decode()}
+                    )
+                return http_response(content=pages[url].encode())
+
+            with gitbook_to_pdf.GitbookToPDF(
+                "https://example.com/", cache_dir=self.cache_dir,
+                discover=False,
+            ) as converter:
+                converter.session.get = Mock(side_effect=get)
+                with redirect_stdout(io.StringIO()):
+                    converter.get_page_content("https://example.com/")
+                fragment = read_fragments(converter)[0]
+                image = re.search(r'src="([^"]+)"', fragment).group(1)
+                fragments.append(Path(image).read_bytes())
+                reused = converter.manifest.reused
+
+        self.assertEqual(reused, 1)
+        self.assertEqual(image_requests, [{"If-None-Match": "OLD-IMAGE"}])
+        self.assertEqual(fragments, [b"OLD-IMAGE", b"NEW-IMAGE"])
+
+    def test_interrupted_exports_keep_the_manifest(self):
+        pages = {
+            "https://example.com/": link_page("Home", "/a"),
+            "https://example.com/a": link_page("A"),
+        }
+        self.export_html(pages)
+        manifest = gitbook_to_pdf.BuildManifest(self.cache_dir, "manifest-html")
+        artifacts = sorted(manifest.artifacts_dir.iterdir())
+
+        del pages["https://example.com/a"]
+        pages["https://example.com/"] = link_page("Home")
+        self.export_html(pages)
+
+        self.assertEqual(sorted(manifest.artifacts_dir.iterdir()), artifacts)
+        reopened = gitbook_to_pdf.BuildManifest(self.cache_dir, "manifest-html")
+        self.assertIn("https://example.com/a", reopened._records)
+
+    @patch("gitbook_to_pdf.pdfkit.from_file")
+    @patch("gitbook_to_pdf.pdfkit.configuration")
+    @patch("gitbook_to_pdf.resolve_wkhtmltopdf")
+    def test_completed_exports_drop_pages_that_disappeared(
+        self, resolve, configuration, from_file,
+    ):
+        pages = {
+            "https://example.com/": link_page("Home", "/a"),
+            "https://example.com/a": link_page("A"),
+        }
+        self.export_html(pages)
+
+        pages["https://example.com/"] = link_page("Home")
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", cache_dir=self.cache_dir, discover=False
+        ) as converter:
+            self.serve(converter, pages)
+            converter.download_css = Mock(return_value="")
+            with redirect_stdout(io.StringIO()):
+                converter.get_page_content("https://example.com/")
+                converter.generate_pdf(os.path.join(self.cache_dir, "out.pdf"))
+
+        manifest = gitbook_to_pdf.BuildManifest(self.cache_dir, "manifest-html")
+        self.assertEqual(list(manifest._records), ["https://example.com/"])
+        self.assertEqual(len(list(manifest.artifacts_dir.iterdir())), 1)
+
+    @patch("gitbook_to_pdf.wait_for_page_ready", return_value=0)
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_unchanged_print_pages_are_not_rendered_again(
+        self,
+        setup_driver,
+        wait,
+    ):
+        setup_driver.side_effect = lambda: Mock(
+            title="A",
+            execute_cdp_cmd=Mock(return_value={"data": "JVBERi0="}),
+        )
+        pages = {"https://example.com/a": link_page("A")}
+        outputs = []
+        for _ in range(2):
+            with gitbook_to_pdf.GitbookToPDF(
+                "https://example.com/",
+                method="print",
+                cache_dir=self.cache_dir,
+            ) as converter:
+                self.serve(converter, pages)
+                with redirect_stdout(io.StringIO()):
+                    path = converter.print_to_pdf("https://example.com/a", 1)
+                outputs.append(Path(path).read_bytes())
+                driver = converter.driver
+
+        driver.get.assert_not_called()
+        self.assertEqual(outputs, [b"%PDF-", b"%PDF-"])
+        self.assertEqual(list(converter.pdf_titles.values()), ["A"])
+
+
+def shared_asset_page(title):
+    return (
+        f"<html><head><title>{title}</title>"
+        '<link rel="stylesheet" href="https://cdn.example.com/theme.css">'
+        "</head><body><article>"
+        f'<h2>{title}</h2><img src="https://cdn.example.com/logo.png">'
+        "</article></body></html>"
+    )
+
+
+class ContentStoreTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store_dir = Path(directory.name)
+        self.requests = []
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.assets = {
+            "https://cdn.example.com/logo.png": b"logo-bytes",
+            "https://cdn.example.com/theme.css": b"h2 { color: red }",
+        }
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            self.requests.append(url)
+        if url in self.assets:
+            body = self.assets[url]
+            etag = f'"{len(body)}-{body[:4].hex()}"'
+            if kwargs.get("headers", {}).get("If-None-Match") == etag:
+                return http_response(status_code=304)
+            with self.lock:
+                self.transfers.append(url)
+            response = http_response(content=body, headers={"etag": etag})
+            response.text = body.decode()
+            response.iter_content = Mock(return_value=[body])
+            return response
+        host = urlparse(url).netloc
+        response = http_response(content=shared_asset_page(host).encode())
+        response.text = shared_asset_page(host)
+        return response
+
+    def export(self, base_url, metrics=None):
+        with gitbook_to_pdf.GitbookToPDF(
+            base_url, store_dir=self.store_dir, discover=False, metrics=metrics
+        ) as converter:
+            converter.session.get = Mock(side_effect=self.get)
+            with redirect_stdout(io.StringIO()):
+                converter.get_page_content(base_url)
+                css = converter.download_css()
+            return read_fragments(converter), css
+
+    def test_related_books_transfer_shared_assets_once(self):
+        first, first_css = self.export("https://a.example.com/")
+        second, second_css = self.export("https://b.example.com/")
+
+        self.assertEqual(
+            sorted(self.transfers),
+            ["https://cdn.example.com/logo.png", "https://cdn.example.com/theme.css"],
+        )
+        image = re.search(r'src="([^"]+)"', first[0]).group(1)
+        self.assertIn(f'src="{image}"', second[0])
+        self.assertEqual(Path(image).read_bytes(), b"logo-bytes")
+        self.assertEqual(first_css, second_css)
+        self.assertIn("color:red", second_css)
+
+    def test_unchanged_pages_are_not_extracted_again(self):
+        self.export("https://a.example.com/")
+        metrics = gitbook_to_pdf.Metrics()
+        with patch(
+            "gitbook_to_pdf.new_process_pool",
+            gitbook_to_pdf.ThreadPoolExecutor,
+        ), patch(
+            "gitbook_to_pdf.BeautifulSoup",
+            wraps=gitbook_to_pdf.BeautifulSoup,
+        ) as parser:
+            fragments, _ = self.export("https://a.example.com/", metrics)
+
+        parser.assert_not_called()
+        self.assertIn("<h2>a.example.com</h2>", fragments[0])
+        self.assertEqual(metrics.counters["store_hits"], 3)
+        self.assertNotIn("store_misses", metrics.counters)
+
+    def test_changed_assets_are_revalidated_and_replaced(self):
+        self.export("https://a.example.com/")
+        self.assets["https://cdn.example.com/theme.css"] = b"h2 { color: blue }"
+        self.assets["https://cdn.example.com/logo.png"] = b"new-logo"
+
+        fragments, css = self.export("https://a.example.com/")
+
+        self.assertIn("color:blue", css)
+        image = re.search(r'src="([^"]+)"', fragments[0]).group(1)
+        self.assertEqual(Path(image).read_bytes(), b"new-logo")
+        self.assertEqual(len(self.transfers), 4)
+
+    def test_garbage_collection_keeps_referenced_blobs(self):
+        first = gitbook_to_pdf.ContentStore(self.store_dir, grace_period=0)
+        shared = first.add(b"shared", ".png")
+        first.set("image", "https://cdn.example.com/shared.png", shared)
+        first.save_ref("book-a")
+        second = gitbook_to_pdf.ContentStore(self.store_dir, grace_period=0)
+        second.add(b"shared", ".png")
+        only = second.add(b"only in b", ".png")
+        second.set("image", "https://cdn.example.com/b.png", only)
+        second.save_ref("book-b")
+
+        store = gitbook_to_pdf.ContentStore(self.store_dir, grace_period=0)
+        self.assertEqual(store.reference_counts(), {shared: 2, only: 1})
+        self.assertEqual(store.collect_garbage(force=True), 0)
+
+        gitbook_to_pdf.ContentStore(self.store_dir).save_ref("book-b")
+        self.assertEqual(store.collect_garbage(force=True), 1)
+        self.assertTrue(store.path(shared).exists())
+        self.assertFalse(store.path(only).exists())
+        self.assertIsNone(store.get("image", "https://cdn.example.com/b.png"))
+        self.assertEqual(
+            store.get("image", "https://cdn.example.com/shared.png")["blob"],
+            shared,
+        )
+
+    def test_recently_used_blobs_survive_collection(self):
+        store = gitbook_to_pdf.ContentStore(self.store_dir)
+        blob = store.add(b"in use by a running export")
+
+        self.assertEqual(store.collect_garbage(), 0)
+        self.assertTrue(store.path(blob).exists())
+
+    def test_collection_runs_at_most_once_per_interval(self):
+        store = gitbook_to_pdf.ContentStore(self.store_dir, grace_period=0)
+        self.assertEqual(store.collect_garbage(), 0)
+        blob = store.add(b"unreferenced")
+        os.utime(store.path(blob), (0, 0))
+
+        self.assertIsNone(store.collect_garbage())
+        self.assertTrue(store.path(blob).exists())
+        self.assertEqual(store.collect_garbage(force=True), 1)
+
+    def test_locks_exclude_other_holders_and_collection_does_not_wait(self):
+        store = gitbook_to_pdf.ContentStore(self.store_dir)
+        with store.lock("image", "https://cdn.example.com/a.png"):
+            other = store.lock("image", "https://cdn.example.com/a.png")
+            self.assertFalse(other.acquire(blocking=False))
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+        with gitbook_to_pdf.FileLock(self.store_dir / "gc.lock"):
+            self.assertIsNone(store.collect_garbage())
+
+
+class URLCanonicalizationTests(unittest.TestCase):
+    def test_variants_of_one_page_share_a_canonical_form(self):
+        variants = [
+            "https://Docs.Example.com/guide/page",
+            "https://docs.example.com:443/guide/page#install",
+            "https://docs.example.com/guide/page/",
+            "HTTPS://docs.example.com/guide/page?utm_source=x&fbclid=1",
+        ]
+
+        self.assertEqual(
+            {gitbook_to_pdf.canonicalize_url(url) for url in variants},
+            {"https://docs.example.com/guide/page"},
+        )
+
+    def test_query_policies(self):
+        url = "https://example.com/search?b=2&utm_medium=x&a=1"
+
+        self.assertEqual(
+            gitbook_to_pdf.canonicalize_url(url),
+            "https://example.com/search?a=1&b=2",
+        )
+        self.assertEqual(
+            gitbook_to_pdf.canonicalize_url(url, query_policy="drop"),
+            "https://example.com/search",
+        )
+        self.assertEqual(
+            gitbook_to_pdf.canonicalize_url(url, query_policy="keep"),
+            url,
+        )
+        with self.assertRaisesRegex(ValueError, "unknown query policy"):
+            gitbook_to_pdf.canonicalize_url(url, query_policy="other")
+
+    def test_root_and_trailing_slash_policy(self):
+        self.assertEqual(
+            gitbook_to_pdf.canonicalize_url("http://example.com:8080"),
+            "http://example.com:8080/",
+        )
+        self.assertEqual(
+            gitbook_to_pdf.canonicalize_url(
+                "https://example.com/dir/", trailing_slash=True
+            ),
+            "https://example.com/dir/",
+        )
+
+    def test_visited_index_round_trips_through_a_file(self):
+        index = gitbook_to_pdf.VisitedIndex()
+        self.assertTrue(index.add("https://example.com/a#top"))
+        self.assertFalse(index.add("https://EXAMPLE.com/a/"))
+        index.add("https://example.com/b")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "visited.idx"
+            index.save(path)
+            self.assertEqual(path.stat().st_size, 16)
+            restored = gitbook_to_pdf.VisitedIndex()
+            restored.load(path)
+
+        self.assertEqual(restored, index)
+        self.assertIn("https://example.com/b?utm_campaign=x", restored)
+
+    def test_fragment_links_are_fetched_once(self):
+        pages = {
+            "https://example.com/": link_page(
+                "Home", "/a#one", "/a#two", "/a/", "/a?utm_source=x", "#top"
+            ),
+            "https://example.com/a": link_page("A", "/#intro"),
+        }
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", discover=False
+        )
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site(pages))
+
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/")
+
+        self.assertEqual(
+            [call.args[0] for call in converter.session.get.call_args_list],
+            ["https://example.com/", "https://example.com/a"],
+        )
+
+
+class PageExtractionTests(unittest.TestCase):
+    PAGE = (
+        "<html><head><title>Guide</title>"
+        '<link rel="stylesheet" href="/style.css">'
+        '<link rel="icon" href="/favicon.ico"></head>'
+        '<body><nav><a href="/a">A</a><img src="/logo.png"></nav>'
+        '<div class="page-inner wide"><p>Inner</p></div>'
+        '<main><img src="img/chart.png"><a href="b#top">B</a></main>'
+        "</body></html>"
+    )
+
+    def test_everything_is_collected_in_one_pass(self):
+        page = gitbook_to_pdf.PageExtractor().extract(
+            self.PAGE, "https://example.com/guide/"
+        )
+
+        self.assertEqual(page["title"], "Guide")
+        self.assertEqual(page["stylesheets"], ["https://example.com/style.css"])
+        self.assertEqual(
+            page["links"],
+            ["https://example.com/a", "https://example.com/guide/b#top"],
+        )
+        self.assertEqual(page["content"].name, "main")
+        self.assertEqual(
+            [url for _, url in page["images"]],
+            ["https://example.com/guide/img/chart.png"],
+        )
+
+    def test_selectors_are_tried_in_priority_order(self):
+        page = gitbook_to_pdf.PageExtractor(
+            ["section", "div.page-inner", "main"]
+        ).extract(self.PAGE, "https://example.com/")
+
+        self.assertEqual(page["content"].get_text(), "Inner")
+        self.assertEqual(page["images"], [])
+
+    def test_compiled_selectors(self):
+        soup = gitbook_to_pdf.BeautifulSoup(
+            '<div id="x" class="a b" data-testid="page.contentEditor"></div>',
+            "html.parser",
+        )
+        for selector in (
+            "div", "#x", ".a.b", "div#x.b", "[data-testid]",
+            '[data-testid="page.contentEditor"]', "[class='a b']",
+        ):
+            with self.subTest(selector=selector):
+                self.assertTrue(gitbook_to_pdf.compile_selector(selector)(soup.div))
+        for selector in ("span", ".c", '[data-testid="nav"]'):
+            with self.subTest(selector=selector):
+                self.assertFalse(gitbook_to_pdf.compile_selector(selector)(soup.div))
+        for selector in ("", "div > p", "a:hover"):
+            with self.subTest(selector=selector):
+                with self.assertRaises(ValueError):
+                    gitbook_to_pdf.compile_selector(selector)
+
+    def test_parsed_pages_carry_image_placeholders(self):
+        page = gitbook_to_pdf.parse_page(
+            '<article><img src="a.png?x=1&amp;y=2"><img src="/b.png"></article>',
+            "https://example.com/guide/",
+        )
+
+        self.assertEqual(page["images"], [
+            ("https://example.com/guide/a.png?x=1&y=2", "a.png?x=1&y=2"),
+            ("https://example.com/b.png", "/b.png"),
+        ])
+        self.assertNotIn("a.png", page["content"])
+        self.assertEqual(
+            gitbook_to_pdf.localize_content(
+                page["content"], ["a.png?x=1&y=2", "/tmp/b.png"]
+            ),
+            '<article><img src="a.png?x=1&amp;y=2"/>'
+            '<img src="/tmp/b.png"/></article>',
+        )
+
+    def test_only_content_images_are_downloaded(self):
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/")
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site({
+            "https://example.com/": self.PAGE,
+        }))
+        converter.fetch_image = Mock(side_effect=lambda url: Mock(
+            result=Mock(return_value="/tmp/chart.png")
+        ))
+
+        page = converter._fetch_page("https://example.com/")
+
+        converter.fetch_image.assert_called_once_with(
+            "https://example.com/img/chart.png"
+        )
+        self.assertIn('src="/tmp/chart.png"', Path(page["fragment"]).read_text())
+
+
+class DiscoveryTests(unittest.TestCase):
+    def discover(self, pages):
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/book/")
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site(pages))
+        with redirect_stdout(io.StringIO()):
+            return converter, converter.discover_urls(
+                "https://example.com/book/"
+            )
+
+    def test_sidebar_order_comes_first_then_sitemap_pages(self):
+        home = (
+            "<html><body><header><nav><a href='/about'>About</a></nav>"
+            "</header><aside><nav>"
+            "<a href='intro'>Intro</a><a href='setup#install'>Setup</a>"
+            "<a href='usage'>Usage</a></nav></aside></body></html>"
+        )
+        sitemap = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            "<url><loc>https://example.com/book/usage</loc></url>"
+            "<url><loc>https://example.com/book/faq</loc></url>"
+            "<url><loc>https://example.com/blog/post</loc></url>"
+            "</urlset>"
+        )
+        _, urls = self.discover({
+            "https://example.com/book/": home,
+            "https://example.com/book/sitemap.xml": sitemap,
+        })
+
+        self.assertEqual(
+            urls,
+            [
+                "https://example.com/book/",
+                "https://example.com/book/intro",
+                "https://example.com/book/setup",
+                "https://example.com/book/usage",
+                "https://example.com/book/faq",
+            ],
+        )
+
+    def test_sitemap_indexes_and_legacy_summary_are_followed(self):
+        index = (
+            "<sitemapindex><sitemap><loc>https://example.com/pages.xml</loc>"
+            "</sitemap></sitemapindex>"
+        )
+        pages = (
+            "<urlset><url><loc>https://example.com/book/extra.html</loc>"
+            "</url></urlset>"
+        )
+        summary = "# Summary\n* [Intro](README.md)\n* [One](chapter/one.md)\n"
+        _, urls = self.discover({
+            "https://example.com/book/": "<html><body></body></html>",
+            "https://example.com/book/SUMMARY.md": summary,
+            "https://example.com/robots.txt": (
+                "Sitemap: https://example.com/index.xml\n"
+            ),
+            "https://example.com/index.xml": index,
+            "https://example.com/pages.xml": pages,
+        })
+
+        self.assertEqual(
+            urls,
+            [
+                "https://example.com/book/",
+                "https://example.com/book/chapter/one.html",
+                "https://example.com/book/extra.html",
+            ],
+        )
+
+    def test_missing_metadata_falls_back_to_crawling(self):
+        _, urls = self.discover({
+            "https://example.com/book/": "<html><body>Hello</body></html>",
+        })
+
+        self.assertIsNone(urls)
+
+    def test_discovered_pages_are_fetched_without_following_links(self):
+        pages = {
+            "https://example.com/book/": link_page("Home", "a", "b"),
+            "https://example.com/book/a": link_page("A", "hidden"),
+            "https://example.com/book/b": link_page("B"),
+        }
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/book/")
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site(pages))
+
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/book/")
+
+        self.assertEqual(len(converter.page_fragments), 3)
+        self.assertNotIn(
+            "https://example.com/book/hidden", converter.visited_urls
+        )
+
+
+class CrawlTests(unittest.TestCase):
+    SITE = {
+        "https://example.com/": link_page("Home", "/a", "/b"),
+        "https://example.com/a": link_page("A", "/", "/a1", "/b"),
+        "https://example.com/b": link_page("B", "/b1", "https://other.org/"),
+        "https://example.com/a1": link_page("A1", "/a"),
+        "https://example.com/b1": link_page("B1", "/image.png"),
+    }
+
+    def crawl(self, concurrency, pages=None):
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/",
+            method="html",
+            concurrency=concurrency,
+            discover=False,
+        )
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site(pages or self.SITE))
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/")
+        return converter
+
+    def test_pages_are_ordered_by_discovery_path(self):
+        converter = self.crawl(concurrency=1)
+
+        self.assertEqual(
+            read_fragments(converter),
+            [
+                f'<div class="page-break"></div><h1>{name}</h1>'
+                f"<article>{name} body</article>"
+                for name in ("Home", "A", "A1", "B", "B1")
+            ],
+        )
+        self.assertEqual(converter.title, "Home")
+
+    def test_order_does_not_depend_on_worker_count(self):
+        serial = self.crawl(concurrency=1)
+        parallel = self.crawl(concurrency=8)
+
+        self.assertEqual(read_fragments(serial), read_fragments(parallel))
+        self.assertEqual(serial.visited_urls, parallel.visited_urls)
+
+    def test_deep_chains_do_not_recurse(self):
+        depth = sys.getrecursionlimit() + 100
+        pages = {
+            f"https://example.com/{index}": link_page(
+                str(index), f"/{index + 1}"
+            )
+            for index in range(depth)
+        }
+        pages[f"https://example.com/{depth}"] = link_page(str(depth))
+
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/0", method="html", discover=False
+        )
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site(pages))
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/0")
+
+        self.assertEqual(len(converter.visited_urls), depth + 1)
+
+    def test_concurrency_must_be_positive(self):
+        with self.assertRaisesRegex(ValueError, "at least 1"):
+            gitbook_to_pdf.GitbookToPDF("https://example.com", concurrency=0)
+
+
+class CSSOptimizationTests(unittest.TestCase):
+    CSS = """
+        @charset "utf-8";
+        /* theme { } */
+        body, .book-summary a { color: red ; }
+        .markdown-section  >  p:hover , a.link::before { content: "; } "; }
+        html.dark .markdown-section { color: white }
+        @media print { .book-summary { display: none } p { margin: 0 auto } }
+        @font-face { font-family: X; src: url(data:font/woff;base64,AA==) }
+        .md\\:flex, div :not(.missing) { display: flex }
+    """
+
+    def usage(self):
+        usage = gitbook_to_pdf.CSSUsage()
+        usage.add_html(
+            '<div class="markdown-section md:flex"><p>Hi</p>'
+            '<a class="link" href="#">x</a></div>'
+        )
+        return usage
+
+    def test_unused_rules_are_pruned_and_the_rest_minified(self):
+        self.assertEqual(
+            gitbook_to_pdf.optimize_css(self.CSS, self.usage()),
+            '@charset "utf-8";'
+            "body{color:red}"
+            '.markdown-section>p:hover,a.link::before{content:"; } "}'
+            "@media print{p{margin:0 auto}}"
+            "@font-face{font-family:X;src:url(data:font/woff;base64,AA==)}"
+            ".md\\:flex,div :not(.missing){display:flex}",
+        )
+
+    def test_without_usage_every_rule_is_kept(self):
+        css = gitbook_to_pdf.optimize_css(self.CSS)
+
+        self.assertIn("html.dark .markdown-section{color:white}", css)
+        self.assertIn("@media print{.book-summary{display:none}", css)
+
+    def test_stylesheets_are_fetched_once_per_content(self):
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/")
+        self.addCleanup(converter.close)
+        sheets = {
+            "https://example.com/theme.css": ".x { color: red }",
+            "https://cdn.example.com/theme.css": ".x { color: red }",
+            "https://example.com/site.css": "p { margin: 0 }",
+        }
+        converter.css_files.update(dict.fromkeys(sheets))
+        converter.session.get = Mock(side_effect=fake_site(sheets))
+        converter.prune_css = False
+
+        with redirect_stdout(io.StringIO()):
+            css = converter.download_css()
+
+        self.assertEqual(css, ".x{color:red}p{margin:0}")
+        self.assertEqual(converter.session.get.call_count, 3)
+
+
+class StreamingAssemblyTests(unittest.TestCase):
+    @patch("gitbook_to_pdf.pdfkit.from_file")
+    @patch("gitbook_to_pdf.pdfkit.configuration")
+    @patch("gitbook_to_pdf.resolve_wkhtmltopdf")
+    def test_document_is_assembled_from_fragment_files(
+        self,
+        resolve,
+        configuration,
+        from_file,
+    ):
+        documents = []
+        from_file.side_effect = lambda source, *args, **kwargs: (
+            documents.append(Path(source).read_text(encoding="utf-8"))
+        )
+        pages = {
+            "https://example.com/": link_page("Home", "/a"),
+            "https://example.com/a": link_page("A"),
+        }
+        with gitbook_to_pdf.GitbookToPDF("https://example.com/") as converter:
+            converter.session.get = Mock(side_effect=fake_site(pages))
+            converter.download_css = Mock(return_value="")
+            with redirect_stdout(io.StringIO()):
+                converter.get_page_content("https://example.com/")
+                converter.generate_pdf("output.pdf")
+            fragment_files = sorted(converter.fragment_dir.iterdir())
+
+        self.assertEqual(len(fragment_files), 2)
+        document = documents[0]
+        self.assertLess(
+            document.index("<article>Home body</article>"),
+            document.index("<article>A body</article>"),
+        )
+        self.assertTrue(document.rstrip().endswith("</html>"))
+
+
+class AsyncAPITests(unittest.TestCase):
+    PAGES = {
+        "https://example.com/": link_page("Home", "/a"),
+        "https://example.com/a": link_page("A"),
+    }
+
+    @patch("gitbook_to_pdf.pdfkit.from_file")
+    @patch("gitbook_to_pdf.pdfkit.configuration")
+    @patch("gitbook_to_pdf.resolve_wkhtmltopdf")
+    def test_export_reports_progress(self, resolve, configuration, from_file):
+        events = []
+
+        async def progress(stage, completed, url):
+            events.append((stage, completed, url))
+
+        async def export():
+            async with gitbook_to_pdf.AsyncGitbookToPDF(
+                "https://example.com/", progress=progress, discover=False
+            ) as exporter:
+                exporter.converter.session.get = Mock(
+                    side_effect=fake_site(self.PAGES)
+                )
+                exporter.converter.download_css = Mock(return_value="")
+                return await exporter.export("book.pdf")
+
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(asyncio.run(export()), "book.pdf")
+
+        self.assertEqual(from_file.call_args.args[1], "book.pdf")
+        self.assertEqual(
+            sorted(event for event in events if event[0] == "fetch_page"),
+            [
+                ("fetch_page", 1, "https://example.com/"),
+                ("fetch_page", 2, "https://example.com/a"),
+            ],
+        )
+        self.assertEqual([event[:2] for event in events][-1], ("render", 1))
+
+    @patch("gitbook_to_pdf.print_to_file")
+    @patch("gitbook_to_pdf.wait_for_page_ready")
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_single_document_export_crawls_before_printing(
+        self, setup_driver, wait, print_to_file,
+    ):
+        setup_driver.side_effect = lambda *args, **kwargs: Mock()
+
+        def printed(driver, path, options, chunk_size=None):
+            html = Path(driver.get.call_args.args[0][len("file://"):])
+            self.assertIn("<article>A body</article>", html.read_text("utf-8"))
+            write_blank_pdf(path, 1)
+
+        print_to_file.side_effect = printed
+
+        async def export(output):
+            async with gitbook_to_pdf.AsyncGitbookToPDF(
+                "https://example.com/", method="print", single_document=True,
+                discover=False,
+            ) as exporter:
+                exporter.converter.session.get = Mock(
+                    side_effect=fake_site(self.PAGES)
+                )
+                exporter.converter.download_css = Mock(return_value="")
+                await exporter.export(output)
+                return exporter.converter.page_fragments
+
+        with tempfile.TemporaryDirectory() as directory:
+            with redirect_stdout(io.StringIO()):
+                fragments = asyncio.run(export(os.path.join(directory, "b.pdf")))
+
+        self.assertEqual(len(fragments), 2)
+        print_to_file.assert_called_once()
+
+    def test_cancelling_the_task_stops_the_crawl(self):
+        entered = threading.Event()
+        release = threading.Event()
+        site = fake_site(self.PAGES)
+
+        def slow_get(url, **kwargs):
+            entered.set()
+            release.wait(5)
+            return site(url, **kwargs)
+
+        async def export():
+            exporter = gitbook_to_pdf.AsyncGitbookToPDF(
+                "https://example.com/", discover=False
+            )
+            converter = await exporter.open()
+            converter.session.get = Mock(side_effect=slow_get)
+            task = asyncio.ensure_future(exporter.export("book.pdf"))
+            while not entered.is_set():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            asyncio.get_running_loop().call_later(0.05, release.set)
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await exporter.close()
+            return converter
+
+        with redirect_stdout(io.StringIO()):
+            converter = asyncio.run(export())
+
+        self.assertTrue(converter._cancelled.is_set())
+        self.assertEqual(converter.session.get.call_count, 1)
+        self.assertEqual(converter.page_fragments, [])
+
+    @patch("gitbook_to_pdf.pdfkit.from_file")
+    @patch("gitbook_to_pdf.pdfkit.configuration")
+    @patch("gitbook_to_pdf.resolve_wkhtmltopdf")
+    def test_cancelling_during_render_raises(
+        self, resolve, configuration, from_file,
+    ):
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/")
+        self.addCleanup(converter.close)
+        converter.download_css = Mock(return_value="")
+
+        def render(*args, **kwargs):
+            converter.cancel()
+            converter._check_cancelled()
+
+        from_file.side_effect = render
+
+        with redirect_stdout(io.StringIO()) as output:
+            with self.assertRaises(gitbook_to_pdf.ExportCancelled):
+                converter.generate_pdf("book.pdf")
+
+        self.assertNotIn("wkhtmltopdf is installed", output.getvalue())
+
+
+def write_blank_pdf(path, pages):
+    writer = gitbook_to_pdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+class StreamingMergeTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def blank_pdf(self, name, pages, width=595):
+        path = self.directory / name
+        writer = gitbook_to_pdf.PdfWriter()
+        for _ in range(pages):
+            writer.add_blank_page(width=width, height=842)
+        with open(path, "wb") as f:
+            writer.write(f)
+        return str(path)
+
+    def test_pages_are_concatenated_with_an_outline(self):
+        files = [
+            self.blank_pdf("a.pdf", 1, width=100),
+            self.blank_pdf("b.pdf", 2, width=200),
+            self.blank_pdf("c.pdf", 1, width=300),
+        ]
+        output = self.directory / "book.pdf"
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/")
+        self.addCleanup(converter.close)
+
+        converter.merge_pdfs(files, str(output), titles=["A", "第二章", None])
+
+        reader = gitbook_to_pdf.PdfReader(str(output))
+        self.assertEqual(
+            [float(page.mediabox.width) for page in reader.pages],
+            [100, 200, 200, 300],
+        )
+        self.assertEqual(
+            [
+                (item.title, reader.get_destination_page_number(item))
+                for item in reader.outline
+            ],
+            [("A", 0), ("第二章", 1)],
+        )
+        self.assertFalse(any(os.path.exists(pdf) for pdf in files))
+
+    def test_unreadable_inputs_are_skipped(self):
+        broken = self.directory / "broken.pdf"
+        broken.write_bytes(b"not a pdf")
+        files = [self.blank_pdf("a.pdf", 1), str(broken), self.blank_pdf("b.pdf", 2)]
+        output = self.directory / "book.pdf"
+        converter = gitbook_to_pdf.GitbookToPDF("https://example.com/")
+        self.addCleanup(converter.close)
+
+        with redirect_stdout(io.StringIO()):
+            converter.merge_pdfs(files, str(output))
+
+        self.assertEqual(len(gitbook_to_pdf.PdfReader(str(output)).pages), 3)
+
+
+class ChunkedRenderTests(unittest.TestCase):
+    @patch("gitbook_to_pdf.pdfkit.from_file")
+    @patch("gitbook_to_pdf.pdfkit.configuration")
+    @patch("gitbook_to_pdf.resolve_wkhtmltopdf")
+    def test_chunks_render_in_parallel_and_merge_with_page_numbers(
+        self,
+        resolve,
+        configuration,
+        from_file,
+    ):
+        rendered = {}
+        lock = threading.Lock()
+
+        def fake_wkhtmltopdf(source, output, options, configuration):
+            html = Path(source).read_text(encoding="utf-8")
+            if "page-break-after" in html:
+                pages = html.count("page-break-after") + 1
+            else:
+                pages = html.count('class="page-break"')
+            with lock:
+                rendered[Path(source).name] = (html, options)
+            write_blank_pdf(output, pages)
+
+        from_file.side_effect = fake_wkhtmltopdf
+        pages = {
+            "https://example.com/": link_page(
+                "Home", *[f"/{index}" for index in range(4)]
+            ),
+        }
+        for index in range(4):
+            pages[f"https://example.com/{index}"] = link_page(str(index))
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / "book.pdf"
+            with gitbook_to_pdf.GitbookToPDF(
+                "https://example.com/", chunk_pages=2, render_workers=3
+            ) as converter:
+                converter.session.get = Mock(side_effect=fake_site(pages))
+                converter.download_css = Mock(return_value="")
+                with redirect_stdout(io.StringIO()):
+                    converter.get_page_content("https://example.com/")
+                    converter.generate_pdf(str(output))
+
+            page_count = len(gitbook_to_pdf.PdfReader(str(output)).pages)
+
+        self.assertEqual(page_count, 5)
+        self.assertEqual(
+            sorted(rendered),
+            [
+                "chunk_000.html",
+                "chunk_001.html",
+                "chunk_002.html",
+                "page_numbers.html",
+            ],
+        )
+        self.assertIn("cover-title", rendered["chunk_000.html"][0])
+        self.assertNotIn("cover-title", rendered["chunk_001.html"][0])
+        self.assertNotIn("footer-center", rendered["chunk_001.html"][1])
+        number_options = rendered["page_numbers.html"][1]
+        self.assertEqual(number_options["footer-center"], "[page]")
+        self.assertNotIn("header-right", number_options)
+        self.assertIn("no-background", number_options)
+
+
+class SingleDocumentPrintTests(unittest.TestCase):
+    def setUp(self):
+        self.pages = {
+            "https://example.com/": link_page(
+                "Home", *[f"/{index}" for index in range(4)]
+            ),
+        }
+        for index in range(4):
+            self.pages[f"https://example.com/{index}"] = link_page(str(index))
+        self.printed = {}
+        self.lock = threading.Lock()
+
+        def fake_print(driver, path, options, chunk_size=None):
+            html = Path(driver.get.call_args.args[0][len("file://"):])
+            html = html.read_text(encoding="utf-8")
+            if "page-break-after" in html:
+                pages = html.count("page-break-after") + 1
+            else:
+                pages = html.count('class="page-break"')
+            with self.lock:
+                self.printed[Path(path).name] = (html, options)
+            write_blank_pdf(path, pages)
+
+        for target, replacement in (
+            ("setup_chrome_driver", lambda *args, **kwargs: Mock()),
+            ("wait_for_page_ready", None),
+            ("print_to_file", fake_print),
+        ):
+            patcher = patch(f"gitbook_to_pdf.{target}", side_effect=replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def export(self, output, **options):
+        with gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", method="print", single_document=True,
+            **options
+        ) as converter:
+            converter.session.get = Mock(side_effect=fake_site(self.pages))
+            converter.download_css = Mock(return_value="")
+            converter.print_to_pdf = Mock()
+            with redirect_stdout(io.StringIO()):
+                converter.get_page_content("https://example.com/")
+                converter.generate_pdf(str(output))
+        converter.print_to_pdf.assert_not_called()
+        return len(gitbook_to_pdf.PdfReader(str(output)).pages)
+
+    def test_book_is_printed_as_one_chrome_document(self):
+        with tempfile.TemporaryDirectory() as directory:
+            page_count = self.export(Path(directory) / "book.pdf")
+
+        self.assertEqual(page_count, 5)
+        self.assertEqual(list(self.printed), ["book.pdf"])
+        html, options = self.printed["book.pdf"]
+        self.assertIn("cover-title", html)
+        self.assertIn("3 body", html)
+        self.assertTrue(options["displayHeaderFooter"])
+        self.assertIn('class="pageNumber"', options["footerTemplate"])
+
+    def test_chunks_are_printed_in_parallel_and_numbered_by_an_overlay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            page_count = self.export(
+                Path(directory) / "book.pdf", chunk_pages=2, print_workers=2
+            )
+
+        self.assertEqual(page_count, 5)
+        self.assertEqual(
+            sorted(self.printed),
+            [
+                "chunk_000.pdf",
+                "chunk_001.pdf",
+                "chunk_002.pdf",
+                "page_numbers.pdf",
+            ],
+        )
+        self.assertNotIn("cover-title", self.printed["chunk_001.pdf"][0])
+        self.assertNotIn(
+            "pageNumber", self.printed["chunk_001.pdf"][1]["footerTemplate"]
+        )
+        number_options = self.printed["page_numbers.pdf"][1]
+        self.assertIn('class="pageNumber"', number_options["footerTemplate"])
+        self.assertFalse(number_options["printBackground"])
+
+
+class Crash(BaseException):
+    """Simulates the process dying in the middle of an export."""
+
+
+class ResumeTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.work_dir = Path(directory.name) / "work"
+
+    def converter(self, **kwargs):
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/",
+            work_dir=str(self.work_dir),
+            discover=False,
+            concurrency=1,
+            **kwargs,
+        )
+        converter.checkpoint.interval = 0
+        return converter
+
+    def test_interrupted_crawl_resumes_with_missing_pages_only(self):
+        pages = {
+            "https://example.com/": link_page("Home", "/a", "/b", "/c"),
+            "https://example.com/a": link_page("A"),
+            "https://example.com/b": link_page("B"),
+            "https://example.com/c": link_page("C"),
+        }
+
+        def crash_on_b(url, **kwargs):
+            if url == "https://example.com/b":
+                raise Crash()
+            return fake_site(pages)(url)
+
+        first = self.converter()
+        first.session.get = Mock(side_effect=crash_on_b)
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(Crash):
+                first.get_page_content("https://example.com/")
+        first.close()
+        self.assertTrue(self.work_dir.is_dir())
+
+        second = self.converter(resume=True)
+        self.addCleanup(second.close)
+        second.session.get = Mock(side_effect=fake_site(pages))
+        with redirect_stdout(io.StringIO()):
+            second.get_page_content("https://example.com/")
+
+        fetched = [call.args[0] for call in second.session.get.call_args_list]
+        self.assertEqual(
+            fetched, ["https://example.com/b", "https://example.com/c"]
+        )
+        self.assertEqual(
+            [fragment.split("<article>")[1] for fragment in read_fragments(second)],
+            [f"{name} body</article>" for name in ("Home", "A", "B", "C")],
+        )
+        self.assertEqual(second.title, "Home")
+
+    @patch("gitbook_to_pdf.time.sleep")
+    @patch("gitbook_to_pdf.setup_chrome_driver")
+    def test_interrupted_print_run_only_prints_missing_pages(
+        self,
+        setup_driver,
+        sleep,
+    ):
+        urls = [f"https://example.com/{index}" for index in range(1, 4)]
+
+        def print_to_pdf(url, index, driver=None):
+            if index == 2:
+                raise Crash()
+            return f"page_{index:03d}.pdf"
+
+        first = self.converter(method="print")
+        first.print_to_pdf = Mock(side_effect=print_to_pdf)
+        first.get_all_links = Mock(return_value=urls)
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(Crash):
+                first.generate_pdf("output.pdf")
+        first.close()
+
+        second = self.converter(method="print", resume=True)
+        self.addCleanup(second.close)
+        second.print_to_pdf = Mock(
+            side_effect=lambda url, index, driver=None: f"page_{index:03d}.pdf"
+        )
+        second.get_all_links = Mock()
+        second.merge_pdfs = Mock()
+        with redirect_stdout(io.StringIO()):
+            second.generate_pdf("output.pdf")
+
+        second.get_all_links.assert_not_called()
+        self.assertEqual(
+            [call.args[1] for call in second.print_to_pdf.call_args_list],
+            [2, 3],
+        )
+        self.assertEqual(
+            second.merge_pdfs.call_args.args[0],
+            [f"page_{index:03d}.pdf" for index in range(4)],
+        )
+        self.assertFalse(second.checkpoint.path.exists())
+
+    def test_checkpoint_of_another_export_is_ignored(self):
+        converter = self.converter()
+        converter._save_checkpoint({"stage": "crawl"}, force=True)
+        converter.close()
+
+        with self.assertLogs(level="WARNING"):
+            other = gitbook_to_pdf.GitbookToPDF(
+                "https://other.example.com/",
+                work_dir=str(self.work_dir),
+                resume=True,
+            )
+        other.close()
+
+        self.assertIsNone(other._resume_state)
+
+    def test_resume_requires_a_work_directory(self):
+        with self.assertRaisesRegex(ValueError, "work directory"):
+            gitbook_to_pdf.GitbookToPDF("https://example.com/", resume=True)
+
+
+class MetricsTests(unittest.TestCase):
+    def test_timers_counters_and_hooks(self):
+        metrics = gitbook_to_pdf.Metrics()
+        events = []
+        metrics.add_hook(lambda *event: events.append(event))
+        metrics.add_hook(Mock(side_effect=RuntimeError("tracer down")))
+
+        for seconds in (0.4, 0.1, 0.2, 0.3):
+            metrics.observe("fetch_page", seconds, url=f"https://e.com/{seconds}")
+        metrics.increment("http_bytes", 512)
+        metrics.increment("http_bytes", 512)
+        with self.assertLogs(level="ERROR"):
+            metrics.increment("http_requests")
+
+        report = metrics.report()
+        self.assertEqual(report["counters"], {"http_bytes": 1024, "http_requests": 1})
+        self.assertEqual(report["timers"]["fetch_page"]["count"], 4)
+        self.assertEqual(report["timers"]["fetch_page"]["p50_seconds"], 0.2)
+        self.assertEqual(report["timers"]["fetch_page"]["max_seconds"], 0.4)
+        self.assertEqual(len(report["pages"]), 4)
+        self.assertIn(("counter", "http_bytes", 512, {}), events)
+        self.assertIn(
+            ("timer", "fetch_page", 0.1, {"url": "https://e.com/0.1"}), events
+        )
+
+        text = metrics.prometheus()
+        self.assertIn("gitbook_to_pdf_http_bytes_total 1024\n", text)
+        self.assertIn(
+            'gitbook_to_pdf_stage_seconds_count{stage="fetch_page"} 4\n', text
+        )
+
+    def test_crawl_is_instrumented(self):
+        converter = gitbook_to_pdf.GitbookToPDF(
+            "https://example.com/", discover=False
+        )
+        self.addCleanup(converter.close)
+        converter.session.get = Mock(side_effect=fake_site({
+            "https://example.com/": link_page("Home", "/a"),
+            "https://example.com/a": link_page("A"),
+        }))
+
+        with redirect_stdout(io.StringIO()):
+            converter.get_page_content("https://example.com/")
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "metrics.json"
+            converter.write_metrics(path)
+            report = json.loads(path.read_text())
+
+        self.assertEqual(report["counters"]["http_requests"], 2)
+        self.assertEqual(report["counters"]["pages_extracted"], 2)
+        self.assertEqual(report["timers"]["get_page_content"]["count"], 1)
+        self.assertEqual(
+            sorted(page["url"] for page in report["pages"]),
+            ["https://example.com/", "https://example.com/a"],
+        )
+
+    def test_ready_timeout_must_be_positive(self):
+        stderr = io.StringIO()
+        with redirect_stderr(stderr), self.assertRaises(SystemExit):
+            gitbook_to_pdf.main(["https://example.com", "--ready-timeout", "0"])
+
+        self.assertIn("--ready-timeout", stderr.getvalue())
+
+    @patch("gitbook_to_pdf.GitbookToPDF")
+    def test_metrics_are_written_when_the_export_fails(self, converter_class):
+        converter = converter_class.return_value.__enter__.return_value
+        converter.generate_pdf.side_effect = RuntimeError("render failed")
+
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            gitbook_to_pdf.main([
+                "https://example.com",
+                "--metrics-out", "metrics.prom",
+                "--metrics-format", "prometheus",
+            ])
+
+        converter.write_metrics.assert_called_once_with(
+            "metrics.prom", "prometheus"
+        )
+
 
 class CommandLineTests(unittest.TestCase):
     @patch("gitbook_to_pdf.GitbookToPDF")
@@ -250,6 +2406,29 @@ class CommandLineTests(unittest.TestCase):
             "https://example.com",
             method="html",
             wkhtmltopdf_path="/custom/wkhtmltopdf",
+            concurrency=4,
+            max_per_host=None,
+            rate_limit=None,
+            timeout=gitbook_to_pdf.DEFAULT_TIMEOUT,
+            retries=gitbook_to_pdf.DEFAULT_RETRIES,
+            print_workers=1,
+            image_workers=None,
+            max_image_dpi=None,
+            image_quality=None,
+            chunk_pages=None,
+            render_workers=None,
+            discover=True,
+            query_policy="strip-tracking",
+            content_selectors=None,
+            parse_workers=None,
+            prune_css=True,
+            single_document=False,
+            ready_timeout=10,
+            cache_dir=None,
+            cache_size_mb=gitbook_to_pdf.DEFAULT_CACHE_SIZE_MB,
+            store_dir=None,
+            work_dir=None,
+            resume=False,
         )
         converter.get_page_content.assert_called_once_with(
             "https://example.com"